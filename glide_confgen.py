@@ -36,7 +36,8 @@
 #
 import sys
 import csv
-import sqlite3
+import hasten_db
+import hasten_ingest
 from schrodinger import structure
 
 mols = {}
@@ -48,17 +49,9 @@ for st in reader:
         mols[s[1]] = "{ \n  s_m_m2io_version\n  :::\n  2.0.0 \n} \n\n"
     mols[s[1]]+=structure.write_ct_to_string(st)
 
-try:
-    conn=sqlite3.connect(sys.argv[2])
-except:
-    print("Error while accessing database!")
-finally:
-    if conn:
-        c=conn.cursor()
-        to_db = []
-        for hastenid in mols:
-            to_db.append((hastenid,bytes(mols[hastenid],encoding="utf-8")))
-        c.executemany("REPLACE INTO confs(hastenid,conf) VALUES (?,?)",to_db)
-        conn.commit()
-        conn.close()
-        print("glide_confgen.py done.")
+to_db = []
+for hastenid in mols:
+    to_db.append((hastenid,bytes(mols[hastenid],encoding="utf-8")))
+hasten_ingest.write_confs(sys.argv[2],to_db)
+hasten_db.close()
+print("glide_confgen.py done.")
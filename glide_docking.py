@@ -34,14 +34,16 @@
 # 4 = database name
 # 5 = smilesid to hastenid mapping
 # 6 = cutoff for storing posees
+# 7 = iteration (optional)
+# 8 = docking cascade stage (optional, only for the earlier stages)
 #
 # Written with Schrodinger Suite 2020-3
 #
 import sys
-import csv
-import sqlite3
 from schrodinger import structure
 
+import hasten_ingest
+
 # read in hastenids (in docked file they use smilesids)
 smilesid_to_hastenid = {}
 for line in open(sys.argv[5],"rt"):
@@ -49,45 +51,29 @@ for line in open(sys.argv[5],"rt"):
     smilesid_to_hastenid[l[0]] = l[1]
 
 score_cutoff = float(sys.argv[6])
+iteration = int(sys.argv[7]) if len(sys.argv)>7 else None
+stage = int(sys.argv[8]) if len(sys.argv)>8 else None
 
-mols = {}
-poses = {}
-reader = structure.StructureReader(sys.argv[1])
-for st in reader:
-    s=st.property["s_m_title"]
-    hastenid=smilesid_to_hastenid[s]
-    docking_score=float(st.property["r_i_docking_score"])
-    if hastenid not in mols or mols[hastenid]>=docking_score:
-        mols[hastenid] = docking_score
+docked = set()
+with hasten_ingest.DockIngest(sys.argv[4],stage=stage) as ingest:
+    reader = structure.StructureReader(sys.argv[1])
+    for st in reader:
+        s=st.property["s_m_title"]
+        hastenid=smilesid_to_hastenid[s]
+        docking_score=float(st.property["r_i_docking_score"])
+        pose = None
         if docking_score <= score_cutoff:
-            poses[hastenid] = "{ \n  s_m_m2io_version\n  :::\n  2.0.0 \n} \n\n"+structure.write_ct_to_string(st)
-
-# check not docked mols and give them bad score
-reader = structure.StructureReader(sys.argv[2])
-bad_score = float(sys.argv[3])
-for st in reader:
-    s=st.property["s_m_title"]
-    hastenid=smilesid_to_hastenid[s]
-    if hastenid not in mols:
-        mols[hastenid] = bad_score
+            pose = "{ \n  s_m_m2io_version\n  :::\n  2.0.0 \n} \n\n"+structure.write_ct_to_string(st)
+        ingest.add(hastenid,docking_score,iteration,pose)
+        docked.add(hastenid)
 
-try:
-    conn=sqlite3.connect(sys.argv[4])
-except:
-    print("Error while accesing database")
-    sys.exit(1)
-finally:
-    if conn:
-        c=conn.cursor()
-        to_db = []
-        for hastenid in mols:
-            to_db.append((mols[hastenid],hastenid))
-        c.executemany("UPDATE data SET dock_score = ? WHERE hastenid = ?",to_db)
-        conn.commit()
-        to_db = []
-        for hastenid in poses:
-            to_db.append((hastenid,bytes(poses[hastenid],encoding="utf-8")))
-        c.executemany("REPLACE INTO poses(hastenid,pose) VALUES (?,?)",to_db)
-        conn.commit()
-        conn.close()
-        print("glide_docking.py done.")
+    # check not docked mols and give them bad score
+    reader = structure.StructureReader(sys.argv[2])
+    bad_score = float(sys.argv[3])
+    for st in reader:
+        s=st.property["s_m_title"]
+        hastenid=smilesid_to_hastenid[s]
+        if hastenid not in docked:
+            ingest.add(hastenid,bad_score,iteration)
+            docked.add(hastenid)
+print("glide_docking.py done.")
@@ -51,5 +51,5 @@ maename=`echo $1 | sed -e 's:.out:.mae:'`
 mv $1 $maename
 sed -e "s:INPUTMAEGZ:$maename:" $infile >$tmpin
 $SCHRODINGER/glide -HOST localhost:$cpu -NJOBS $cpu -WAIT -OVERWRITE $tmpin
-$SCHRODINGER/run $glide_docking_py $libfile $maename $failed_dock_score $2 $3 $store_poses_cutoff
+$SCHRODINGER/run $glide_docking_py $libfile $maename $failed_dock_score $2 $3 $store_poses_cutoff $4 $5
 rm -f $tmpin $logfile $subjoblog $subjoblogposes $subjobtar $libfile $maename
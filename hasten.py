@@ -36,10 +36,24 @@ import argparse
 import os
 import sys
 import csv
-import sqlite3
 import random
-import tempfile
 import glob
+import json
+import math
+import asyncio
+
+import hasten_acquisition
+import hasten_db
+import hasten_dedup
+import hasten_dockcost
+import hasten_ingest
+import hasten_leaderboard
+import hasten_library
+import hasten_memory
+import hasten_runner
+import hasten_scratch
+import hasten_status
+import hasten_target
 
 def parse_cmd_line():
     """
@@ -51,9 +65,12 @@ def parse_cmd_line():
     parser.add_argument("-m","--database",required=False,type=str,help="HASTEN database")
     parser.add_argument("-p","--protocol",required=True,type=str,help="Screening protocol file")
     parser.add_argument("-i","--iteration",required=False,type=int,help="Iteration number to start")
+    parser.add_argument("-t","--target",required=False,type=str,help="Screen a target of the database (see hasten_target.py)")
 
-    parser.add_argument("-a","--hand-operate",required=False,type=str,choices=["dock","train","split-dock","split-pred","pred","import-pred","simu-dock"],help="Hand-operated mode (only for expert users)")
+    parser.add_argument("-a","--hand-operate",required=False,type=str,choices=["dock","train","split-dock","split-pred","split-pred-ranges","pred","import-pred","simu-dock"],help="Hand-operated mode (only for expert users)")
     parser.add_argument("-c","--cpu",required=False,type=int,help="In hand-operated mode: how many CPUs to use")
+    parser.add_argument("--max-memory",required=False,type=str,help="Memory budget like 16G (overrides memory_budget of protocol)")
+    parser.add_argument("--scratch-dir",required=False,type=str,help="Directory for the input files of the plug-in scripts (overrides scratch_dir of protocol)")
     return parser.parse_args()
 
 def files_exist(args):
@@ -66,20 +83,26 @@ def files_exist(args):
     if args.database is not None and not os.path.exists(args.database):
         print("HASTEN database file missing!")
         return False
+    if args.database is None and args.target is not None:
+        print("Target (-t) needs the HASTEN database (-m)")
+        return False
     if not os.path.exists(args.protocol):
         print("Screening protocol file missing!")
         return False
     return True
 
-def get_protocol(filename):
+def get_protocol(filename,check_files=True):
     """
     Load a protocol file
 
     :param filename: Filename for the .protocol file
+    :param check_files: Check that the plug-in scripts exist
     :return: Protocol dictionary
     """
     protocol = {}
-    keywords = {"confgen":"file","docking":"file","ml_train":"file","ml_pred":"file","dataset_size":"float","dataset_split":"floats3","train_mode":"text","random_seed":"integer","pred_size":"integer","stop_criteria":"integer","pred_split":"integer","dock_split":"integer"}
+    keywords = {"confgen":"file","docking":"file","ml_train":"file","ml_pred":"file","dataset_size":"float","dataset_split":"floats3","train_mode":"text","random_seed":"integer","pred_size":"integer","stop_criteria":"integer","pred_split":"integer","dock_split":"integer","leaderboard_size":"integer","docking_cascade":"cascade","acquisition":"text","acquisition_beta":"float","diversity_bucket_size":"integer","stage_timeout":"integer","stage_retries":"integer","confgen_parallel":"integer","docking_parallel":"integer","ml_pred_parallel":"integer","pred_store":"text","pred_store_dtype":"text","db_cache_size":"integer","db_mmap_size":"integer","db_page_size":"integer","train_budget":"integer","train_top_fraction":"float","memory_budget":"text","dock_split_balance":"text","scratch_dir":"text","plugin_io":"text"}
+    # optional keywords
+    defaults = {"leaderboard_size":hasten_leaderboard.DEFAULT_SIZE,"docking_cascade":[],"acquisition":"greedy","acquisition_beta":1.0,"diversity_bucket_size":10,"stage_timeout":0,"stage_retries":0,"confgen_parallel":1,"docking_parallel":1,"ml_pred_parallel":1,"pred_store":"sqlite","pred_store_dtype":"float32","db_cache_size":hasten_db.SETTINGS["cache_size"],"db_mmap_size":hasten_db.SETTINGS["mmap_size"],"db_page_size":hasten_db.SETTINGS["page_size"],"train_budget":0,"train_top_fraction":0.5,"memory_budget":"0","dock_split_balance":"cost","scratch_dir":"","plugin_io":"files"}
     for line in open(filename,"rt"):
         if line[0].startswith("#"):
             continue
@@ -88,7 +111,7 @@ def get_protocol(filename):
             print("Invalid line in protocol:"+line.strip())
             sys.exit(1)
         if keywords[l[0]] == "file":
-            if not os.path.exists(l[1]):
+            if check_files and not os.path.exists(l[1]):
                 print("checking",l[0])
                 print(l[0],"is defined but is missing in the protocol file")
                 sys.exit(1)
@@ -114,6 +137,22 @@ def get_protocol(filename):
                     protocol[l[0]].append(float(number))
         elif keywords[l[0]] == "text":
             protocol[l[0]] = l[1]
+        elif keywords[l[0]] == "cascade":
+            protocol[l[0]] = []
+            for stage in l[1].split():
+                s = stage.rsplit(":",1)
+                try:
+                    fraction = float(s[1])
+                except (ValueError,IndexError):
+                    print(l[0],"must be list of script:fraction pairs seperated by space in the protocol file")
+                    sys.exit(1)
+                if fraction<=0.0 or fraction>1.0:
+                    print(l[0],"fractions must be between 0 and 1 in the protocol file")
+                    sys.exit(1)
+                if check_files and not os.path.exists(s[0]):
+                    print(s[0],"is defined in",l[0],"but is missing")
+                    sys.exit(1)
+                protocol[l[0]].append((s[0],fraction))
         elif keywords[l[0]] == "integer":
             try:
                 protocol[l[0]] = int(l[1])
@@ -121,8 +160,36 @@ def get_protocol(filename):
                 print(l[0],"needs to be an integer in the protocol file.")
                 sys.exit(1)
 
+    # fail early on unknown strategy
+    if "acquisition" in protocol:
+        hasten_acquisition.get_strategy(protocol["acquisition"])
+    if protocol.get("pred_store","sqlite") not in ["sqlite","mmap"]:
+        print("pred_store must be sqlite or mmap in the protocol file")
+        sys.exit(1)
+    if protocol.get("pred_store_dtype","float32") not in ["float32","float16"]:
+        print("pred_store_dtype must be float32 or float16 in the protocol file")
+        sys.exit(1)
+    if protocol.get("train_budget",0)>0 and protocol.get("train_mode")=="shards":
+        print("train_budget can not be used with train_mode=shards in the protocol file")
+        sys.exit(1)
+    if protocol.get("train_budget",0)<0 or not 0.0<=protocol.get("train_top_fraction",0.5)<=1.0:
+        print("train_budget must be zero or positive and train_top_fraction between 0 and 1 in the protocol file")
+        sys.exit(1)
+    if protocol.get("dock_split_balance","cost") not in ["cost","count"]:
+        print("dock_split_balance must be cost or count in the protocol file")
+        sys.exit(1)
+    if protocol.get("plugin_io","files") not in ["files","pipes"]:
+        print("plugin_io must be files or pipes in the protocol file")
+        sys.exit(1)
+    if min(protocol.get(stage+"_parallel",1) for stage in ["confgen","docking","ml_pred"])<1:
+        print("confgen_parallel, docking_parallel and ml_pred_parallel must be at least 1 in the protocol file")
+        sys.exit(1)
+
     for keyword in keywords:
         if keyword not in protocol:
+            if keyword in defaults:
+                protocol[keyword] = defaults[keyword]
+                continue
             print(keyword,"not defined in protocol.")
             sys.exit(1)
 
@@ -138,35 +205,40 @@ def pick_compounds_for_docking(protocol,db,iteration,skip_confgen=False):
     :param iteration: iteration integer
     :param skip_confgen: Skip confgen (useful in hand-operate mode)
     """
-    try:
-        conn=sqlite3.connect(db)
-    except:
-        print("Error while accessing database!")
-        sys.exit(1)
+    conn=hasten_db.connect(db)
     if conn:
         c = conn.cursor()
-        # counting is very slow and we are not deleting so use a hack here
-        # https://stackoverflow.com/questions/8988915/sqlite-count-slow-on-big-tables
-        #number_of_mols=c.execute("SELECT COUNT() FROM data").fetchone()[0]
-        number_of_mols=c.execute("SELECT MAX(_ROWID_) FROM data LIMIT 1").fetchone()[0]
+        # counting is very slow, the number is kept in stats table
+        number_of_mols=hasten_status.get_stats(conn)["total"]
         number_to_dock=int(round(protocol["dataset_size"]*number_of_mols))
         print("Number of molecules in the database",number_of_mols)
         print("Picking",protocol["dataset_size"]*100,"% for docking (",number_to_dock,")...")
+        hasten_memory.check(number_to_dock*compound_row_size(db,conn),"the compounds picked for docking","Use smaller dataset_size in the protocol.")
 
-        # first time pick just random set (slow way but as this is done once in
-        # every iteration it does not matter)
+        # first time pick just random set (random hastenids, no sorting)
         if iteration==1:
-            to_dock=c.execute("SELECT hastenid FROM data WHERE dock_score IS NULL ORDER BY random() LIMIT ?",[number_to_dock,]).fetchall()
+            pick = lambda number: hasten_acquisition.pick_random(conn,protocol,number)
         else:
-            to_dock=c.execute("SELECT hastenid FROM data WHERE dock_score IS NULL ORDER BY pred_score LIMIT ?",[number_to_dock,]).fetchall()
-        smilesids = []
-        for smile_id in to_dock: smilesids.append(smile_id[0])
+            print("Acquisition strategy:",protocol["acquisition"])
+            store = get_pred_store(protocol,db)
+            if store is not None:
+                pred_iteration = iteration if iteration in store.iterations() else store.latest_iteration()
+                if pred_iteration is None:
+                    print("No predictions in",store.path)
+                    sys.exit(1)
+                print("Using predictions of iteration",pred_iteration,"from",store.path)
+                pick = lambda number: store.pick(conn,protocol,pred_iteration,number)
+            else:
+                strategy = hasten_acquisition.get_strategy(protocol["acquisition"])
+                pick = lambda number: strategy(conn,protocol,number)
+        # identical SMILES are docked once, the score is fanned out to the
+        # other compounds of the group
+        smilesids = hasten_dedup.pick_representatives(conn,pick,number_to_dock)
 
         if not skip_confgen:
             # check by joining to confs table which of the mols have already confs 
             sqlstr="SELECT data.hastenid FROM data INNER JOIN confs ON confs.hastenid=data.hastenid WHERE confs.conf IS NOT NULL AND data.hastenid IN {}".format(str(tuple(smilesids))).replace("[","").replace("]","")
             confs_avail=c.execute(sqlstr).fetchall()
-            conn.close()
    
             # add to list those that do not have conf 
             confgen_smilesids = []
@@ -181,6 +253,18 @@ def pick_compounds_for_docking(protocol,db,iteration,skip_confgen=False):
     
         return(smilesids,calc_confs)
 
+def parallel_chunks(smilesids,parts):
+    """
+    Split compounds into chunks of (nearly) equal size for the parallel
+    runs of a stage
+
+    :param smilesids: List of hastenids
+    :param parts: number of chunks
+    :return: list of lists of hastenids
+    """
+    size = max(1,int(math.ceil(len(smilesids)/max(1,parts))))
+    return [smilesids[start:start+size] for start in range(0,len(smilesids),size)]
+
 def run_confgen(protocol,db,smilesids,runmode="dock",cpu=None):
     """
     Run outside conformer generator (simply starts external code)
@@ -196,33 +280,99 @@ def run_confgen(protocol,db,smilesids,runmode="dock",cpu=None):
     if runmode=="split-dock":
         print("NOTE: splitted mode activate: preparing files for both confgen and docking...")
         return
-    try:
-        conn=sqlite3.connect(db)
-    except:
-        print("Error while accessing database!")
-        sys.exit(1)
+    conn=hasten_db.connect(db)
     if conn:
-        c = conn.cursor()
-        sqlstr="SELECT smiles,smilesid,hastenid FROM data WHERE hastenid IN {}".format(str(tuple(smilesids))).replace("[","").replace("]","")
-        rowsmiles=c.execute(sqlstr).fetchall()
-        conn.close()
+        def write_smiles(w,chunk):
+            c = hasten_db.connect(db).cursor()
+            sqlstr="SELECT smiles,smilesid,hastenid FROM data WHERE hastenid IN ("+",".join(str(hastenid) for hastenid in chunk)+")"
+            for row in hasten_library.fill_text(db,c.execute(sqlstr).fetchall(),2,0,1):
+                w.write(row[0]+" "+row[1]+"|"+str(row[2])+"\n")
 
         if runmode == "dock":
-            temp_name = tempfile.mkstemp(".smi","hasten_confgen_","/tmp")[1]
-            w = open(temp_name,"wt")
-            for row in rowsmiles:
-                w.write(row[0]+" "+row[1]+"|"+str(row[2])+"\n")
-            w.close()
-            os.system(protocol["confgen"]+" "+temp_name+" "+db)
-            # clean up if the confgen script did not already
-            try:
-                os.unlink(temp_name)
-            except:
-                pass
+            runner = hasten_runner.StageRunner(protocol)
+            async def confgen(chunk):
+                with hasten_scratch.Input(".smi","hasten_confgen_",lambda w: write_smiles(w,chunk)) as smi:
+                    await runner.run("confgen",protocol["confgen"],[smi.name,db])
+            # confgen_parallel runs at once, one chunk of compounds each
+            chunks = parallel_chunks(smilesids,runner.limits["confgen"])
+            runner.execute(runner.run_bounded((confgen(chunk) for chunk in chunks),runner.limits["confgen"]))
         else:
             print("BUG AT RUN_CONFGEN!!!!")
             sys.exit(10)
 
+def dock_stage(protocol,script,db,smilesids,iteration,runmode="dock",stage=None):
+    """
+    Export compounds and run one docking script for them
+
+    :param protocol: Protocol dictionary
+    :param script: docking script
+    :param db: The filename of SQlite3 database
+    :param smilesids: List of hastenids to be exported
+    :param iteration: iteration integer
+    :param runmode: Either "dock" (default) or "simu-dock"
+    :param stage: cascade stage number (None for the final docking)
+    """
+    stage_arg = [] if stage is None else [stage]
+    runner = hasten_runner.StageRunner(protocol)
+    def write_ids(w,chunk,source="data"):
+        c = hasten_db.connect(db).cursor()
+        sqlstr="SELECT data.smilesid,data.hastenid FROM "+source+" WHERE data.hastenid IN ("+",".join(str(hastenid) for hastenid in chunk)+")"
+        for row in hasten_library.fill_text(db,c.execute(sqlstr).fetchall(),1,None,0):
+            w.write(str(row[0])+"|"+str(row[1])+"\n")
+    def write_confs(w,chunk):
+        c = hasten_db.connect(db).cursor()
+        sqlstr="SELECT conf FROM confs WHERE hastenid IN ("+",".join(str(hastenid) for hastenid in chunk)+")"
+        for rows in hasten_memory.fetch_chunks(c.execute(sqlstr),123456,what="conformers for docking"):
+            for row in rows:
+                w.write(row[0])
+    async def dock(chunk):
+        if runmode == "dock":
+            with hasten_scratch.Input(".out","hasten_dock_confs_",lambda w: write_confs(w,chunk),binary=True) as confs, hasten_scratch.Input(".txt","hasten_dock_ids_",lambda w: write_ids(w,chunk,"confs INNER JOIN data ON data.hastenid=confs.hastenid")) as ids:
+                await runner.run("docking",script,[confs.name,db,ids.name,iteration]+stage_arg)
+        elif runmode=="simu-dock":
+            # the ids are given as the conformers too, so always a file
+            with hasten_scratch.Input(".txt","hasten_dock_ids_",lambda w: write_ids(w,chunk),pipe=False) as ids:
+                await runner.run("docking",script,[ids.name,db,ids.name,iteration]+stage_arg)
+    # docking_parallel runs at once, one chunk of compounds each
+    chunks = parallel_chunks(smilesids,runner.limits["docking"])
+    runner.execute(runner.run_bounded((dock(chunk) for chunk in chunks),runner.limits["docking"]))
+
+def run_cascade(protocol,db,smilesids,iteration,runmode="dock"):
+    """
+    Run the fast docking stages of the cascade. Each stage docks the
+    compounds given to it and the best fraction is passed to the next
+    stage. The compounds dropped by a stage are not docked further: their
+    scores stay in stage_scores table and they are marked (dataset_status)
+    so that they are not predicted or picked again.
+
+    :param protocol: Protocol dictionary
+    :param db: The filename of SQlite3 database
+    :param smilesids: List of hastenids selected for docking
+    :param iteration: iteration integer
+    :param runmode: Either "dock" (default) or "simu-dock"
+    :return: List of hastenids for the final docking
+    """
+    for stage,(script,fraction) in enumerate(protocol["docking_cascade"],start=1):
+        print("Cascade stage",stage,"docking",len(smilesids),"compounds...")
+        dock_stage(protocol,script,db,smilesids,iteration,runmode,stage)
+        conn=hasten_db.connect(db)
+        c = conn.cursor()
+        scores = []
+        chunk_size = 900
+        for start in range(0,len(smilesids),chunk_size):
+            chunk = smilesids[start:start+chunk_size]
+            sqlstr="SELECT score,hastenid FROM stage_scores WHERE stage = ? AND iteration = ? AND hastenid IN ("+",".join(["?"]*len(chunk))+")"
+            scores.extend(c.execute(sqlstr,[stage,iteration]+chunk).fetchall())
+        scores.sort()
+        survivors = int(math.ceil(fraction*len(scores)))
+        # compounds without stage score (failed stage) go to next stage
+        scored = set(score[1] for score in scores)
+        next_stage = [hastenid for score,hastenid in scores[:survivors]]+[hastenid for hastenid in smilesids if hastenid not in scored]
+        hasten_ingest.write_dropped(db,[hastenid for score,hastenid in scores[survivors:]])
+        print("Cascade stage",stage,"passed",len(next_stage),"compounds")
+        smilesids = next_stage
+    return smilesids
+
 def run_docking(protocol,db,smilesids,iteration,runmode="dock",cpu=1):
     """
     Run outside docking (simply starts external code)
@@ -234,56 +384,28 @@ def run_docking(protocol,db,smilesids,iteration,runmode="dock",cpu=1):
     :param runmode: Either "dock" (default) or "split-dock" or "simu-dock"
     :param cpu: if in "split-dock", the number of CPUs to use
     """
-    db_chunk_size=123456
-    conn=sqlite3.connect(db)
-    c = conn.cursor()
-    if runmode == "dock":
-        sqlstr="SELECT conf,data.hastenid,data.smilesid FROM confs INNER JOIN data ON data.hastenid=confs.hastenid WHERE data.hastenid IN {}".format(str(tuple(smilesids))).replace("[","").replace("]","")
-        temp_name = tempfile.mkstemp(".out","hasten_dock_confs_","/tmp")[1]
-        temp2_name = tempfile.mkstemp(".txt","hasten_dock_ids_","/tmp")[1]
-        w = open(temp_name,"wb")
-        w2 = open(temp2_name,"wt")
-        db_cursor = c.execute(sqlstr)
-        rowsmiles=db_cursor.fetchmany(db_chunk_size)
-        while(len(rowsmiles)>0):
-            for row in rowsmiles: 
-                w.write(row[0])
-                w2.write(str(row[2])+"|"+str(row[1])+"\n")
-            rowsmiles=db_cursor.fetchmany(db_chunk_size)
-        w.close()
-        w2.close()
-
-        os.system(protocol["docking"]+" "+temp_name+" "+db+" "+temp2_name+" "+str(iteration))
-        # clean up if the confgen script did not already
-        conn.close()
-        try:
-            os.unlink(temp_name)
-        except:
-            pass
-        try:
-            os.unlink(temp2_name)
-        except:
-            pass
+    if runmode != "split-dock" and len(protocol["docking_cascade"])>0:
+        smilesids = run_cascade(protocol,db,smilesids,iteration,runmode)
+    elif len(protocol["docking_cascade"])>0:
+        print("NOTE: docking_cascade is not used in split-dock mode, all compounds are written for the final docking")
+    if runmode == "dock" or runmode == "simu-dock":
+        dock_stage(protocol,protocol["docking"],db,smilesids,iteration,runmode)
     elif runmode == "split-dock":
         cur_chunk = 1
+        conn=hasten_db.connect(db)
+        c = conn.cursor()
         sqlstr="SELECT smiles,smilesid,hastenid FROM data WHERE hastenid IN {}".format(str(tuple(smilesids))).replace("[","").replace("]","")
-        rowsmiles=c.execute(sqlstr).fetchall()
-        conn.close()
-        chunk = []
-        while len(rowsmiles) > 0:
-            chunk.append(rowsmiles.pop())
-            if len(chunk)>=protocol["dock_split"]:
-                if not os.path.exists("DOCK_"+str(iteration)+"_"+str(cur_chunk)):
-                    os.mkdir("DOCK_"+str(iteration)+"_"+str(cur_chunk))
-                chunk_filename = "DOCK_"+str(iteration)+"_"+str(cur_chunk)+"/iter"+str(iteration)+"_dock_input.smi"
-                w = open(chunk_filename,"wt")
-                for row in chunk:
-                    w.write(row[0]+" "+row[1]+"|"+str(row[2])+"\n")
-                w.close()
-                chunk = []
-                cur_chunk += 1
-        # make sure the end is there also
-        if len(chunk)>0:
+        rowsmiles=hasten_library.fill_text(db,c.execute(sqlstr).fetchall(),2,0,1)
+        if protocol["dock_split_balance"]=="cost":
+            chunks = hasten_dockcost.balance(rowsmiles,protocol["dock_split"])
+            costs = [cost for cost,chunk in chunks]
+            if len(costs)>0:
+                print("Estimated docking cost of the chunks:",round(min(costs)),"-",round(max(costs)))
+            chunks = [chunk for cost,chunk in chunks]
+        else:
+            rowsmiles.reverse()
+            chunks = [rowsmiles[start:start+protocol["dock_split"]] for start in range(0,len(rowsmiles),protocol["dock_split"])]
+        for chunk in chunks:
             if not os.path.exists("DOCK_"+str(iteration)+"_"+str(cur_chunk)):
                 os.mkdir("DOCK_"+str(iteration)+"_"+str(cur_chunk))
             chunk_filename = "DOCK_"+str(iteration)+"_"+str(cur_chunk)+"/iter"+str(iteration)+"_dock_input.smi"
@@ -291,20 +413,7 @@ def run_docking(protocol,db,smilesids,iteration,runmode="dock",cpu=1):
             for row in chunk:
                 w.write(row[0]+" "+row[1]+"|"+str(row[2])+"\n")
             w.close()
-    elif runmode=="simu-dock":
-        sqlstr="SELECT smiles,smilesid,hastenid FROM data WHERE hastenid IN {}".format(str(tuple(smilesids))).replace("[","").replace("]","")
-        rowsmiles=c.execute(sqlstr).fetchall()
-        conn.close()
-        temp2_name = tempfile.mkstemp(".txt","hasten_dock_ids_","/tmp")[1]
-        w2 = open(temp2_name,"wt")
-        for row in rowsmiles: 
-            w2.write(str(row[1])+"|"+str(row[2])+"\n")
-        w2.close()
-        os.system(protocol["docking"]+" "+temp2_name+" "+db+" "+temp2_name+" "+str(iteration))
-        try:
-            os.unlink(temp_name)
-        except:
-            pass
+            cur_chunk += 1
 
 def run_ml_train(protocol,db,iteration):
     """
@@ -315,18 +424,33 @@ def run_ml_train(protocol,db,iteration):
     :param db: The filename of SQlite3 database
     :param iteration: iteration integer
     """
-    try:
-        conn=sqlite3.connect(db)
-    except error:
-        print("Error while accessing database!")
-        sys.exit(1)
+    conn=hasten_db.connect(db)
+    if protocol["train_mode"]=="shards":
+        manifest_filename = write_training_shards(protocol,db,conn,iteration)
+        hasten_runner.StageRunner(protocol).run_sync("ml_train",protocol["ml_train"],[manifest_filename,"iter"+str(iteration)])
+        return
     if conn:
         c = conn.cursor()
-        sqlstr="SELECT smiles,hastenid,dock_score FROM data WHERE dock_score IS NOT NULL"
-        rowsmiles=c.execute(sqlstr).fetchall()
+        stats=hasten_status.get_stats(conn)
+        # the compounds dropped by the docking cascade are trained with
+        # their stage scores
+        docked=stats["docked"]+stats["dropped"]
+        print(stats["docked"],"compounds with docking result")
+        if stats["dropped"]>0:
+            print(stats["dropped"],"compounds dropped by the docking cascade")
+        if protocol["train_budget"]>0 and docked>protocol["train_budget"]:
+            hasten_memory.check(protocol["train_budget"]*compound_row_size(db,conn),"the training set","Use smaller train_budget in the protocol.")
+            rowsmiles=sample_training_set(conn,protocol)
+        else:
+            hasten_memory.check(docked*compound_row_size(db,conn),"the training set","Use train_budget or train_mode=shards in the protocol.")
+            sqlstr="SELECT smiles,hastenid,dock_score FROM data WHERE dock_score IS NOT NULL"
+            rowsmiles=c.execute(sqlstr).fetchall()
+            if stats["dropped"]>0:
+                rowsmiles.extend(stage_score_rows(conn))
+        rowsmiles=hasten_library.fill_text(db,rowsmiles,1,0)
         dataset_size=len(rowsmiles)
-        print(dataset_size,"compounds with docking result")
-        conn.close()
+        if protocol["train_budget"]>0 and dataset_size<docked:
+            print(dataset_size,"of them used for training (train_budget)")
         if protocol["train_mode"]=="scratch":
             print("Runninng in scratch mode")
             # calculate number of molecules into each set
@@ -353,46 +477,38 @@ def run_ml_train(protocol,db,iteration):
         else:
             print("Error, invalid train_mode in the protocol file:",protocol["train_mode"])
             sys.exit(1)
-    train_filename = write_for_ml(train_set)
-    valid_filename = write_for_ml(validation_set)
-    test_filename = write_for_ml(test_set)
-
-    os.system(protocol["ml_train"]+" "+train_filename+" "+valid_filename+" "+test_filename+" iter"+str(iteration))
+    with ml_input(train_set) as train, ml_input(validation_set) as valid, ml_input(test_set) as test:
+        hasten_runner.StageRunner(protocol).run_sync("ml_train",protocol["ml_train"],[train.name,valid.name,test.name,"iter"+str(iteration)])
 
-    os.unlink(train_filename)
-    os.unlink(valid_filename)
-    os.unlink(test_filename)
-
-def run_ml_pred(protocol,db,iteration,mode="normal"):
+def run_ml_pred(protocol,db,iteration,mode="normal",cpu=None):
     """
     Predict compounds either in automatic or hand-operated mode (see mode)
 
     :param protocol: Protocol dictionary
     :param db: The filename of SQlite3 database
     :param iteration: iteration integer
-    :param mode: string "split" means hand-operated split, "para" means prediction in hand-operated mode and default "normal" the automatic mode
+    :param mode: string "split" means hand-operated split, "ranges" hand-operated split to hastenid range manifests, "para" means prediction in hand-operated mode and default "normal" the automatic mode
+    :param cpu: in "para" mode, the number of predictions run in parallel (default: ml_pred_parallel)
     """
     if mode=="split":
-        conn=sqlite3.connect(db)
+        conn=hasten_db.connect(db)
         c = conn.cursor()
-        sqlstr="SELECT COUNT(*) FROM data WHERE dock_score IS NULL"
-        number_of_comps=int(c.execute(sqlstr).fetchall()[0][0])
-        sqlstr="SELECT smiles,hastenid FROM data WHERE dock_score IS NULL"
+        number_of_comps=hasten_status.get_stats(conn)["undocked"]
         per_machine = int(number_of_comps/protocol["pred_split"])
         cur_machine=1
         cur_machine_count=0
         cur_chunk = 1
         # only predict those that we don't have docking_score yet
-        sqlstr="SELECT smiles,hastenid FROM data WHERE dock_score IS NULL"
-        db_batch_size = 4000000
+        sqlstr="SELECT data.smiles,data.hastenid FROM "+hasten_dedup.PRED_SOURCE+" WHERE "+hasten_dedup.PRED_FILTER
+        pred_size = pred_chunk_size(protocol,db,conn,1)
         db_cursor = c.execute(sqlstr)
-        rowsmiles = db_cursor.fetchmany(db_batch_size)
         chunk = []
-        while len(rowsmiles) > 0:
+        for rowsmiles in hasten_memory.fetch_chunks(db_cursor,4000000,what="prediction split"):
+            rowsmiles = hasten_library.fill_text(db,rowsmiles,1,0)
             while len(rowsmiles) > 0:
                 chunk.append(rowsmiles.pop())
                 cur_machine_count += 1
-                if len(chunk)>=protocol["pred_size"] or cur_machine_count>=per_machine:
+                if len(chunk)>=pred_size or cur_machine_count>=per_machine:
                     if not os.path.exists("PRED"+str(cur_machine)):
                         os.mkdir("PRED"+str(cur_machine))
                     chunk_filename = write_for_ml(chunk,with_score=False,filename="PRED"+str(cur_machine)+"/iter"+str(iteration)+"_pred_input_"+str(cur_machine)+"_"+str(cur_chunk)+".csv")
@@ -405,67 +521,193 @@ def run_ml_pred(protocol,db,iteration,mode="normal"):
                         cur_chunk = 1
                         if len(rowsmiles)>0 and not os.path.exists("PRED"+str(cur_machine)):
                             os.mkdir("PRED"+str(cur_machine))
-            rowsmiles = db_cursor.fetchmany(db_batch_size)
-        conn.close()
         # write leftover compounds in the last chunk
         if len(chunk)>0:
             chunk_filename = write_for_ml(chunk,with_score=False,filename="PRED"+str(cur_machine)+"/iter"+str(iteration)+"_pred_input_"+str(cur_machine)+"_"+str(cur_chunk+1)+".csv")
+    elif mode=="ranges":
+        write_pred_manifests(protocol,db,iteration)
     elif mode=="para":
-        for filename in glob.glob("iter*_pred_input_*.csv"):
-            print("Predicting:",filename)
-            pred_chunk(protocol,None,None,iteration,filename)
+        runner = hasten_runner.StageRunner(protocol)
+        if cpu is not None:
+            runner.limits["ml_pred"] = cpu
+        def chunks():
+            for filename in glob.glob("iter*_pred_input_*.csv"):
+                print("Predicting:",filename)
+                yield pred_chunk(runner,protocol,None,None,iteration,filename)
+            for manifest_name in glob.glob("iter*_pred_manifest.json"):
+                yield from manifest_chunks(runner,protocol,db,manifest_name)
+        runner.execute(runner.run_bounded(chunks(),runner.limits["ml_pred"]))
     elif mode=="normal":
-        conn=sqlite3.connect(db)
+        conn=hasten_db.connect(db)
+        # predictions of the previous iteration are outdated
+        hasten_leaderboard.reset_leaderboard(conn,"pred")
+        hasten_status.reset_predictions(conn,iteration)
+        conn.commit()
         c = conn.cursor()
-        sqlstr="SELECT smiles,hastenid FROM data WHERE dock_score IS NULL"
-        # we need to get all molecules at once due to sqlite3 locking
-        db_batch_size = protocol["pred_size"]
-        db_cursor = c.execute(sqlstr)
-        rowsmiles = db_cursor.fetchall()
-        conn.close()
-        # calculate each chunk at the time
-        print(len(rowsmiles),"compounds to predict")
-        chunk=[]
-        while len(rowsmiles) >0:
-            chunk.append(rowsmiles.pop())
-            if len(chunk)>=protocol["pred_size"]:
-                print(len(rowsmiles),"compounds to be ranked by the ML model")
-                pred_chunk(protocol,db,chunk,iteration)
-                chunk = []
-        if len(chunk)>0:
-                pred_chunk(protocol,db,chunk,iteration)
+        store = create_pred_store(protocol,db,conn,iteration)
+        # read one chunk at a time by hastenid ranges, each read is a short
+        # WAL snapshot so the predictions can be written meanwhile
+        sqlstr="SELECT data.smiles,data.hastenid FROM "+hasten_dedup.PRED_SOURCE+" WHERE "+hasten_dedup.PRED_FILTER+" AND data.hastenid > ? ORDER BY data.hastenid LIMIT ?"
+        runner = hasten_runner.StageRunner(protocol)
+        pred_size = pred_chunk_size(protocol,db,conn,runner.limits["ml_pred"])
+        # calculate each chunk at the time (ml_pred_parallel of them at once)
+        def chunks():
+            sent = 0
+            chunk = hasten_library.fill_text(db,c.execute(sqlstr,[0,pred_size]).fetchall(),1,0)
+            while len(chunk)>0:
+                sent += len(chunk)
+                print(sent,"compounds sent to be ranked by the ML model")
+                yield pred_chunk(runner,protocol,db,chunk,iteration,store=store)
+                chunk = hasten_library.fill_text(db,c.execute(sqlstr,[chunk[-1][1],pred_size]).fetchall(),1,0)
+        runner.execute(runner.run_bounded(chunks(),runner.limits["ml_pred"]))
     else:
         print("BUG IN ml_chemprop_pred(): invalid mode!")
         sys.exit(2)
         
-def pred_chunk(protocol,db,chunk,iteration,filename=None):
+def write_pred_manifests(protocol,db,iteration):
+    """
+    Split the undocked compounds to pred_split machines as hastenid ranges
+    with about the same number of undocked compounds. Only a small manifest
+    is written to each PRED directory, the machines read their compounds
+    from a (read-only) copy of the database in "pred" mode.
+
+    :param protocol: Protocol dictionary
+    :param db: The filename of SQlite3 database
+    :param iteration: iteration integer
+    """
+    conn=hasten_db.connect(db)
+    stats = hasten_status.get_stats(conn)
+    last = conn.execute("SELECT MAX(_ROWID_) FROM data LIMIT 1").fetchone()[0]
+    if last!=stats["total"]:
+        print("NOTE: hastenids are not continuous, the ranges are balanced only roughly")
+    machines = protocol["pred_split"]
+    per_machine = stats["undocked"]/machines
+    # hastenids are 1...last, so the undocked compounds up to hastenid b
+    # are b minus docked ones up to b. One pass over the docked hastenids
+    # (read from the partial index) finds the boundaries.
+    docked = conn.execute("SELECT hastenid FROM data INDEXED BY data_docked WHERE dock_score IS NOT NULL ORDER BY hastenid")
+    docked_so_far = 0
+    next_docked = docked.fetchone()
+    first = 1
+    for machine in range(1,machines+1):
+        if machine==machines:
+            boundary = last
+        else:
+            boundary = int(round(machine*per_machine))+docked_so_far
+            while next_docked is not None and next_docked[0]<=boundary:
+                docked_so_far += 1
+                boundary += 1
+                next_docked = docked.fetchone()
+        pred_dir = "PRED"+str(machine)
+        if not os.path.exists(pred_dir):
+            os.mkdir(pred_dir)
+        manifest_name = os.path.join(pred_dir,"iter"+str(iteration)+"_pred_manifest.json")
+        with open(manifest_name,"wt") as w:
+            json.dump({"iteration":iteration,"machine":machine,"first":first,"last":boundary},w)
+        print("Wrote",manifest_name,"hastenids",first,"-",boundary)
+        first = boundary+1
+    docked.close()
+
+def manifest_chunks(runner,protocol,db,manifest_name):
+    """
+    Predict the compounds of a range manifest in pred_size chunks. The
+    compounds are read from the database, which can be a read-only copy.
+
+    :param runner: hasten_runner.StageRunner
+    :param protocol: Protocol dictionary
+    :param db: The filename of SQlite3 database
+    :param manifest_name: manifest written by write_pred_manifests()
+    :return: generator of prediction coroutines
+    """
+    with open(manifest_name,"rt") as manifest_file:
+        manifest = json.load(manifest_file)
+    iteration = manifest["iteration"]
+    print("Predicting hastenids",manifest["first"],"-",manifest["last"],"of",manifest_name)
+    conn = hasten_db.connect(db,readonly=True)
+    sqlstr = "SELECT data.smiles,data.hastenid FROM "+hasten_dedup.PRED_SOURCE+" WHERE "+hasten_dedup.PRED_FILTER+" AND data.hastenid > ? AND data.hastenid <= ? ORDER BY data.hastenid LIMIT ?"
+    chunk_number = 1
+    pred_size = pred_chunk_size(protocol,db,conn,runner.limits["ml_pred"])
+    rows = hasten_library.fill_text(db,conn.execute(sqlstr,[manifest["first"]-1,manifest["last"],pred_size]).fetchall(),1,0)
+    while len(rows)>0:
+        filename = "iter"+str(iteration)+"_pred_input_"+str(manifest["machine"])+"_"+str(chunk_number)+".csv"
+        # outputs of an interrupted run are kept
+        if not os.path.exists(filename.replace("_input_","_output_")):
+            write_for_ml(rows,with_score=False,filename=filename)
+            yield predict_and_remove(runner,protocol,iteration,filename)
+        chunk_number += 1
+        rows = hasten_library.fill_text(db,conn.execute(sqlstr,[rows[-1][1],manifest["last"],pred_size]).fetchall(),1,0)
+
+def pred_chunk_size(protocol,db,conn,parallel):
+    """
+    Number of compounds in a prediction chunk: pred_size, or less if the
+    chunks predicted at the same time do not fit to the memory budget
+
+    :param protocol: Protocol dictionary
+    :param db: The filename of SQlite3 database
+    :param conn: SQLite3 connection
+    :param parallel: number of chunks in memory at the same time
+    :return: chunk size
+    """
+    pred_size = hasten_memory.rows_for(compound_row_size(db,conn),protocol["pred_size"],hasten_memory.SHARE/parallel,minimum=min(1000,protocol["pred_size"]),what="prediction chunks")
+    if pred_size<protocol["pred_size"]:
+        print("Prediction chunks of",pred_size,"compounds to fit the memory budget")
+    return pred_size
+
+def compound_row_size(db,conn):
+    """
+    :param db: The filename of SQlite3 database
+    :param conn: SQLite3 connection
+    :return: memory taken by a (smiles,smilesid,hastenid) row in bytes, measured from a sample
+    """
+    sample = conn.execute("SELECT smiles,smilesid,hastenid FROM data LIMIT 100").fetchall()
+    return hasten_memory.row_size(hasten_library.fill_text(db,sample,2,0,1))
+
+async def predict_and_remove(runner,protocol,iteration,filename):
+    """
+    Predict a chunk written from a manifest and remove the input file
+
+    :param runner: hasten_runner.StageRunner
+    :param protocol: Protocol dictionary
+    :param iteration: iteration integer
+    :param filename: input filename
+    """
+    await pred_chunk(runner,protocol,None,None,iteration,filename)
+    os.unlink(filename)
+
+async def pred_chunk(runner,protocol,db,chunk,iteration,filename=None,store=None):
     """
     Predict a chunk of molecules
 
+    :param runner: hasten_runner.StageRunner
     :param protocol: Protocol dictionary
     :param db: The filename of SQlite3 database
     :param chunk: List of hastenids to be predicted
     :param iteration: iteration integer
     :param filename: automatic mode is None, hand-operated mode has the filename
+    :param store: hasten_predstore.PredictionStore or None to store to database
     """
-    if filename is None:
-        chunk_filename = write_for_ml(chunk,with_score=False)
-        chunk_output = tempfile.mkstemp(".csv","hasten","/tmp")[1]
-    else:
-        chunk_filename = filename
-        chunk_output = filename.replace("_input_","_output_")
-    os.system(protocol["ml_pred"]+" "+chunk_filename+" iter"+str(iteration)+" "+chunk_output)
-    if filename is None:
-        write_pred_to_db(db,chunk_output)
-        os.unlink(chunk_filename)
-        os.unlink(chunk_output)
+    if filename is not None:
+        await runner.run("ml_pred",protocol["ml_pred"],[filename,"iter"+str(iteration),filename.replace("_input_","_output_")])
+        return
+    chunk_output = hasten_scratch.mkstemp(".csv")
+    try:
+        with ml_input(chunk,with_score=False) as chunk_input:
+            await runner.run("ml_pred",protocol["ml_pred"],[chunk_input.name,"iter"+str(iteration),chunk_output])
+        # one writer at a time, without blocking the other predictions
+        async with runner.semaphore("db_write"):
+            await asyncio.to_thread(write_pred_to_db,db,chunk_output,protocol["leaderboard_size"],store,iteration)
+    finally:
+        hasten_scratch.remove(chunk_output)
 
-def write_pred_to_db(db,filename):
+def write_pred_to_db(db,filename,leaderboard_size,store=None,iteration=None):
     """
     Write predictions to db from a ML output file
 
     :param db: The filename of SQlite3 database
     :param filename: The filename of the ML output file
+    :param leaderboard_size: Size of the prediction leaderboard
+    :param store: hasten_predstore.PredictionStore, scores go there instead of data table
+    :param iteration: iteration integer (needed with store)
     """
     pred_scores = []
     with open(filename) as outputfile:
@@ -473,34 +715,189 @@ def write_pred_to_db(db,filename):
         csvreader = csv.reader(outputfile,delimiter=",")
         next(csvreader)
         for row in csvreader:
-            pred_scores.append((float(row[2]),row[1]))
-    try:
-        conn=sqlite3.connect(db)
-    except:
-        print("Error while accesing database")
-        sys.exit(1)
-    finally:
-        if conn:
-            c=conn.cursor()
-            c.executemany("UPDATE data SET pred_score = ? WHERE hastenid = ?",pred_scores)
-            conn.commit()
-            conn.close()
+            # optional fourth column is the spread of an ensemble prediction
+            pred_scores.append((float(row[2]),float(row[3]) if len(row)>3 and len(row[3])>0 else None,row[1]))
+    # only one compound of each group of identical SMILES was predicted
+    pred_scores = hasten_dedup.fan_out_predictions(hasten_db.connect(db,readonly=True),pred_scores)
+    if store is not None:
+        store.write(iteration,[int(hastenid) for score,std,hastenid in pred_scores],[score for score,std,hastenid in pred_scores],[std for score,std,hastenid in pred_scores])
+    hasten_ingest.write_predictions(db,pred_scores,leaderboard_size,update_scores=store is None)
+
+def get_pred_store(protocol,db):
+    """
+    Get the prediction store of the database if pred_store=mmap is used
+
+    :param protocol: Protocol dictionary
+    :param db: The filename of SQlite3 database
+    :return: hasten_predstore.PredictionStore or None
+    """
+    if protocol["pred_store"]!="mmap":
+        return None
+    # numpy is needed only with the prediction store
+    import hasten_predstore
+    # scores, keys and argpartition indices of a block, about 24 bytes each
+    return hasten_predstore.PredictionStore(db,protocol["pred_store_dtype"],hasten_memory.rows_for(24,1<<24,what="prediction store blocks"))
+
+def create_pred_store(protocol,db,conn,iteration):
+    """
+    Create empty prediction arrays for an iteration if pred_store=mmap is used
+
+    :param protocol: Protocol dictionary
+    :param db: The filename of SQlite3 database
+    :param conn: SQLite3 connection
+    :param iteration: iteration integer
+    :return: hasten_predstore.PredictionStore or None
+    """
+    store = get_pred_store(protocol,db)
+    if store is not None:
+        store.create_iteration(iteration,conn.execute("SELECT MAX(_ROWID_) FROM data LIMIT 1").fetchone()[0])
+    return store
+
+def stage_score_rows(conn,dock_iteration=False):
+    """
+    Training rows of the compounds dropped by the docking cascade: they
+    have no docking score, so the score of the latest stage they were
+    docked in is used. The number of compounds per stage is printed.
+
+    :param conn: SQLite3 connection
+    :param dock_iteration: only the compounds dropped in this iteration (None: imported, False: all)
+    :return: list of (smiles,hastenid,stage score) rows
+    """
+    sqlstr = "SELECT data.smiles,data.hastenid,s.score,s.stage FROM stage_scores s INNER JOIN data ON data.hastenid=s.hastenid WHERE data.dataset_status=? AND data.dock_score IS NULL AND s.stage=(SELECT MAX(stage) FROM stage_scores WHERE hastenid=s.hastenid)"
+    args = [hasten_ingest.CASCADE_DROPPED,]
+    if dock_iteration is not False:
+        sqlstr += " AND s.iteration IS ?"
+        args.append(dock_iteration)
+    rows = conn.execute(sqlstr,args).fetchall()
+    stages = {}
+    for row in rows:
+        stages[row[3]] = stages.get(row[3],0)+1
+    for stage in sorted(stages):
+        print(stages[stage],"compounds dropped by the docking cascade trained with score of stage",stage)
+    return [row[:3] for row in rows]
+
+def write_training_shards(protocol,db,conn,iteration):
+    """
+    Keep the training data as append-only shards in "<database>.train", one
+    shard (train, validation and test file) per docking iteration. Only
+    the shards of iterations whose docking results changed since they
+    were written are exported, usually just the newest one. Each compound
+    stays in the same set between the iterations. The compounds dropped by
+    the docking cascade go to the shard of the iteration of their latest
+    stage score.
+
+    :param protocol: Protocol dictionary
+    :param db: The filename of SQlite3 database
+    :param conn: SQLite3 connection
+    :param iteration: iteration integer
+    :return: filename of the manifest listing the shard files
+    """
+    cache_dir = db+".train"
+    os.makedirs(cache_dir,exist_ok=True)
+    index_filename = os.path.join(cache_dir,"shards.json")
+    shards = {}
+    if os.path.exists(index_filename):
+        with open(index_filename,"rt") as index_file:
+            shards = json.load(index_file)
+    manifest = {"iteration":iteration,"train":[],"valid":[],"test":[],"compounds":0}
+    iteration_stats = dict((dock_iteration,[docked,best,0]) for dock_iteration,docked,best in hasten_status.get_iteration_stats(conn))
+    sqlstr = "SELECT IFNULL(s.iteration,-1),COUNT(*) FROM stage_scores s INNER JOIN data ON data.hastenid=s.hastenid WHERE data.dataset_status=? AND data.dock_score IS NULL AND s.stage=(SELECT MAX(stage) FROM stage_scores WHERE hastenid=s.hastenid) GROUP BY IFNULL(s.iteration,-1)"
+    for dock_iteration,dropped in conn.execute(sqlstr,[hasten_ingest.CASCADE_DROPPED,]):
+        iteration_stats.setdefault(dock_iteration,[0,None,0])[2] = dropped
+    for dock_iteration,(docked,best,dropped) in sorted(iteration_stats.items()):
+        if docked+dropped==0:
+            continue
+        # iteration -1 holds the imported docking scores
+        name = "iter"+str(dock_iteration) if dock_iteration>=0 else "imported"
+        filenames = dict((split,os.path.join(cache_dir,name+"_"+split+".csv")) for split in ["train","valid","test"])
+        if shards.get(name)!=[docked,best,dropped] or not all(os.path.exists(filename) for filename in filenames.values()):
+            hasten_memory.check((docked+dropped)*compound_row_size(db,conn),"the training data shard "+name)
+            rows = conn.execute("SELECT smiles,hastenid,dock_score FROM data WHERE dock_score IS NOT NULL AND dock_iteration IS ?",[None if dock_iteration<0 else dock_iteration,]).fetchall()
+            if dropped>0:
+                rows.extend(stage_score_rows(conn,None if dock_iteration<0 else dock_iteration))
+            split_rows = {"train":[],"valid":[],"test":[]}
+            for row in hasten_library.fill_text(db,rows,1,0):
+                # multiplicative hash of hastenid spreads the compounds evenly
+                # and puts a compound always to the same set
+                position = ((row[1]*2654435761)&0xffffffff)/4294967296.0
+                if position<protocol["dataset_split"][0]:
+                    split_rows["train"].append(row)
+                elif position<protocol["dataset_split"][0]+protocol["dataset_split"][1]:
+                    split_rows["valid"].append(row)
+                else:
+                    split_rows["test"].append(row)
+            for split,filename in filenames.items():
+                write_for_ml(split_rows[split],filename=filename)
+            print("Wrote training data shard",name,"(",len(rows),"compounds)")
+            shards[name] = [docked,best,dropped]
+            with open(index_filename,"wt") as index_file:
+                json.dump(shards,index_file)
+        for split,filename in filenames.items():
+            manifest[split].append(os.path.abspath(filename))
+        manifest["compounds"] += docked+dropped
+    print(manifest["compounds"],"compounds with docking or cascade stage result in",len(manifest["train"]),"shards")
+    manifest_filename = os.path.join(cache_dir,"iter"+str(iteration)+"_manifest.json")
+    with open(manifest_filename,"wt") as manifest_file:
+        json.dump(manifest,manifest_file,indent=1)
+    return os.path.abspath(manifest_filename)
+
+def sample_training_set(conn,protocol,bin_width=0.1,chunk_size=900):
+    """
+    Cap the training set to train_budget compounds. The best docked
+    compounds (train_top_fraction of the budget, from the dock leaderboard)
+    are all kept, the rest are sampled systematically from score bins in
+    proportion to the size of the bin, so that the shape of the score
+    distribution is kept. The docked compounds are streamed twice, only the
+    picked ones are kept in memory. The compounds dropped by the docking
+    cascade are sampled with the score of their latest stage.
+
+    :param conn: SQLite3 connection
+    :param protocol: Protocol dictionary
+    :param bin_width: width of the score bins
+    :param chunk_size: number of hastenids looked up at a time
+    :return: list of (smiles,hastenid,score) rows
+    """
+    budget = protocol["train_budget"]
+    top_size = int(budget*protocol["train_top_fraction"])
+    picked = set(row[0] for row in conn.execute("SELECT hastenid FROM leaderboard WHERE kind='dock' ORDER BY score LIMIT ?",[top_size,]))
+    if len(picked)<top_size:
+        print("NOTE: the dock leaderboard keeps only",len(picked),"compounds (leaderboard_size in protocol)")
+    sqlstr = "SELECT hastenid,dock_score FROM data INDEXED BY data_docked WHERE dock_score IS NOT NULL"
+    sqlstr += " UNION ALL SELECT s.hastenid,s.score FROM stage_scores s INNER JOIN data ON data.hastenid=s.hastenid WHERE data.dataset_status="+str(hasten_ingest.CASCADE_DROPPED)+" AND data.dock_score IS NULL AND s.stage=(SELECT MAX(stage) FROM stage_scores WHERE hastenid=s.hastenid)"
+    counts = {}
+    for hastenid,score in conn.execute(sqlstr):
+        if hastenid not in picked:
+            score_bin = math.floor(score/bin_width)
+            counts[score_bin] = counts.get(score_bin,0)+1
+    # the same fraction of each bin, every (1/step)th compound starting
+    # from a random one
+    step = (budget-len(picked))/max(1,sum(counts.values()))
+    phases = dict((score_bin,random.random()) for score_bin in counts)
+    top = len(picked)
+    for hastenid,score in conn.execute(sqlstr):
+        if hastenid not in picked:
+            score_bin = math.floor(score/bin_width)
+            phases[score_bin] += step
+            if phases[score_bin]>=1.0:
+                phases[score_bin] -= 1.0
+                picked.add(hastenid)
+    print("Training set budget:",top,"best compounds and",len(picked)-top,"sampled from",len(counts),"score bins")
+    hastenids = sorted(picked)
+    rows = []
+    for start in range(0,len(hastenids),chunk_size):
+        chunk = hastenids[start:start+chunk_size]
+        rows.extend(conn.execute("SELECT smiles,hastenid,IFNULL(dock_score,(SELECT score FROM stage_scores WHERE hastenid=data.hastenid ORDER BY stage DESC LIMIT 1)) FROM data WHERE hastenid IN ("+",".join(["?"]*len(chunk))+")",chunk).fetchall())
+    return rows
 
 # with_score = do we have score or not
-def write_for_ml(rows,with_score=True,filename=None):
+def write_ml_rows(w,rows,with_score=True):
     """
-    Write data for ml training
+    Write data for ml to an open file
 
+    :param w: open file
     :param rows: The data rows to be written
     :param with_score: Write data with score (usually True)
-    :param filename: If None, write into temporary file
-    :return: Filename for the temporary file
     """
-    if filename is None:
-        temp_name = tempfile.mkstemp(".smi","hasten","/tmp")[1]
-    else:
-        temp_name = filename
-    w = open(temp_name,"wt")
     if with_score:
         w.write("smiles,hastenid,docking_score\n")
     else:
@@ -510,22 +907,54 @@ def write_for_ml(rows,with_score=True,filename=None):
             w.write(row[0]+","+str(row[1])+","+str(row[2])+"\n")
         else:
             w.write(row[0]+","+str(row[1])+"\n")
+
+def write_for_ml(rows,with_score=True,filename=None):
+    """
+    Write data for ml training
+
+    :param rows: The data rows to be written
+    :param with_score: Write data with score (usually True)
+    :param filename: If None, write into temporary file
+    :return: Filename for the temporary file
+    """
+    if filename is None:
+        temp_name = hasten_scratch.mkstemp(".smi")
+    else:
+        temp_name = filename
+    w = open(temp_name,"wt")
+    write_ml_rows(w,rows,with_score)
     w.close()
     return temp_name
 
-def run_ml_import(protocol,db):
+def ml_input(rows,with_score=True):
+    """
+    Input of a ML script as scratch file or named pipe (see hasten_scratch)
+
+    :param rows: The data rows to be written
+    :param with_score: Write data with score (usually True)
+    :return: hasten_scratch.Input
+    """
+    return hasten_scratch.Input(".csv","hasten",lambda w: write_ml_rows(w,rows,with_score))
+
+def run_ml_import(protocol,db,iteration):
     """
     Import bunch of files in hand-operated mode from ML predictions
 
     :param protocol: Protocol dictionary
     :param db: The database filename
+    :param iteration: iteration integer
     """
 
-    conn=sqlite3.connect(db)
+    conn=hasten_db.connect(db)
     if conn:
+        # predictions of the previous iteration are outdated
+        hasten_leaderboard.reset_leaderboard(conn,"pred")
+        hasten_status.reset_predictions(conn,iteration)
+        conn.commit()
+        store = create_pred_store(protocol,db,conn,iteration)
         for filename in glob.glob("iter*_output_*.csv"):
             print("Importing predictions from",filename)
-            write_pred_to_db(db,filename)
+            write_pred_to_db(db,filename,protocol["leaderboard_size"],store,iteration)
 
 def run_hasten(protocol,args):
     """
@@ -534,7 +963,18 @@ def run_hasten(protocol,args):
     :param protocol: Protocol dictionary
     :param args: Parsed arguments
     """
+    # only "pred" of CSV files from split-pred runs without the database
+    if args.database is None:
+        if args.hand_operate!="pred":
+            print("HASTEN database (-m) is needed")
+            sys.exit(1)
+        if len(glob.glob("iter*_pred_manifest.json"))>0:
+            print("Predicting range manifests (split-pred-ranges) needs a copy of the HASTEN database (-m)")
+            sys.exit(1)
     random.seed(protocol["random_seed"])
+    hasten_memory.configure(protocol,args.max_memory)
+    hasten_db.configure(protocol)
+    hasten_scratch.configure(protocol,args.scratch_dir)
     if args.iteration is not None:
         iteration = args.iteration
     else:
@@ -555,12 +995,15 @@ def run_hasten(protocol,args):
         elif args.hand_operate == "split-pred":
             print("Splitting for machine learning predictions...")
             run_ml_pred(protocol,args.database,iteration,mode="split")
+        elif args.hand_operate == "split-pred-ranges":
+            print("Splitting hastenid ranges for machine learning predictions...")
+            run_ml_pred(protocol,args.database,iteration,mode="ranges")
         elif args.hand_operate == "pred":
             print("Running machine learning predictions...")
-            run_ml_pred(protocol,args.database,iteration,mode="para")
+            run_ml_pred(protocol,args.database,iteration,mode="para",cpu=args.cpu)
         elif args.hand_operate == "import-pred":
             print("Importing machine learning predictions...")
-            run_ml_import(protocol,args.database)
+            run_ml_import(protocol,args.database,iteration)
         elif args.hand_operate == "simu-dock":
             print("Simulated hand-operated docking mode...")
             compounds_for_docking,compounds_for_confgen = pick_compounds_for_docking(protocol,args.database,iteration,skip_confgen=True)
@@ -582,7 +1025,7 @@ def run_hasten(protocol,args):
                 run_confgen(protocol,args.database,compounds_for_confgen)
                 print("Running docking...")
                 run_docking(protocol,args.database,compounds_for_docking,iteration)
-
+    
                 iteration+=1
 
     print("\nHASTEN finished.")
@@ -606,5 +1049,6 @@ if __name__ == "__main__":
     print("")
     args = parse_cmd_line()
     if (not files_exist(args)): sys.exit(1)
+    if args.target is not None: args.database = hasten_target.get_target_db(args.database,args.target)
     protocol=get_protocol(args.protocol)
     run_hasten(protocol,args)
@@ -0,0 +1,259 @@
+# 
+# Copyright (c) 2021 Orion Corporation
+# 
+# Redistribution and use in source and binary forms, with or without 
+# modification, are permitted provided that the following conditions are met:
+# 
+# 1. Redistributions of source code must retain the above copyright notice, 
+# this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice, 
+# this list of conditions and the following disclaimer in the documentation 
+# and/or other materials provided with the distribution.
+# 3. Neither the name of the copyright holder nor the names of its contributors
+# may be used to endorse or promote products derived from this software 
+# without specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" 
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE 
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE 
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE 
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR 
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF 
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS 
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN 
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) 
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE 
+# POSSIBILITY OF SUCH DAMAGE.
+# 
+"""
+HASTEN acquisition strategies
+
+Pick the compounds for docking after the first iteration. The strategy is
+selected with "acquisition" in the protocol:
+
+greedy   -- the best predicted scores (default)
+ucb      -- optimistic score pred_score - acquisition_beta * pred_std
+thompson -- one random draw from N(pred_score, pred_std) for each compound
+diverse  -- greedy, but at most diversity_bucket_size compounds from each
+            bucket of similar SMILES
+random   -- random undocked compounds (always used in the first iteration)
+
+Own strategies can be given as "module:function", the function is called
+as function(conn,protocol,number_to_dock) and returns list of hastenids.
+Compounds dropped by a docking cascade stage (dataset_status set) are not
+picked again.
+"""
+import sys
+import random
+import importlib
+import zlib
+
+import hasten_db
+import hasten_library
+
+def pick_greedy(conn,protocol,number_to_dock):
+    """
+    Pick the best predicted compounds
+
+    :param conn: SQLite3 connection
+    :param protocol: Protocol dictionary
+    :param number_to_dock: number of compounds to pick
+    :return: list of hastenids
+    """
+    to_dock=conn.execute("SELECT hastenid FROM data WHERE dock_score IS NULL AND dataset_status IS NULL ORDER BY pred_score LIMIT ?",[number_to_dock,]).fetchall()
+    return [row[0] for row in to_dock]
+
+def warn_without_std(strategy,stds):
+    """
+    Warn if the picked compounds have no spread of prediction: the
+    strategy then picks the same compounds as greedy
+
+    :param strategy: name of the strategy
+    :param stds: pred_std values of the picked compounds
+    """
+    if len(stds)>0 and all(std is None or std!=std for std in stds):
+        print("WARNING: predictions have no pred_std,",strategy,"picks the same compounds as greedy.")
+        print("The ML prediction script must write the spread of an ensemble as the fourth column (see ml_chemprop_pred_ensemble.sh).")
+
+def pick_ucb(conn,protocol,number_to_dock):
+    """
+    Pick by lower confidence bound of the predicted score (smaller is
+    better, so this is the optimistic end)
+
+    :param conn: SQLite3 connection
+    :param protocol: Protocol dictionary
+    :param number_to_dock: number of compounds to pick
+    :return: list of hastenids
+    """
+    to_dock=conn.execute("SELECT hastenid,pred_std FROM data WHERE dock_score IS NULL AND dataset_status IS NULL ORDER BY pred_score-?*IFNULL(pred_std,0.0) LIMIT ?",[protocol["acquisition_beta"],number_to_dock]).fetchall()
+    warn_without_std("ucb",[row[1] for row in to_dock])
+    return [row[0] for row in to_dock]
+
+def pick_thompson(conn,protocol,number_to_dock):
+    """
+    Pick by one sample from the predictive distribution of each compound.
+    SQLite keeps only the best number_to_dock samples while scanning.
+
+    :param conn: SQLite3 connection
+    :param protocol: Protocol dictionary
+    :param number_to_dock: number of compounds to pick
+    :return: list of hastenids
+    """
+    # random is seeded with random_seed of the protocol in run_hasten
+    def sample(score,std):
+        if score is None:
+            return None
+        if std is None or std<=0.0:
+            return score
+        return random.gauss(score,std)
+    conn.create_function("hasten_sample",2,sample)
+    to_dock=conn.execute("SELECT hastenid,pred_std FROM data WHERE dock_score IS NULL AND dataset_status IS NULL ORDER BY hasten_sample(pred_score,pred_std) LIMIT ?",[number_to_dock,]).fetchall()
+    warn_without_std("thompson",[row[1] for row in to_dock])
+    return [row[0] for row in to_dock]
+
+def pick_random(conn,protocol,number_to_dock,chunk_size=900,min_acceptance=0.01):
+    """
+    Pick random undocked compounds (used in the first iteration). Random
+    hastenids are drawn from the hastenid range and the missing or docked
+    ones are rejected, so nothing is sorted. If most of the range is
+    rejected, falls back to drawing positions among the undocked compounds
+    (one pass in hastenid order). Both use the random module, which is
+    seeded with random_seed.
+
+    :param conn: SQLite3 connection
+    :param protocol: Protocol dictionary
+    :param number_to_dock: number of compounds to pick
+    :param chunk_size: number of hastenids checked at a time
+    :param min_acceptance: smallest accepted fraction of the draws before the fallback
+    :return: list of hastenids
+    """
+    first,last = conn.execute("SELECT MIN(hastenid),MAX(hastenid) FROM data").fetchone()
+    if first is None:
+        return []
+    to_dock = []
+    picked = set()
+    drawn = 0
+    acceptance = 1.0
+    # random is seeded with random_seed of the protocol in run_hasten
+    while len(to_dock)<number_to_dock:
+        wanted = number_to_dock-len(to_dock)
+        candidates = []
+        for i in range(min(last-first+1,int(wanted/acceptance*1.1)+10)):
+            hastenid = random.randint(first,last)
+            if hastenid not in picked:
+                picked.add(hastenid)
+                candidates.append(hastenid)
+        drawn += len(candidates)
+        for start in range(0,len(candidates),chunk_size):
+            chunk = candidates[start:start+chunk_size]
+            undocked = set(row[0] for row in conn.execute("SELECT hastenid FROM data WHERE dock_score IS NULL AND dataset_status IS NULL AND hastenid IN ("+",".join(["?"]*len(chunk))+")",chunk))
+            to_dock.extend(hastenid for hastenid in chunk if hastenid in undocked)
+        acceptance = len(to_dock)/drawn
+        if acceptance<min_acceptance or len(picked)>=(last-first+1)/2:
+            # nearly everything docked (or a tiny database)
+            return pick_positions(conn,number_to_dock)
+    return to_dock[:number_to_dock]
+
+def pick_positions(conn,number_to_dock,chunk_size=100000):
+    """
+    Pick random undocked compounds by drawing their positions in hastenid
+    order and reading the undocked hastenids once
+
+    :param conn: SQLite3 connection
+    :param number_to_dock: number of compounds to pick
+    :param chunk_size: number of rows fetched at a time
+    :return: list of hastenids in random order
+    """
+    sqlstr = "FROM data WHERE dock_score IS NULL AND dataset_status IS NULL"
+    undocked = conn.execute("SELECT COUNT(*) "+sqlstr).fetchone()[0]
+    positions = sorted(random.sample(range(undocked),min(number_to_dock,undocked)))
+    to_dock = []
+    cur = conn.execute("SELECT hastenid "+sqlstr+" ORDER BY hastenid")
+    position = 0
+    rows = cur.fetchmany(chunk_size)
+    while len(rows)>0 and len(to_dock)<len(positions):
+        while len(to_dock)<len(positions) and positions[len(to_dock)]<position+len(rows):
+            to_dock.append(rows[positions[len(to_dock)]-position][0])
+        position += len(rows)
+        rows = cur.fetchmany(chunk_size)
+    cur.close()
+    random.shuffle(to_dock)
+    return to_dock
+
+def smiles_bucket(smiles,shingle=4,hashes=2):
+    """
+    Bucket of similar SMILES: min-hashes of the character shingles. Two
+    SMILES end up in the same bucket with probability of roughly their
+    shingle Jaccard similarity to the power of hashes.
+
+    :param smiles: SMILES string
+    :param shingle: shingle length
+    :param hashes: number of min-hashes combined
+    :return: bucket as tuple of integers
+    """
+    shingles = [smiles[i:i+shingle].encode() for i in range(max(1,len(smiles)-shingle+1))]
+    return tuple(min(zlib.crc32(s,seed) for s in shingles) for seed in range(1,hashes+1))
+
+def pick_diverse(conn,protocol,number_to_dock,chunk_size=100000):
+    """
+    Pick the best predicted compounds, skipping compounds whose bucket of
+    similar SMILES is already full. The candidates are read in the order
+    of the pred leaderboard (index on score), and if it runs out, from the
+    best predictions of the table in growing ORDER BY ... LIMIT passes, so
+    the whole table is never sorted.
+
+    :param conn: SQLite3 connection
+    :param protocol: Protocol dictionary
+    :param number_to_dock: number of compounds to pick
+    :param chunk_size: number of rows fetched at a time
+    :return: list of hastenids
+    """
+    bucket_counts = {}
+    to_dock = []
+    seen = set()
+    db = hasten_db.filename(conn)
+    def take(cur):
+        rows = cur.fetchmany(chunk_size)
+        while len(rows)>0 and len(to_dock)<number_to_dock:
+            for hastenid,smiles in hasten_library.fill_text(db,[row for row in rows if row[0] not in seen],0,1):
+                seen.add(hastenid)
+                bucket = smiles_bucket(smiles)
+                if bucket_counts.get(bucket,0)<protocol["diversity_bucket_size"]:
+                    bucket_counts[bucket] = bucket_counts.get(bucket,0)+1
+                    to_dock.append(hastenid)
+                    if len(to_dock)>=number_to_dock:
+                        break
+            rows = cur.fetchmany(chunk_size)
+        cur.close()
+    take(conn.execute("SELECT leaderboard.hastenid,data.smiles FROM leaderboard INNER JOIN data ON data.hastenid=leaderboard.hastenid WHERE leaderboard.kind='pred' AND data.dock_score IS NULL AND data.dataset_status IS NULL ORDER BY leaderboard.score"))
+    wanted = 4*number_to_dock
+    while len(to_dock)<number_to_dock:
+        before = len(seen)
+        take(conn.execute("SELECT hastenid,smiles FROM data WHERE dock_score IS NULL AND dataset_status IS NULL ORDER BY pred_score LIMIT ?",[wanted,]))
+        if len(seen)-before==0 or len(seen)<wanted:
+            # all undocked compounds seen
+            break
+        wanted *= 4
+    print(len(bucket_counts),"buckets of similar compounds picked")
+    return to_dock
+
+STRATEGIES = {"greedy":pick_greedy,"ucb":pick_ucb,"thompson":pick_thompson,"diverse":pick_diverse,"random":pick_random}
+
+def get_strategy(name):
+    """
+    Get acquisition function by name
+
+    :param name: name of the strategy or "module:function"
+    :return: acquisition function
+    """
+    if name in STRATEGIES:
+        return STRATEGIES[name]
+    if ":" in name:
+        module_name,function_name = name.split(":",1)
+        try:
+            return getattr(importlib.import_module(module_name),function_name)
+        except (ImportError,AttributeError) as e:
+            print("Cannot load acquisition strategy",name,":",e)
+            sys.exit(1)
+    print("Unknown acquisition strategy:",name)
+    sys.exit(1)
@@ -34,9 +34,10 @@ your datbase (like in the benchmarking study)
 import argparse
 import os
 import sys
-import csv
-import sqlite3
-import subprocess
+import array
+import numpy as np
+
+import hasten_db
 
 def parse_cmd_line():
     """
@@ -46,7 +47,11 @@ def parse_cmd_line():
     """
     parser = argparse.ArgumentParser(description="Analyze HASTEN simulation")
     parser.add_argument("-m","--database",required=True,type=str,help="HASTEN database")
-    parser.add_argument("-d","--dock",required=True,type=str,help="Docking data")
+    parser.add_argument("-d","--dock",required=False,type=str,help="Docking data (default: oracle table of the database)")
+    parser.add_argument("-t","--thresholds",required=False,type=float,nargs="+",default=[0.001,0.01,0.05],help="Fractions of the best reference scores counted as hits (default: 0.001 0.01 0.05)")
+    parser.add_argument("-b","--budgets",required=False,type=float,nargs="+",default=[0.01,0.02,0.05,0.1],help="Docked fractions of the database to report recalls at (default: 0.01 0.02 0.05 0.1)")
+    parser.add_argument("-p","--pred-history",required=False,action="store_true",help="Report how well the predictions of each iteration in the prediction store (pred_store=mmap) find the hits")
+    parser.add_argument("--no-cache",required=False,action="store_true",help="Do not write or use the .npy cache of the docking data")
     return parser.parse_args()
 
 def files_exist(args):
@@ -59,64 +64,272 @@ def files_exist(args):
     if not os.path.exists(args.database):
         print("HASTEN database file missing!")
         return False
-    if not os.path.exists(args.dock):
+    if args.dock is not None and not os.path.exists(args.dock):
         print("Docking data missing!")
         return False
     return True
 
-def analyze(args):
+def load_reference_scores(filename,use_cache=True):
     """
-    Calculate recalls
+    Load reference docking scores (first column of dock.txt) as float32 array.
 
-    :param args: Parsed arguments
+    The text file is parsed only once, after that the scores are memory-mapped
+    from a "<filename>.npy" cache next to it.
+
+    :param filename: docking data file (score and smilesid, delimiter space)
+    :param use_cache: read and write the .npy cache
+    :return: numpy array of the scores
     """
-    # read in docking scores in ugly way as the dock.txt can be huge
-    # assuming it is sorted! 
-    docks=int(subprocess.check_output("/usr/bin/wc -l "+args.dock,shell=True).split()[0])
-    one_percent=round(0.01*docks)
-    row_count = 0
-    with open(args.dock) as dockfile:
-        for row in csv.reader(dockfile,delimiter=" "):
+    cache_name = filename+".npy"
+    if use_cache and os.path.exists(cache_name) and os.path.getmtime(cache_name)>=os.path.getmtime(filename):
+        return np.load(cache_name,mmap_mode="r")
+    scores = array.array("f")
+    with open(filename,"rt") as dockfile:
+        for line in dockfile:
+            if len(line.strip())==0:
+                continue
             try:
-                if row_count>=one_percent:
-                    cutoff = float(row[0])
-                    break
-                row_count += 1
-            except:
-                print("Invalid numeric value in docking scores")
+                scores.append(float(line.split(" ",1)[0]))
+            except ValueError:
+                print("Invalid numeric value in docking scores:",line.strip())
                 sys.exit(1)
-    print("WARNING: Assuming that docking scores are sorted in the file.")
-    print()
+    scores = np.frombuffer(scores,dtype=np.float32)
+    if use_cache:
+        try:
+            np.save(cache_name,scores)
+        except OSError:
+            print("NOTE: could not write docking data cache",cache_name)
+    return scores
+
+def load_oracle_scores(db,chunk_size=1000000):
+    """
+    Load reference docking scores from the oracle table of simulation database
+
+    :param db: The filename of SQlite3 database
+    :param chunk_size: number of rows fetched at a time
+    :return: numpy array of the scores
+    """
+    conn=hasten_db.connect(db,readonly=True)
+    c = conn.cursor()
+    if not hasten_db.has_table(conn,"oracle"):
+        print("No oracle table in the database, give the docking data with -d")
+        sys.exit(1)
+    scores = array.array("f")
+    cur = c.execute("SELECT score FROM oracle")
+    rows = cur.fetchmany(chunk_size)
+    while len(rows)>0:
+        scores.extend(row[0] for row in rows)
+        rows = cur.fetchmany(chunk_size)
+    return np.frombuffer(scores,dtype=np.float32)
+
+def score_cutoffs(scores,thresholds):
+    """
+    Calculate exact docking score cutoffs for top fractions of the scores
+
+    The scores do not need to be sorted, one partitioning pass finds all
+    cutoffs. Compounds tied with the cutoff score are counted as hits.
+
+    :param scores: numpy array of reference scores
+    :param thresholds: list of fractions (0.01 is top 1%)
+    :return: list of (threshold,cutoff,number of hits in reference) tuples
+    """
+    kths = [max(1,int(round(threshold*len(scores))))-1 for threshold in thresholds]
+    partitioned = np.partition(scores,sorted(set(kths)))
+    cutoffs = []
+    for threshold,kth in zip(thresholds,kths):
+        cutoff = float(partitioned[kth])
+        cutoffs.append((threshold,cutoff,int(np.count_nonzero(scores<=cutoff))))
+    return cutoffs
+
+def scan_docked(db,cutoffs,chunk_size=1000000):
+    """
+    Count docked compounds and hits per iteration with one pass over database
+
+    :param db: The filename of SQlite3 database
+    :param cutoffs: list of (threshold,cutoff,hits) from score_cutoffs()
+    :param chunk_size: number of rows fetched at a time
+    :return: dictionary iteration -> [docked,hits at each cutoff...]
+    """
+    conn=hasten_db.connect(db,readonly=True)
+    cutoff_values = np.array([cutoff[1] for cutoff in cutoffs],dtype=np.float32)
+    per_iteration = {}
+    c = conn.cursor()
+    cur = c.execute("SELECT dock_score,IFNULL(dock_iteration,-1) FROM data WHERE dock_score IS NOT NULL")
+    rows = cur.fetchmany(chunk_size)
+    while len(rows)>0:
+        chunk = np.array(rows,dtype=np.float64)
+        iterations = chunk[:,1].astype(np.int64)
+        hits = chunk[:,0].astype(np.float32)[:,None]<=cutoff_values[None,:]
+        for iteration in np.unique(iterations):
+            mask = iterations==iteration
+            counts = [int(np.count_nonzero(mask))]+[int(x) for x in hits[mask].sum(axis=0)]
+            if iteration not in per_iteration:
+                per_iteration[int(iteration)] = [0]*len(counts)
+            per_iteration[int(iteration)] = [a+b for a,b in zip(per_iteration[int(iteration)],counts)]
+        rows = cur.fetchmany(chunk_size)
+    return per_iteration
+
+def recall_curve(per_iteration,cutoffs,database_size):
+    """
+    Calculate cumulative recall curve over iterations
+
+    :param per_iteration: dictionary iteration -> [docked,hits...]
+    :param cutoffs: list of (threshold,cutoff,hits) from score_cutoffs()
+    :param database_size: number of compounds in the whole database
+    :return: list of (iteration,docked,docked fraction,[recalls]) tuples
+    """
+    curve = []
+    so_far = [0]*(len(cutoffs)+1)
+    for iteration in sorted(per_iteration.keys()):
+        so_far = [a+b for a,b in zip(so_far,per_iteration[iteration])]
+        recalls = [so_far[i+1]/cutoffs[i][2] for i in range(len(cutoffs))]
+        curve.append((iteration,per_iteration[iteration][0],so_far[0]/database_size,recalls))
+    return curve
+
+def budget_recalls(curve,budget):
+    """
+    Interpolate recalls at given docked fraction of the database
+
+    :param curve: recall curve from recall_curve()
+    :param budget: docked fraction of the database
+    :return: list of recalls or None if the simulation did not dock that much
+    """
+    prev_fraction = 0.0
+    prev_recalls = [0.0]*len(curve[0][3]) if len(curve)>0 else []
+    for iteration,mols,fraction,recalls in curve:
+        if fraction>=budget:
+            if fraction==prev_fraction:
+                return recalls
+            weight = (budget-prev_fraction)/(fraction-prev_fraction)
+            return [a+weight*(b-a) for a,b in zip(prev_recalls,recalls)]
+        prev_fraction = fraction
+        prev_recalls = recalls
+    return None
+
+def print_recall_table(cutoffs,curve,budgets,database_size):
+    """
+    Print recall tables per iteration and per docking budget
+
+    :param cutoffs: list of (threshold,cutoff,hits) from score_cutoffs()
+    :param curve: recall curve from recall_curve()
+    :param budgets: list of docked fractions of the database
+    :param database_size: number of compounds in the whole database
+    """
     print("DOCKING DATA")
-    print("Docked compounds:",docks)
-    print("Top 1% of docked compounds:",one_percent)
-    print("Docking score cutoff at top 1%:",cutoff)
+    print("Docked compounds:",database_size)
+    for threshold,cutoff,hits in cutoffs:
+        print("Top",str(round(threshold*100,3))+"%:",hits,"compounds, docking score cutoff",round(cutoff,3))
     print()
     print("HASTEN DATA\n")
-    print("Iter\t Mols\t Recall")
+    header = "Iter\t Mols\t Docked%"
+    for threshold,cutoff,hits in cutoffs:
+        header += "\t Top"+str(round(threshold*100,3))+"%"
+    print(header)
+    print("-------------------------------------")
+    for iteration,mols,fraction,recalls in curve:
+        line = ("NA" if iteration<0 else str(iteration))+"\t "+str(mols)+"\t "+str(round(fraction*100,3))
+        for recall in recalls:
+            line += "\t "+str(round(recall,3))
+        print(line)
+    print()
+    print("Budget%\t Recalls")
+    print("-------------------------------------")
+    for budget in budgets:
+        recalls = budget_recalls(curve,budget)
+        line = str(round(budget*100,3))
+        if recalls is None:
+            line += "\t not reached"
+        else:
+            for recall in recalls:
+                line += "\t "+str(round(recall,3))
+        print(line)
+
+def prediction_history(db,cutoffs):
+    """
+    Calculate hit rates of the predictions of each iteration in the
+    prediction store. For each cutoff, the same number of compounds as
+    there are hits among the predicted compounds are taken from the top of
+    the predictions and the fraction of them that are hits is reported.
+
+    :param db: The filename of SQlite3 database
+    :param cutoffs: list of (threshold,cutoff,hits) from score_cutoffs()
+    :return: list of (iteration,predicted,[hit rates]) tuples
+    """
+    import hasten_predstore
+    dtype = hasten_predstore.exists(db)
+    if dtype is None:
+        print("No prediction store (pred_store=mmap) for",db)
+        sys.exit(1)
+    store = hasten_predstore.PredictionStore(db,dtype)
+    conn=hasten_db.connect(db,readonly=True)
+    if not hasten_db.has_table(conn,"oracle"):
+        print("Prediction history needs the oracle table of simulation database")
+        sys.exit(1)
+    size = conn.execute("SELECT MAX(hastenid) FROM oracle").fetchone()[0]
+    oracle = np.full(size+1,np.nan,dtype=np.float32)
+    cur = conn.execute("SELECT hastenid,score FROM oracle")
+    rows = cur.fetchmany(1000000)
+    while len(rows)>0:
+        chunk = np.array(rows,dtype=np.float64)
+        oracle[chunk[:,0].astype(np.int64)] = chunk[:,1]
+        rows = cur.fetchmany(1000000)
+    history = []
+    for iteration in store.iterations():
+        predicted = 0
+        hits = [0]*len(cutoffs)
+        for hastenids,scores in store.below(iteration,np.inf):
+            predicted += len(hastenids)
+            for i in range(len(cutoffs)):
+                hits[i] += int(np.count_nonzero(oracle[hastenids]<=cutoffs[i][1]))
+        rates = []
+        for i in range(len(cutoffs)):
+            if hits[i]==0:
+                rates.append(0.0)
+                continue
+            best = store.best(iteration,hits[i])
+            rates.append(int(np.count_nonzero(oracle[best]<=cutoffs[i][1]))/hits[i])
+        history.append((iteration,predicted,rates))
+    return history
+
+def print_prediction_history(cutoffs,history):
+    """
+    Print hit rates of the predictions per iteration
+
+    :param cutoffs: list of (threshold,cutoff,hits) from score_cutoffs()
+    :param history: list from prediction_history()
+    """
+    print()
+    print("PREDICTIONS\n")
+    header = "Iter\t Predicted"
+    for threshold,cutoff,hits in cutoffs:
+        header += "\t Top"+str(round(threshold*100,3))+"%"
+    print(header)
     print("-------------------------------------")
-    
-    # sort by docking score
-    # get the top 1% docking score cut off and number of hits
-    sqlstr="SELECT dock_score,dock_iteration FROM data WHERE data.dock_score<="+str(cutoff)
-    try:
-        conn=sqlite3.connect(args.database)
-    except error in e:
-        print("Error while accessing database:",e)
+    for iteration,predicted,rates in history:
+        line = str(iteration)+"\t "+str(predicted)
+        for rate in rates:
+            line += "\t "+str(round(rate,3))
+        print(line)
+
+def analyze(args):
+    """
+    Calculate recalls
+
+    :param args: Parsed arguments
+    """
+    if args.dock is not None:
+        scores = load_reference_scores(args.dock,use_cache=not args.no_cache)
+    else:
+        scores = load_oracle_scores(args.database)
+    if len(scores)==0:
+        print("No docking scores to analyze")
         sys.exit(1)
-    if conn:
-        hasten_data = {}
-        c = conn.cursor()
-        cur=c.execute(sqlstr)
-        for row in cur.fetchmany(4000000):
-            if row[1] not in hasten_data:
-                hasten_data[row[1]] = 0
-            hasten_data[row[1]] += 1
-        conn.close()
-        so_far = 0
-        for iteration in sorted(hasten_data.keys()):
-            so_far += hasten_data[iteration]
-            print(iteration,"\t",hasten_data[iteration],"\t",round(so_far/one_percent,3))
+    cutoffs = score_cutoffs(scores,args.thresholds)
+    per_iteration = scan_docked(args.database,cutoffs)
+    curve = recall_curve(per_iteration,cutoffs,len(scores))
+    print_recall_table(cutoffs,curve,args.budgets,len(scores))
+    if args.pred_history:
+        print_prediction_history(cutoffs,prediction_history(args.database,cutoffs))
 
 if __name__ == "__main__":
     args = parse_cmd_line()
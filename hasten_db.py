@@ -0,0 +1,366 @@
+# 
+# Copyright (c) 2021 Orion Corporation
+# 
+# Redistribution and use in source and binary forms, with or without 
+# modification, are permitted provided that the following conditions are met:
+# 
+# 1. Redistributions of source code must retain the above copyright notice, 
+# this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice, 
+# this list of conditions and the following disclaimer in the documentation 
+# and/or other materials provided with the distribution.
+# 3. Neither the name of the copyright holder nor the names of its contributors
+# may be used to endorse or promote products derived from this software 
+# without specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" 
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE 
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE 
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE 
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR 
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF 
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS 
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN 
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) 
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE 
+# POSSIBILITY OF SUCH DAMAGE.
+# 
+"""
+HASTEN database access
+
+All tools get their SQLite3 connections from here. Connections are opened
+once per database (and thread) and kept open, so that the page cache and
+the prepared statements are reused between the stages. The database is
+switched to WAL mode, which lets the docking wrappers write while HASTEN
+reads.
+
+The schema is versioned with PRAGMA user_version and older databases are
+upgraded with the migrations below when they are opened for writing.
+
+Target databases (see hasten_target.py) get the imported database that
+they share attached as "library": its confs table (and oracle table) are
+used through the connection as if they were in the target database.
+
+The connection settings can be changed in the protocol (db_cache_size,
+db_mmap_size, db_page_size) or with HASTEN_DB_CACHE_SIZE,
+HASTEN_DB_MMAP_SIZE and HASTEN_DB_PAGE_SIZE environment variables, which
+are passed on to the plug-in scripts.
+"""
+import os
+import sys
+import atexit
+import sqlite3
+import threading
+
+# cache_size in KiB (as in PRAGMA cache_size=-N), mmap_size in bytes,
+# page_size is used only when a new database is created
+SETTINGS = {"cache_size":262144,"mmap_size":1<<30,"page_size":4096}
+ENVIRONMENT = {"cache_size":"HASTEN_DB_CACHE_SIZE","mmap_size":"HASTEN_DB_MMAP_SIZE","page_size":"HASTEN_DB_PAGE_SIZE"}
+
+for setting,variable in ENVIRONMENT.items():
+    if variable in os.environ:
+        try:
+            SETTINGS[setting] = int(os.environ[variable])
+        except ValueError:
+            print("Invalid value for",variable,":",os.environ[variable])
+            sys.exit(1)
+
+_connections = {}
+_libraries = {}
+_lock = threading.Lock()
+
+def configure(protocol):
+    """
+    Take the database settings from protocol and pass them to the plug-in
+    scripts through environment
+
+    :param protocol: Protocol dictionary
+    """
+    for setting,variable in ENVIRONMENT.items():
+        if "db_"+setting in protocol:
+            SETTINGS[setting] = protocol["db_"+setting]
+            os.environ[variable] = str(protocol["db_"+setting])
+
+def migrate_base(conn):
+    """
+    Tables of the original HASTEN database
+
+    :param conn: SQLite3 connection
+    """
+    conn.execute("CREATE TABLE IF NOT EXISTS data (hastenid INTEGER PRIMARY KEY,smiles TEXT,smilesid TEXT,dock_score NUMERIC,dock_iteration INTEGER,pred_score NUMERIC,dataset_status INTEGER)")
+    conn.execute("CREATE TABLE IF NOT EXISTS confs (hastenid INTEGER PRIMARY KEY,conf BLOB)")
+    conn.execute("CREATE TABLE IF NOT EXISTS poses (hastenid INTEGER PRIMARY KEY,pose BLOB)")
+
+def migrate_pred_std(conn):
+    """
+    Spread of the ensemble predictions (acquisition strategies)
+
+    :param conn: SQLite3 connection
+    """
+    if "pred_std" not in [row[1] for row in conn.execute("PRAGMA table_info(data)").fetchall()]:
+        conn.execute("ALTER TABLE data ADD COLUMN pred_std NUMERIC")
+
+def migrate_leaderboard(conn):
+    """
+    Top-N tables, see hasten_leaderboard.py
+
+    :param conn: SQLite3 connection
+    """
+    conn.execute("CREATE TABLE IF NOT EXISTS leaderboard (kind TEXT,hastenid INTEGER,score NUMERIC,PRIMARY KEY(kind,hastenid))")
+    conn.execute("CREATE INDEX IF NOT EXISTS leaderboard_score ON leaderboard(kind,score)")
+    conn.execute("CREATE TABLE IF NOT EXISTS leaderboard_size (kind TEXT PRIMARY KEY,size INTEGER)")
+
+def migrate_stage_scores(conn):
+    """
+    Scores of the docking cascade stages
+
+    :param conn: SQLite3 connection
+    """
+    conn.execute("CREATE TABLE IF NOT EXISTS stage_scores (hastenid INTEGER,stage INTEGER,score NUMERIC,iteration INTEGER,PRIMARY KEY(hastenid,stage))")
+
+def migrate_stats(conn):
+    """
+    Statistics of the campaign, see hasten_status.py. Docking results are
+    counted by a trigger, imports and predictions by the code writing them.
+
+    :param conn: SQLite3 connection
+    """
+    conn.execute("CREATE TABLE IF NOT EXISTS stats (key TEXT PRIMARY KEY,value NUMERIC)")
+    conn.execute("CREATE TABLE IF NOT EXISTS iteration_stats (iteration INTEGER PRIMARY KEY,docked INTEGER,best_score NUMERIC)")
+    conn.execute("CREATE TRIGGER IF NOT EXISTS stats_dock AFTER UPDATE OF dock_score,dock_iteration ON data BEGIN "
+        "UPDATE stats SET value=value+(NEW.dock_score IS NOT NULL)-(OLD.dock_score IS NOT NULL) WHERE key='docked'; "
+        "UPDATE stats SET value=NEW.dock_score WHERE key='best_dock' AND NEW.dock_score IS NOT NULL AND (value IS NULL OR NEW.dock_score<value); "
+        "UPDATE iteration_stats SET docked=docked-1 WHERE OLD.dock_score IS NOT NULL AND iteration=IFNULL(OLD.dock_iteration,-1); "
+        "INSERT INTO iteration_stats(iteration,docked,best_score) SELECT IFNULL(NEW.dock_iteration,-1),1,NEW.dock_score WHERE NEW.dock_score IS NOT NULL "
+        "ON CONFLICT(iteration) DO UPDATE SET docked=docked+1,best_score=MIN(IFNULL(best_score,excluded.best_score),excluded.best_score); "
+        "END")
+    recount_stats(conn)
+
+def recount_stats(conn):
+    """
+    Fill statistics with a full scan of the database. The caller commits.
+
+    :param conn: SQLite3 connection
+    """
+    conn.execute("DELETE FROM stats")
+    conn.execute("DELETE FROM iteration_stats")
+    conn.execute("INSERT INTO stats(key,value) SELECT 'total',COUNT(*) FROM data")
+    conn.execute("INSERT INTO stats(key,value) SELECT 'docked',COUNT(dock_score) FROM data")
+    conn.execute("INSERT INTO stats(key,value) SELECT 'best_dock',MIN(dock_score) FROM data")
+    conn.execute("INSERT INTO stats(key,value) SELECT 'predicted',COUNT(pred_score) FROM data WHERE dock_score IS NULL")
+    conn.execute("INSERT INTO stats(key,value) SELECT 'best_pred',MIN(pred_score) FROM data WHERE dock_score IS NULL")
+    conn.execute("INSERT INTO stats(key,value) VALUES ('pred_iteration',NULL)")
+    # dataset_status 1: dropped by a docking cascade stage (see hasten_ingest.py)
+    conn.execute("INSERT INTO stats(key,value) SELECT 'dropped',COUNT(*) FROM data WHERE dataset_status=1 AND dock_score IS NULL")
+    conn.execute("INSERT INTO iteration_stats(iteration,docked,best_score) SELECT IFNULL(dock_iteration,-1),COUNT(*),MIN(dock_score) FROM data WHERE dock_score IS NOT NULL GROUP BY IFNULL(dock_iteration,-1)")
+
+def migrate_docked_index(conn):
+    """
+    Partial index of the docked compounds: reading the docked hastenids
+    does not need a scan of the whole data table
+
+    :param conn: SQLite3 connection
+    """
+    conn.execute("CREATE INDEX IF NOT EXISTS data_docked ON data(hastenid) WHERE dock_score IS NOT NULL")
+
+def migrate_dup_groups(conn):
+    """
+    Groups of identical SMILES, see hasten_dedup.py
+
+    :param conn: SQLite3 connection
+    """
+    conn.execute("CREATE TABLE IF NOT EXISTS dup_groups (hastenid INTEGER PRIMARY KEY,rep INTEGER)")
+    conn.execute("CREATE INDEX IF NOT EXISTS dup_groups_rep ON dup_groups(rep)")
+
+def migrate_dock_iteration_index(conn):
+    """
+    Index for reading the docking results of one iteration (training
+    data shards)
+
+    :param conn: SQLite3 connection
+    """
+    conn.execute("CREATE INDEX IF NOT EXISTS data_dock_iteration ON data(dock_iteration) WHERE dock_score IS NOT NULL")
+
+def migrate_dropped_stats(conn):
+    """
+    Count of the compounds dropped by a docking cascade stage: they are
+    neither docked nor waiting for docking
+
+    :param conn: SQLite3 connection
+    """
+    conn.execute("INSERT OR REPLACE INTO stats(key,value) SELECT 'dropped',COUNT(*) FROM data WHERE dataset_status=1 AND dock_score IS NULL")
+
+# schema version N is reached by running the first N migrations. Migrations
+# must work also on databases created before the versioning (user_version 0).
+MIGRATIONS = [migrate_base,migrate_pred_std,migrate_leaderboard,migrate_stage_scores,migrate_stats,migrate_docked_index,migrate_dup_groups,migrate_dock_iteration_index,migrate_dropped_stats]
+SCHEMA_VERSION = len(MIGRATIONS)
+
+def migrate(conn):
+    """
+    Upgrade database schema to SCHEMA_VERSION
+
+    :param conn: SQLite3 connection
+    """
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    if version==SCHEMA_VERSION:
+        return
+    if version>SCHEMA_VERSION:
+        print("Database schema version",version,"is newer than this HASTEN (",SCHEMA_VERSION,")")
+        sys.exit(1)
+    conn.commit()
+    # the write lock makes sure only one process runs the migrations
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        if version>SCHEMA_VERSION:
+            print("Database schema version",version,"is newer than this HASTEN (",SCHEMA_VERSION,")")
+            sys.exit(1)
+        for number in range(version,SCHEMA_VERSION):
+            MIGRATIONS[number](conn)
+        conn.execute("PRAGMA user_version="+str(SCHEMA_VERSION))
+        conn.commit()
+    except sqlite3.Error as e:
+        conn.rollback()
+        print("Error while upgrading database:",e)
+        sys.exit(1)
+
+def connect(db,readonly=False,create=False):
+    """
+    Get connection to database. The same connection is returned for the
+    same database in the same thread (and process), do not close it.
+
+    :param db: The filename of SQlite3 database
+    :param readonly: open read-only (no migrations)
+    :param create: create the database if it does not exist
+    :return: SQLite3 connection
+    """
+    # connections must not be shared with forked processes
+    key = (os.path.abspath(db),readonly,threading.get_ident(),os.getpid())
+    with _lock:
+        if key in _connections:
+            return _connections[key]
+    new_database = not os.path.exists(db)
+    if new_database and not create:
+        print("HASTEN database",db,"does not exist!")
+        sys.exit(1)
+    try:
+        if readonly:
+            conn = sqlite3.connect("file:"+os.path.abspath(db)+"?mode=ro",uri=True,timeout=60.0,cached_statements=256,check_same_thread=False)
+        else:
+            conn = sqlite3.connect(db,timeout=60.0,cached_statements=256,check_same_thread=False)
+        if new_database:
+            conn.execute("PRAGMA page_size="+str(int(SETTINGS["page_size"])))
+        if not readonly:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA cache_size=-"+str(int(SETTINGS["cache_size"])))
+        conn.execute("PRAGMA mmap_size="+str(int(SETTINGS["mmap_size"])))
+        conn.execute("PRAGMA temp_store=MEMORY")
+        attach_library(conn,db,readonly)
+        if not readonly:
+            migrate(conn)
+    except sqlite3.Error as e:
+        print("Error while accessing database",db,":",e)
+        sys.exit(1)
+    with _lock:
+        if len(_connections)==0:
+            atexit.register(close)
+        _connections[key] = conn
+    return conn
+
+def attach_library(conn,db,readonly):
+    """
+    Attach the shared library database to a target database connection
+
+    :param conn: SQLite3 connection
+    :param db: The filename of SQlite3 database
+    :param readonly: attach read-only
+    """
+    library = None
+    if conn.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='target'").fetchone() is not None:
+        # the path is relative to the target database
+        library = os.path.join(os.path.dirname(os.path.abspath(db)),conn.execute("SELECT library FROM target").fetchone()[0])
+        if not os.path.exists(library):
+            print("Library database",library,"of target",db,"does not exist!")
+            sys.exit(1)
+        if readonly:
+            conn.execute("ATTACH DATABASE ? AS library",["file:"+library+"?mode=ro"])
+        else:
+            conn.execute("ATTACH DATABASE ? AS library",[library])
+    _libraries[os.path.abspath(db)] = library
+
+def library_db(db):
+    """
+    :param db: The filename of SQlite3 database
+    :return: the filename of the shared library database of a target database, None for other databases
+    """
+    if os.path.abspath(db) not in _libraries:
+        connect(db,readonly=True)
+    return _libraries[os.path.abspath(db)]
+
+def has_table(conn,name):
+    """
+    :param conn: SQLite3 connection
+    :param name: table name
+    :return: True if the table is in the database or in the attached library database
+    """
+    for schema in [row[1] for row in conn.execute("PRAGMA database_list").fetchall()]:
+        if conn.execute("SELECT name FROM "+schema+".sqlite_master WHERE type='table' AND name=?",[name]).fetchone() is not None:
+            return True
+    return False
+
+def filename(conn):
+    """
+    :param conn: SQLite3 connection
+    :return: the filename of the main database of the connection
+    """
+    return conn.execute("PRAGMA database_list").fetchone()[2]
+
+def begin_write(conn):
+    """
+    Start a write transaction that takes the write lock at once. A
+    transaction that reads first and writes later fails at once ("database
+    is locked") if another process wrote meanwhile, with the lock taken
+    first the concurrent writers wait for each other.
+
+    :param conn: SQLite3 connection
+    """
+    if not conn.in_transaction:
+        conn.execute("BEGIN IMMEDIATE")
+
+def checkpoint(db):
+    """
+    Write the WAL file back to the database file, needed before copying
+    the database. The database is not migrated, the copies are.
+
+    :param db: The filename of SQlite3 database
+    """
+    if not os.path.exists(db+"-wal") or os.path.getsize(db+"-wal")==0:
+        return
+    try:
+        conn = sqlite3.connect(db,timeout=60.0)
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        conn.close()
+    except sqlite3.Error as e:
+        print("Error while checkpointing database",db,":",e)
+        sys.exit(1)
+
+def close(db=None):
+    """
+    Close pooled connections (all or those of one database). The last
+    connection checkpoints the WAL file back to the database, so call this
+    before copying the database file.
+
+    :param db: The filename of SQlite3 database or None for all
+    """
+    with _lock:
+        for key in list(_connections.keys()):
+            if db is None or key[0]==os.path.abspath(db):
+                conn = _connections.pop(key)
+                if key[3]!=os.getpid():
+                    continue
+                try:
+                    conn.commit()
+                    conn.close()
+                except sqlite3.Error:
+                    pass
@@ -0,0 +1,310 @@
+# 
+# Copyright (c) 2021 Orion Corporation
+# 
+# Redistribution and use in source and binary forms, with or without 
+# modification, are permitted provided that the following conditions are met:
+# 
+# 1. Redistributions of source code must retain the above copyright notice, 
+# this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice, 
+# this list of conditions and the following disclaimer in the documentation 
+# and/or other materials provided with the distribution.
+# 3. Neither the name of the copyright holder nor the names of its contributors
+# may be used to endorse or promote products derived from this software 
+# without specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" 
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE 
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE 
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE 
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR 
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF 
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS 
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN 
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) 
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE 
+# POSSIBILITY OF SUCH DAMAGE.
+# 
+"""
+HASTEN database writer service
+
+SQLite allows only one writer at a time. When several hand-operated steps
+(docking, importing predictions, conformer generation) run at the same
+time against one database, start this service for the database:
+
+    python hasten_dbwriter.py -m screen.db &
+
+All docking results, predictions and conformers written by HASTEN and the
+wrappers (through hasten_ingest.py) are then sent to the service over a
+Unix socket and written by one process in batched transactions, while the
+readers use WAL snapshots of the database. Without the service the writes
+go directly to the database. Stop the service with:
+
+    python hasten_dbwriter.py -m screen.db --stop
+"""
+import argparse
+import os
+import sys
+import hashlib
+import queue
+import tempfile
+import threading
+import multiprocessing.connection
+
+import hasten_db
+import hasten_ingest
+
+def parse_cmd_line():
+    """
+    Parse command line using ArgumentParser
+
+    :return: parsed arguments
+    """
+    parser = argparse.ArgumentParser(description="Serialize HASTEN database writes")
+    parser.add_argument("-m","--database",required=True,type=str,help="HASTEN database")
+    parser.add_argument("-s","--socket",required=False,type=str,help="Unix socket (default: <database>.writer). The clients find it only if HASTEN_DBWRITER is exported with the same socket.")
+    parser.add_argument("-b","--batch-size",required=False,type=int,default=50000,help="Max. number of compounds written per transaction (default: 50000)")
+    parser.add_argument("--stop",required=False,action="store_true",help="Stop the running service")
+    return parser.parse_args()
+
+def files_exist(args):
+    """
+    Check if input files exist
+
+    :param args: parsed arguments
+    :return: True if files exist, false otherwise
+    """
+    if not os.path.exists(args.database):
+        print("HASTEN database file missing!")
+        return False
+    return True
+
+def socket_address(db):
+    """
+    Unix socket of the writer service of a database. Long paths do not fit
+    to a socket address, they get a socket in the temporary directory.
+
+    :param db: The filename of SQlite3 database
+    :return: socket filename
+    """
+    if "HASTEN_DBWRITER" in os.environ:
+        return os.environ["HASTEN_DBWRITER"]
+    address = os.path.abspath(db)+".writer"
+    if len(address)>100:
+        address = os.path.join(tempfile.gettempdir(),"hasten_"+hashlib.md5(os.path.abspath(db).encode()).hexdigest()+".writer")
+    return address
+
+class WriterClient:
+    """
+    Connection to the writer service
+    """
+    def __init__(self,address):
+        self.conn = multiprocessing.connection.Client(address,family="AF_UNIX")
+
+    def request(self,*message):
+        """
+        Send write request and wait until it has been committed
+
+        :param message: kind of the request and its arguments
+        :return: result of the request
+        """
+        try:
+            self.conn.send(message)
+            status,result = self.conn.recv()
+        except (OSError,EOFError) as e:
+            print("Lost connection to database writer service:",e)
+            sys.exit(1)
+        if status!="ok":
+            print("Database writer service failed:",result)
+            sys.exit(1)
+        return result
+
+    def close(self):
+        self.conn.close()
+
+def connect_writer(db):
+    """
+    Connect to the writer service of a database
+
+    :param db: The filename of SQlite3 database
+    :return: WriterClient or None if the service does not run
+    """
+    address = socket_address(db)
+    if not os.path.exists(address):
+        return None
+    try:
+        return WriterClient(address)
+    except OSError:
+        print("NOTE: database writer service does not answer at",address,", writing directly")
+        return None
+
+def request_size(message):
+    """
+    Number of compounds in a write request
+
+    :param message: write request (see WriterService.write)
+    :return: number of compounds (0 for a malformed request)
+    """
+    try:
+        return len(message[1])
+    except (TypeError,IndexError):
+        return 0
+
+class WriterService:
+    """
+    Receives write requests from clients and writes them with one
+    connection. Requests that arrive while a transaction is written are
+    collected into the next transaction.
+    """
+    def __init__(self,db,address,batch_size):
+        self.db = db
+        self.address = address
+        self.batch_size = batch_size
+        self.requests = queue.Queue()
+        self.listener = None
+        self.running = True
+
+    def serve(self):
+        """
+        Run until stopped
+        """
+        if os.path.exists(self.address):
+            if connect_writer(self.db) is not None:
+                print("Database writer service already runs at",self.address)
+                sys.exit(1)
+            os.unlink(self.address)
+        self.listener = multiprocessing.connection.Listener(self.address,family="AF_UNIX")
+        writer = threading.Thread(target=self.write_loop)
+        writer.start()
+        print("Database writer service for",self.db,"at",self.address)
+        try:
+            while self.running:
+                try:
+                    conn = self.listener.accept()
+                except OSError:
+                    break
+                if not self.running:
+                    conn.close()
+                    break
+                threading.Thread(target=self.handle,args=(conn,),daemon=True).start()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.requests.put(None)
+            writer.join()
+            self.listener.close()
+            if os.path.exists(self.address):
+                os.unlink(self.address)
+            hasten_db.close()
+            print("Database writer service stopped")
+
+    def handle(self,conn):
+        """
+        Serve one client (in its own thread)
+
+        :param conn: multiprocessing connection
+        """
+        while True:
+            try:
+                message = conn.recv()
+            except (OSError,EOFError):
+                break
+            if message[0]=="stop":
+                self.running = False
+                conn.send(("ok",None))
+                # closing the listener does not wake up accept(), a
+                # connection does
+                try:
+                    multiprocessing.connection.Client(self.address,family="AF_UNIX").close()
+                except OSError:
+                    pass
+                break
+            done = threading.Event()
+            reply = []
+            self.requests.put((message,done,reply))
+            done.wait()
+            try:
+                conn.send(reply[0])
+            except OSError:
+                break
+        conn.close()
+
+    def write_loop(self):
+        """
+        Write the requests in batched transactions
+        """
+        conn = hasten_db.connect(self.db)
+        request = self.requests.get()
+        while request is not None:
+            batch = [request]
+            compounds = request_size(request[0])
+            stop = False
+            # take what has arrived meanwhile into the same transaction
+            while compounds<self.batch_size:
+                try:
+                    request = self.requests.get_nowait()
+                except queue.Empty:
+                    break
+                if request is None:
+                    stop = True
+                    break
+                batch.append(request)
+                compounds += request_size(request[0])
+            replies = []
+            try:
+                for message,done,reply in batch:
+                    # a failing request is rolled back alone, the others
+                    # of the transaction are still written
+                    conn.execute("SAVEPOINT request")
+                    try:
+                        replies.append(("ok",self.write(conn,message)))
+                    except Exception as e:
+                        conn.execute("ROLLBACK TO request")
+                        replies.append(("error",str(e)))
+                    conn.execute("RELEASE request")
+                conn.commit()
+            except Exception as e:
+                conn.rollback()
+                replies = [("error",str(e))]*len(batch)
+            # every waiting client gets a reply, also when the writing fails
+            for (message,done,reply),result in zip(batch,replies):
+                reply.append(result)
+                done.set()
+            if stop:
+                break
+            request = self.requests.get()
+
+    def write(self,conn,message):
+        """
+        Write one request (without commit)
+
+        :param conn: SQLite3 connection
+        :param message: ("dock",batch,stage), ("pred",pred_scores,leaderboard_size,update_scores) or ("confs",confs) or ("dropped",hastenids)
+        :return: number of written compounds
+        """
+        if message[0]=="dock":
+            return hasten_ingest.write_dock_batch(conn,message[1],message[2])
+        if message[0]=="pred":
+            return hasten_ingest.write_pred_batch(conn,message[1],message[2],message[3])
+        if message[0]=="confs":
+            return hasten_ingest.write_confs_batch(conn,message[1])
+        if message[0]=="dropped":
+            return hasten_ingest.write_dropped_batch(conn,message[1])
+        raise ValueError("unknown request "+str(message[0]))
+
+if __name__ == "__main__":
+    args = parse_cmd_line()
+    if (not files_exist(args)): sys.exit(1)
+    if args.socket is not None:
+        if os.environ.get("HASTEN_DBWRITER")!=args.socket:
+            print("NOTE: export HASTEN_DBWRITER="+args.socket,"for the HASTEN steps, otherwise they write directly to the database")
+        os.environ["HASTEN_DBWRITER"] = args.socket
+    if args.stop:
+        writer = connect_writer(args.database)
+        if writer is None:
+            print("Database writer service does not run for",args.database)
+            sys.exit(1)
+        writer.request("stop")
+        writer.close()
+    else:
+        WriterService(args.database,socket_address(args.database),args.batch_size).serve()
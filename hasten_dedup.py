@@ -0,0 +1,272 @@
+# 
+# Copyright (c) 2021 Orion Corporation
+# 
+# Redistribution and use in source and binary forms, with or without 
+# modification, are permitted provided that the following conditions are met:
+# 
+# 1. Redistributions of source code must retain the above copyright notice, 
+# this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice, 
+# this list of conditions and the following disclaimer in the documentation 
+# and/or other materials provided with the distribution.
+# 3. Neither the name of the copyright holder nor the names of its contributors
+# may be used to endorse or promote products derived from this software 
+# without specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" 
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE 
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE 
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE 
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR 
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF 
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS 
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN 
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) 
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE 
+# POSSIBILITY OF SUCH DAMAGE.
+# 
+"""
+HASTEN deduplication
+
+Groups compounds with identical SMILES (the same molecule under several
+smilesids) so that each distinct SMILES is predicted and docked only once:
+
+    python hasten_dedup.py -m screen.db
+
+The groups are stored to dup_groups table (hastenid -> representative
+hastenid, the representatives themselves are not in the table). Only the
+representative is sent to ML predictions, and only one compound of each
+group is picked for conformer generation and docking. The predicted and
+docked scores (and poses) are fanned out to the other members of the
+group when they are written. Run it again after importing more compounds.
+"""
+import argparse
+import os
+import sys
+import hashlib
+import math
+
+import hasten_db
+import hasten_ingest
+import hasten_library
+
+# prediction input: only the representatives (all compounds of a group are
+# either docked or undocked) and not the ones dropped by a docking cascade
+PRED_SOURCE = "data LEFT JOIN dup_groups ON dup_groups.hastenid=data.hastenid"
+PRED_FILTER = "data.dock_score IS NULL AND data.dataset_status IS NULL AND dup_groups.hastenid IS NULL"
+
+def parse_cmd_line():
+    """
+    Parse command line using ArgumentParser
+
+    :return: parsed arguments
+    """
+    parser = argparse.ArgumentParser(description="Group identical SMILES of HASTEN database")
+    parser.add_argument("-m","--database",required=True,type=str,help="HASTEN database")
+    return parser.parse_args()
+
+def files_exist(args):
+    """
+    Check if input files exist
+
+    :param args: parsed arguments
+    :return: True if files exist, false otherwise
+    """
+    if not os.path.exists(args.database):
+        print("HASTEN database file missing!")
+        return False
+    return True
+
+def smiles_hash(smiles):
+    """
+    64-bit hash of SMILES
+
+    :param smiles: SMILES string
+    :return: signed integer (fits to SQLite INTEGER)
+    """
+    return int.from_bytes(hashlib.blake2b(smiles.encode(),digest_size=8).digest(),"big",signed=True)
+
+def build_groups(conn):
+    """
+    Find compounds with identical SMILES and store them to dup_groups. The
+    hashes are sorted by SQLite on disk, hash collisions are removed by
+    comparing the SMILES of each pair. Results of compounds docked before
+    the grouping are fanned out to the rest of their group.
+
+    :param conn: SQLite3 connection
+    :return: number of compounds that have a representative
+    """
+    conn.create_function("hasten_smiles_hash",1,smiles_hash,deterministic=True)
+    # SMILES moved to the library store are read from there
+    library = hasten_library.open_library(hasten_db.filename(conn))
+    def library_smiles(hastenid,smiles):
+        if smiles is None and library is not None:
+            smiles = library.get([hastenid]).get(hastenid,(None,None))[0]
+        return smiles
+    conn.create_function("hasten_smiles",2,library_smiles,deterministic=True)
+    # the sort does not fit to memory with large databases
+    conn.execute("PRAGMA temp_store=FILE")
+    conn.execute("DROP TABLE IF EXISTS temp.smiles_hash")
+    conn.execute("CREATE TEMP TABLE smiles_hash AS SELECT hasten_smiles_hash(hasten_smiles(hastenid,smiles)) AS hash,hastenid FROM data")
+    conn.execute("CREATE INDEX temp.smiles_hash_index ON smiles_hash(hash,hastenid)")
+    conn.execute("DELETE FROM dup_groups")
+    conn.execute("DROP TABLE IF EXISTS temp.smiles_pairs")
+    conn.execute("CREATE TEMP TABLE smiles_pairs AS SELECT hastenid,rep FROM (SELECT hastenid,MIN(hastenid) OVER (PARTITION BY hash) AS rep FROM smiles_hash) WHERE hastenid!=rep")
+    conn.execute("DROP TABLE temp.smiles_hash")
+    pairs = "FROM smiles_pairs AS pairs INNER JOIN data AS member ON member.hastenid=pairs.hastenid INNER JOIN data AS rep ON rep.hastenid=pairs.rep WHERE hasten_smiles(member.hastenid,member.smiles)"
+    conn.execute("INSERT INTO dup_groups(hastenid,rep) SELECT pairs.hastenid,pairs.rep "+pairs+"=hasten_smiles(rep.hastenid,rep.smiles)")
+    # the few compounds whose hash collides with another SMILES are grouped
+    # by their SMILES
+    collided = {}
+    for hastenid,smiles in conn.execute("SELECT pairs.hastenid,hasten_smiles(member.hastenid,member.smiles) "+pairs+"!=hasten_smiles(rep.hastenid,rep.smiles) ORDER BY pairs.hastenid").fetchall():
+        collided.setdefault(smiles,[]).append(hastenid)
+    conn.executemany("INSERT INTO dup_groups(hastenid,rep) VALUES (?,?)",[(hastenid,group[0]) for group in collided.values() for hastenid in group[1:]])
+    conn.execute("DROP TABLE temp.smiles_pairs")
+    batch = {}
+    for hastenid,score,iteration,pose in conn.execute("SELECT data.hastenid,data.dock_score,data.dock_iteration,poses.pose FROM dup_groups INNER JOIN data ON data.hastenid IN (dup_groups.hastenid,dup_groups.rep) LEFT JOIN poses ON poses.hastenid=data.hastenid WHERE data.dock_score IS NOT NULL"):
+        batch[hastenid] = (score,iteration,pose)
+    if len(batch)>0:
+        hasten_ingest.write_dock_batch(conn,batch)
+    conn.commit()
+    conn.execute("PRAGMA temp_store=MEMORY")
+    return conn.execute("SELECT COUNT(*) FROM dup_groups").fetchone()[0]
+
+def has_groups(conn):
+    """
+    :param conn: SQLite3 connection
+    :return: True if the database has any groups
+    """
+    return conn.execute("SELECT hastenid FROM dup_groups LIMIT 1").fetchone() is not None
+
+def representatives(conn,hastenids,chunk_size=900):
+    """
+    :param conn: SQLite3 connection
+    :param hastenids: list of hastenids
+    :param chunk_size: number of hastenids looked up at a time
+    :return: dictionary hastenid -> representative (only for grouped ones)
+    """
+    reps = {}
+    for start in range(0,len(hastenids),chunk_size):
+        chunk = hastenids[start:start+chunk_size]
+        reps.update(conn.execute("SELECT hastenid,rep FROM dup_groups WHERE hastenid IN ("+",".join(["?"]*len(chunk))+")",chunk).fetchall())
+    return reps
+
+def undocked_members(conn,hastenids,chunk_size=400):
+    """
+    Find the other undocked compounds of the groups of the compounds
+
+    :param conn: SQLite3 connection
+    :param hastenids: list of hastenids (integers)
+    :param chunk_size: number of groups looked up at a time
+    :return: dictionary hastenid -> list of the other undocked members
+    """
+    members = {}
+    reps = representatives(conn,hastenids)
+    keys = list(set(reps.get(hastenid,hastenid) for hastenid in hastenids))
+    groups = {}
+    for start in range(0,len(keys),chunk_size):
+        chunk = keys[start:start+chunk_size]
+        marks = ",".join(["?"]*len(chunk))
+        for hastenid,rep in conn.execute("SELECT dup_groups.hastenid,dup_groups.rep FROM dup_groups INNER JOIN data ON data.hastenid=dup_groups.hastenid WHERE data.dock_score IS NULL AND dup_groups.rep IN ("+marks+")",chunk):
+            groups.setdefault(rep,[]).append(hastenid)
+        for row in conn.execute("SELECT hastenid FROM data WHERE dock_score IS NULL AND hastenid IN ("+marks+")",chunk):
+            groups.setdefault(row[0],[]).append(row[0])
+    for hastenid in hastenids:
+        others = [member for member in groups.get(reps.get(hastenid,hastenid),[]) if member!=hastenid]
+        if len(others)>0:
+            members[hastenid] = others
+    return members
+
+def fan_out_predictions(conn,pred_scores):
+    """
+    Add the other undocked members of the groups to predictions
+
+    :param conn: SQLite3 connection
+    :param pred_scores: list of (score,std,hastenid) tuples
+    :return: list of (score,std,hastenid) tuples with the members
+    """
+    if not has_groups(conn):
+        return pred_scores
+    members = undocked_members(conn,[int(hastenid) for score,std,hastenid in pred_scores])
+    fanned = list(pred_scores)
+    for score,std,hastenid in pred_scores:
+        for member in members.get(int(hastenid),[]):
+            fanned.append((score,std,member))
+    return fanned
+
+def fan_out_docking(conn,batch):
+    """
+    Add the other undocked members of the groups to docking results
+
+    :param conn: SQLite3 connection
+    :param batch: dictionary hastenid -> (score,iteration,pose)
+    :return: dictionary with the members
+    """
+    if not has_groups(conn):
+        return batch
+    members = undocked_members(conn,list(batch.keys()))
+    fanned = dict(batch)
+    for hastenid,result in batch.items():
+        for member in members.get(hastenid,[]):
+            if member not in fanned or fanned[member][0]>result[0]:
+                fanned[member] = result
+    return fanned
+
+def one_per_group(conn,hastenids):
+    """
+    Keep only the first compound of each group
+
+    :param conn: SQLite3 connection
+    :param hastenids: list of hastenids
+    :return: list of hastenids
+    """
+    if not has_groups(conn):
+        return hastenids
+    reps = representatives(conn,hastenids)
+    seen = set()
+    kept = []
+    for hastenid in hastenids:
+        key = reps.get(hastenid,hastenid)
+        if key not in seen:
+            seen.add(key)
+            kept.append(hastenid)
+    return kept
+
+def pick_representatives(conn,pick,number_to_dock):
+    """
+    Pick compounds until there are number_to_dock of them after keeping
+    one compound of each group. If duplicates were skipped, more compounds
+    are asked. The picks of all calls are collected (a strategy may pick
+    different compounds on each call, e.g. thompson and random), so the
+    compounds kept earlier stay picked.
+
+    :param conn: SQLite3 connection
+    :param pick: function picking given number of hastenids
+    :param number_to_dock: number of compounds wanted
+    :return: list of hastenids
+    """
+    wanted = number_to_dock
+    picked = []
+    seen = set()
+    while True:
+        new_picks = pick(wanted)
+        added = [hastenid for hastenid in new_picks if hastenid not in seen]
+        seen.update(added)
+        picked.extend(added)
+        kept = one_per_group(conn,picked)
+        if len(kept)>=number_to_dock or len(new_picks)<wanted or len(added)==0:
+            break
+        # ask for more in proportion to the duplicates seen so far
+        wanted += int(math.ceil((number_to_dock-len(kept))*len(picked)/max(1,len(kept))))
+    if len(picked)>len(kept):
+        print(len(picked)-len(kept),"picked compounds skipped as duplicates (their group is docked once)")
+    return kept[:number_to_dock]
+
+if __name__ == "__main__":
+    args = parse_cmd_line()
+    if (not files_exist(args)): sys.exit(1)
+    conn = hasten_db.connect(args.database)
+    print("Grouping identical SMILES...")
+    duplicates = build_groups(conn)
+    groups = conn.execute("SELECT COUNT(DISTINCT rep) FROM dup_groups").fetchone()[0]
+    print(duplicates,"compounds are duplicates of",groups,"other compounds")
@@ -0,0 +1,193 @@
+# 
+# Copyright (c) 2021 Orion Corporation
+# 
+# Redistribution and use in source and binary forms, with or without 
+# modification, are permitted provided that the following conditions are met:
+# 
+# 1. Redistributions of source code must retain the above copyright notice, 
+# this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice, 
+# this list of conditions and the following disclaimer in the documentation 
+# and/or other materials provided with the distribution.
+# 3. Neither the name of the copyright holder nor the names of its contributors
+# may be used to endorse or promote products derived from this software 
+# without specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" 
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE 
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE 
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE 
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR 
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF 
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS 
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN 
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) 
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE 
+# POSSIBILITY OF SUCH DAMAGE.
+# 
+"""
+HASTEN docking cost
+
+Docking time grows with the size and the flexibility of the compound.
+The cost of a compound is estimated from its SMILES (heavy atoms and
+rotatable bonds, no toolkit needed) and the compounds are packed into
+docking chunks of about equal total cost, so that no chunk is left
+running long after the others.
+"""
+import heapq
+import re
+
+# one rotatable bond costs about as much as this many heavy atoms
+ROTOR_WEIGHT = 4.0
+HYDROGEN = re.compile("[0-9]*H([^a-z]|$)")
+ORGANIC = ["Cl","Br","B","C","N","O","P","S","F","I","b","c","n","o","p","s"]
+
+def parse(smiles):
+    """
+    Read the heavy atoms and the bonds of a SMILES
+
+    :param smiles: SMILES string
+    :return: (number of atoms,list of (atom1,atom2,bond order))
+    """
+    atoms = 0
+    bonds = []
+    branches = []
+    rings = {}
+    previous = None
+    order = 1
+    i = 0
+    while i<len(smiles):
+        char = smiles[i]
+        atom = False
+        if char=="[":
+            end = smiles.find("]",i)
+            end = len(smiles) if end<0 else end
+            # explicit hydrogens ([H], [2H], [H+]) are not heavy atoms
+            atom = HYDROGEN.match(smiles[i+1:end]) is None
+            i = end+1
+        elif smiles.startswith("Cl",i) or smiles.startswith("Br",i):
+            atom = True
+            i += 2
+        elif char in ORGANIC:
+            atom = True
+            i += 1
+        elif char=="(":
+            branches.append(previous)
+            i += 1
+        elif char==")":
+            previous = branches.pop() if branches else previous
+            i += 1
+        elif char in "=#$":
+            order = {"=":2,"#":3,"$":4}[char]
+            i += 1
+        elif char.isdigit() or char=="%":
+            number = smiles[i+1:i+3] if char=="%" else char
+            i += 3 if char=="%" else 1
+            if number in rings:
+                start,start_order = rings.pop(number)
+                if previous is not None:
+                    bonds.append((start,previous,max(order,start_order)))
+            else:
+                rings[number] = (previous,order)
+            order = 1
+        elif char==".":
+            previous = None
+            i += 1
+        else:
+            # "-", ":", "/", "\" and anything unknown
+            i += 1
+        if atom:
+            if previous is not None:
+                bonds.append((previous,atoms,order))
+            previous = atoms
+            atoms += 1
+            order = 1
+    return atoms,bonds
+
+def ring_bonds(atoms,bonds):
+    """
+    Find the bonds that are in a ring (the bonds that are not bridges)
+
+    :param atoms: number of atoms
+    :param bonds: list of (atom1,atom2,bond order)
+    :return: set of bond indices in a ring
+    """
+    neighbours = [[] for _ in range(atoms)]
+    for index,(a,b,_) in enumerate(bonds):
+        neighbours[a].append((b,index))
+        neighbours[b].append((a,index))
+    order = [-1]*atoms
+    low = [0]*atoms
+    bridges = set()
+    counter = 0
+    for root in range(atoms):
+        if order[root]>=0:
+            continue
+        order[root] = low[root] = counter
+        counter += 1
+        stack = [(root,-1,iter(neighbours[root]))]
+        while stack:
+            atom,via,edges = stack[-1]
+            for other,index in edges:
+                if index==via:
+                    continue
+                if order[other]<0:
+                    order[other] = low[other] = counter
+                    counter += 1
+                    stack.append((other,index,iter(neighbours[other])))
+                    break
+                low[atom] = min(low[atom],order[other])
+            else:
+                stack.pop()
+                if stack:
+                    parent = stack[-1][0]
+                    low[parent] = min(low[parent],low[atom])
+                    if low[atom]>order[parent]:
+                        bridges.add(via)
+    return set(range(len(bonds)))-bridges
+
+def estimate(smiles):
+    """
+    Estimate the docking cost of a compound
+
+    A rotatable bond is a single bond outside rings between two atoms
+    that both have other heavy atom neighbours.
+
+    :param smiles: SMILES string
+    :return: cost (heavy atoms plus weighted rotatable bonds)
+    """
+    atoms,bonds = parse(smiles)
+    degree = [0]*atoms
+    for a,b,_ in bonds:
+        degree[a] += 1
+        degree[b] += 1
+    in_ring = ring_bonds(atoms,bonds)
+    rotors = 0
+    for index,(a,b,order) in enumerate(bonds):
+        if order==1 and index not in in_ring and degree[a]>1 and degree[b]>1:
+            rotors += 1
+    return atoms+ROTOR_WEIGHT*rotors
+
+def balance(rows,chunk_size,smiles_column=0):
+    """
+    Pack compounds into chunks of about equal docking cost
+
+    The number of chunks is the same as with chunks of chunk_size
+    compounds. The most expensive compounds are placed first, each to the
+    currently cheapest chunk (longest processing time first).
+
+    :param rows: compound rows
+    :param chunk_size: compounds per chunk on average
+    :param smiles_column: column of the SMILES in the rows
+    :return: list of (estimated cost,list of rows)
+    """
+    if len(rows)==0:
+        return []
+    number_of_chunks = (len(rows)+chunk_size-1)//chunk_size
+    costs = sorted(((estimate(row[smiles_column]),position) for position,row in enumerate(rows)),reverse=True)
+    chunks = [(0.0,number,[]) for number in range(number_of_chunks)]
+    for cost,position in costs:
+        total,number,members = heapq.heappop(chunks)
+        members.append(rows[position])
+        heapq.heappush(chunks,(total+cost,number,members))
+    return [(total,members) for total,number,members in sorted(chunks,key=lambda chunk: chunk[1])]
@@ -36,7 +36,18 @@ import argparse
 import os
 import sys
 import csv
-import sqlite3
+import glob
+import io
+import gzip
+import queue
+import concurrent.futures
+import threading
+
+import hasten_db
+import hasten_leaderboard
+import hasten_library
+import hasten_memory
+import hasten_target
 
 def parse_cmd_line():
     """
@@ -46,11 +57,15 @@ def parse_cmd_line():
     """
     parser = argparse.ArgumentParser(description="Export data from HASTEN")
     parser.add_argument("-m","--database",required=True,type=str,help="HASTEN database")
-    parser.add_argument("-c","--cutoff",required=True,type=float,help="Docking score cut off for molecules")
+    parser.add_argument("-t","--target",required=False,type=str,help="Export a target of the database (see hasten_target.py)")
+    parser.add_argument("-c","--cutoff",required=False,type=float,help="Docking score cut off for molecules")
+    parser.add_argument("-n","--top",required=False,type=int,help="Export N best compounds from the leaderboard instead of using cut off")
     parser.add_argument("-z","--out-dock-poses",required=False,type=str,help="Docked poses from docking calculations")
     parser.add_argument("-x","--out-dock-scores",required=False,type=str,help="Scores for the docked poses")
     parser.add_argument("-a","--out-pred-confs",required=False,type=str,help="Conformers for to be docked compounds")
     parser.add_argument("-q","--out-pred-scores",required=False,type=str,help="Predicted scores for the to be docked poses")
+    parser.add_argument("--chunk-size",required=False,type=int,default=2000,help="Number of rows fetched from database at a time (default: 2000)")
+    parser.add_argument("--max-memory",required=False,type=str,help="Memory budget like 16G, limits --chunk-size")
     return parser.parse_args()
 
 def files_exist(args):
@@ -63,59 +78,211 @@ def files_exist(args):
     if not os.path.exists(args.database):
         print("HASTEN database file missing!")
         return False
+    if (args.cutoff is None) == (args.top is None):
+        print("Give either docking score cut off (-c) or number of top compounds (--top)")
+        return False
     return True
 
-def export_to_file(args,outputtype):
+def open_output(filename,binary):
     """
-    Output data to file
+    Open output file, compressed if the filename ends with .gz or .zst
+
+    :param filename: output filename
+    :param binary: open in binary mode
+    :return: file object
+    """
+    if filename.endswith(".gz"):
+        return gzip.open(filename,"wb" if binary else "wt",compresslevel=6)
+    if filename.endswith(".zst"):
+        try:
+            import zstandard
+        except ImportError:
+            print("zstandard module is needed for .zst output")
+            sys.exit(1)
+        return zstandard.open(filename,"wb" if binary else "wt")
+    return open(filename,"wb" if binary else "wt")
+
+class OutputWriter(threading.Thread):
+    """
+    Writes (and compresses) one output file in its own thread. The queue is
+    bounded so that memory use stays flat even if the disk is slow.
+    """
+    def __init__(self,filename,binary):
+        threading.Thread.__init__(self)
+        self.filename = filename
+        self.binary = binary
+        self.queue = queue.Queue(maxsize=4)
+        self.error = None
+        self.start()
+
+    def run(self):
+        try:
+            with open_output(self.filename,self.binary) as w:
+                block = self.queue.get()
+                while block is not None:
+                    w.write(block)
+                    block = self.queue.get()
+        except (OSError,ValueError) as e:
+            self.error = e
+            # keep draining so that the database reader does not block
+            while self.queue.get() is not None:
+                pass
+
+    def write(self,block):
+        self.queue.put(block)
+
+    def close(self):
+        self.queue.put(None)
+        self.join()
+        if self.error is not None:
+            print("Error while writing",self.filename,":",self.error)
+            sys.exit(1)
+
+def check_leaderboards(args):
+    """
+    Make sure that the leaderboards needed for --top exist
 
     :param args: parsed arguments
-    :param outputtype: "dock-poses","dock-scores","pred-confs","pred-scores"
-    """
-    if outputtype=="dock-poses":
-        outputfile=args.out_dock_poses
-        sqlstr="SELECT pose FROM poses INNER JOIN data ON data.hastenid==poses.hastenid WHERE data.dock_score<="+str(args.cutoff)
-        output_blob = True
-    elif outputtype=="dock-scores":
-        outputfile=args.out_dock_scores
-        sqlstr="SELECT smiles,smilesid,dock_score,dock_iteration FROM data WHERE data.dock_score<="+str(args.cutoff)
-        output_blob = False
-    elif outputtype=="pred-confs":
-        outputfile=args.out_pred_confs
-        sqlstr="SELECT conf FROM confs INNER JOIN data ON data.hastenid==confs.hastenid WHERE data.dock_score IS NULL AND data.pred_score<="+str(args.cutoff)
-        output_blob = True
-    elif outputtype=="pred-scores":
-        outputfile=args.out_pred_scores
-        sqlstr="SELECT smiles,smilesid,pred_score FROM data WHERE data.dock_score IS NULL AND data.pred_score<="+str(args.cutoff)
-        output_blob = False
+    """
+    kinds = []
+    if args.out_dock_poses is not None or args.out_dock_scores is not None:
+        kinds.append("dock")
+    if args.out_pred_confs is not None or args.out_pred_scores is not None:
+        kinds.append("pred")
+    conn=hasten_db.connect(args.database,readonly=True)
+    for kind in kinds:
+        size = hasten_leaderboard.get_leaderboard_size(conn,kind)
+        if size is None:
+            print("No",kind,"leaderboard in the database, building it with a full scan...")
+            # the only write of the export
+            hasten_leaderboard.rebuild_leaderboard(hasten_db.connect(args.database),kind,args.top)
+        elif size<args.top:
+            print("NOTE: the",kind,"leaderboard keeps only",size,"compounds (leaderboard_size in protocol)")
+
+def fetch_rows(cur,chunk_size):
+    """
+    Read result set in chunks. With memory budget the chunks are made
+    smaller if needed: two passes with four queued blocks for both output
+    files each are in memory at the same time.
+
+    :param cur: SQLite3 cursor
+    :param chunk_size: number of rows fetched at a time
+    :return: generator of lists of rows
+    """
+    return hasten_memory.fetch_chunks(cur,chunk_size,hasten_memory.SHARE/20,what="export")
+
+def store_rows(args,conn,with_blob,chunk_size=900):
+    """
+    Read predicted compounds from the prediction store (pred_store=mmap)
+    instead of the pred_score column. Rows come in hastenid order like in
+    the table scan.
+
+    :param args: parsed arguments
+    :param conn: SQLite3 connection
+    :param with_blob: add the conformer as last column
+    :param chunk_size: number of hastenids looked up at a time
+    :return: generator of lists of rows
+    """
+    import hasten_predstore
+    store = hasten_predstore.PredictionStore(args.database,hasten_predstore.exists(args.database))
+    iteration = store.latest_iteration()
+    print("Using predictions of iteration",iteration,"from",store.path)
+    if with_blob:
+        sqlstr="SELECT data.hastenid,data.smiles,data.smilesid,confs.conf FROM data LEFT JOIN confs ON data.hastenid==confs.hastenid WHERE data.dock_score IS NULL AND data.hastenid IN "
     else:
-        print("INTERNAL ERROR: invalid export_to_file definition")
-        sys.exit(1)
-    print("Exporting to",outputfile)
-    try:
-        conn=sqlite3.connect(args.database)
-    except error in e:
-        print("Error while accessing database:",e)
+        sqlstr="SELECT data.hastenid,data.smiles,data.smilesid FROM data WHERE data.dock_score IS NULL AND data.hastenid IN "
+    for hastenids,scores in store.below(iteration,args.cutoff):
+        store_scores = scores.astype(store.dtype)
+        for start in range(0,len(hastenids),chunk_size):
+            chunk = [int(hastenid) for hastenid in hastenids[start:start+chunk_size]]
+            # shortest representation of the stored float32/float16 value
+            pred_scores = dict(zip(chunk,[float(str(score)) for score in store_scores[start:start+chunk_size]]))
+            rows = hasten_library.fill_text(args.database,conn.execute(sqlstr+"("+",".join(["?"]*len(chunk))+") ORDER BY data.hastenid",chunk).fetchall(),0,1,2)
+            yield [(row[1],row[2],pred_scores[row[0]])+tuple(row[3:]) for row in rows]
+
+def export_pass(args,kind):
+    """
+    Output docked ("dock") or predicted ("pred") compounds with one pass over
+    the database. Both the structure and the score files of the kind are
+    written from the same result set.
+
+    :param args: parsed arguments
+    :param kind: "dock" or "pred"
+    """
+    if kind=="dock":
+        blob_file,score_file = args.out_dock_poses,args.out_dock_scores
+        columns="data.smiles,data.smilesid,data.dock_score,data.dock_iteration"
+        blob_table,blob_column = "poses","pose"
+        where="data.dock_score<=?"
+    elif kind=="pred":
+        blob_file,score_file = args.out_pred_confs,args.out_pred_scores
+        columns="data.smiles,data.smilesid,data.pred_score"
+        blob_table,blob_column = "confs","conf"
+        where="data.dock_score IS NULL AND data.pred_score<=?"
+    else:
+        print("INTERNAL ERROR: invalid export_pass definition")
         sys.exit(1)
-    if conn:
-        c = conn.cursor()
-        if output_blob:
-            rowblob=c.execute(sqlstr).fetchall()
-            w = open(outputfile,"wb")
-            for row in rowblob: w.write(row[0])
-            w.close()
-        else:
-            rowtxt=c.execute(sqlstr).fetchall()
-            with open(outputfile, "wt") as csvfile:
-                reswriter=csv.writer(csvfile,delimiter=",")
-                for row in rowtxt: reswriter.writerow(row)
-        conn.close()
+    if blob_file is None and score_file is None:
+        return
+    conn=hasten_db.connect(args.database,readonly=True)
+    if args.top is not None:
+        # served from leaderboard in score order
+        source="leaderboard INNER JOIN data ON data.hastenid==leaderboard.hastenid"
+        where="leaderboard.kind='"+kind+"'"+(" AND data.dock_score IS NULL" if kind=="pred" else "")
+        order=" ORDER BY leaderboard.score LIMIT ?"
+        # pred_score column is not filled with pred_store=mmap
+        columns=columns.replace("data.pred_score","leaderboard.score")
+        parameter=args.top
+    else:
+        source="data"
+        order=""
+        parameter=args.cutoff
+    # SMILES moved to the library store are looked up by hastenid
+    library = hasten_library.open_library(args.database)
+    if library is not None:
+        columns="data.hastenid,"+columns
+    if blob_file is not None and score_file is not None:
+        sqlstr="SELECT "+columns+","+blob_table+"."+blob_column+" FROM "+source+" LEFT JOIN "+blob_table+" ON data.hastenid=="+blob_table+".hastenid WHERE "+where+order
+    elif blob_file is not None:
+        sqlstr="SELECT "+blob_table+"."+blob_column+" FROM "+source+" INNER JOIN "+blob_table+" ON data.hastenid=="+blob_table+".hastenid WHERE "+where+order
+    else:
+        sqlstr="SELECT "+columns+" FROM "+source+" WHERE "+where+order
+    writers = []
+    if blob_file is not None:
+        print("Exporting to",blob_file)
+        blob_writer = OutputWriter(blob_file,True)
+        writers.append(blob_writer)
+    if score_file is not None:
+        print("Exporting to",score_file)
+        score_writer = OutputWriter(score_file,False)
+        writers.append(score_writer)
+    if kind=="pred" and args.top is None and len(glob.glob(os.path.join(args.database+".preds","iter*")))>0:
+        blocks = store_rows(args,conn,blob_file is not None)
+    else:
+        blocks = fetch_rows(conn.cursor().execute(sqlstr,[parameter,]),args.chunk_size)
+        if library is not None and score_file is not None:
+            blocks = ([row[1:] for row in hasten_library.fill_text(args.database,rows,0,1,2)] for rows in blocks)
+    for rows in blocks:
+        if len(rows)==0:
+            continue
+        if blob_file is not None:
+            blob_writer.write(b"".join(row[-1] for row in rows if row[-1] is not None))
+        if score_file is not None:
+            block = io.StringIO()
+            reswriter=csv.writer(block,delimiter=",")
+            for row in rows:
+                reswriter.writerow(row[:-1] if blob_file is not None else row)
+            score_writer.write(block.getvalue())
+    for writer in writers:
+        writer.close()
 
 if __name__ == "__main__":
     args = parse_cmd_line()
     if (not files_exist(args)): sys.exit(1)
-    if args.out_dock_poses is not None: export_to_file(args,"dock-poses")
-    if args.out_dock_scores is not None: export_to_file(args,"dock-scores")
-    if args.out_pred_confs is not None: export_to_file(args,"pred-confs")
-    if args.out_pred_scores is not None: export_to_file(args,"pred-scores")
-
+    hasten_memory.configure(None,args.max_memory)
+    if args.target is not None: args.database = hasten_target.get_target_db(args.database,args.target)
+    if args.top is not None: check_leaderboards(args)
+    # docked and predicted compounds are different rows, scan them in parallel
+    with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+        passes = [executor.submit(export_pass,args,kind) for kind in ["dock","pred"]]
+        for export_future in passes: export_future.result()
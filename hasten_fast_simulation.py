@@ -0,0 +1,353 @@
+# 
+# Copyright (c) 2021 Orion Corporation
+# 
+# Redistribution and use in source and binary forms, with or without 
+# modification, are permitted provided that the following conditions are met:
+# 
+# 1. Redistributions of source code must retain the above copyright notice, 
+# this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice, 
+# this list of conditions and the following disclaimer in the documentation 
+# and/or other materials provided with the distribution.
+# 3. Neither the name of the copyright holder nor the names of its contributors
+# may be used to endorse or promote products derived from this software 
+# without specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" 
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE 
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE 
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE 
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR 
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF 
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS 
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN 
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) 
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE 
+# POSSIBILITY OF SUCH DAMAGE.
+# 
+"""
+HASTEN fast simulation
+
+Runs the HASTEN loop (random first pick, train, predict, pick the best
+predicted) in memory on the oracle scores of a simulation database. No
+SQLite updates, temporary files or plug-in scripts are involved, so the
+protocol parameters can be studied in minutes. The machine learning model
+is replaced by a fast surrogate model.
+"""
+import argparse
+import os
+import sys
+import importlib
+import zlib
+import numpy as np
+
+import hasten
+import hasten_analyze_simulation
+import hasten_db
+import hasten_library
+
+def parse_cmd_line():
+    """
+    Parse command line using ArgumentParser
+
+    :return: parsed arguments
+    """
+    parser = argparse.ArgumentParser(description="Fast in-memory HASTEN simulation")
+    parser.add_argument("-m","--database",required=False,type=str,help="HASTEN simulation database (with oracle table)")
+    parser.add_argument("-d","--dock",required=False,type=str,help="Docking data, if no database is given (only for models without SMILES)")
+    parser.add_argument("-p","--protocol",required=True,type=str,help="Screening protocol file")
+    parser.add_argument("-M","--model",required=False,type=str,default="ngram",help="Surrogate model: ngram (default), noisy-oracle[:correlation] or module:Class")
+    parser.add_argument("-t","--thresholds",required=False,type=float,nargs="+",default=[0.001,0.01,0.05],help="Fractions of the best reference scores counted as hits (default: 0.001 0.01 0.05)")
+    parser.add_argument("-b","--budgets",required=False,type=float,nargs="+",default=[0.01,0.02,0.05,0.1],help="Docked fractions of the database to report recalls at (default: 0.01 0.02 0.05 0.1)")
+    return parser.parse_args()
+
+def files_exist(args):
+    """
+    Check if input files exist
+
+    :param args: parsed arguments
+    :return: True if files exist, false otherwise
+    """
+    if args.database is None and args.dock is None:
+        print("Give either HASTEN database or docking data!")
+        return False
+    if args.database is not None and not os.path.exists(args.database):
+        print("HASTEN database file missing!")
+        return False
+    if args.dock is not None and not os.path.exists(args.dock):
+        print("Docking data missing!")
+        return False
+    if not os.path.exists(args.protocol):
+        print("Screening protocol file missing!")
+        return False
+    return True
+
+class NgramModel:
+    """
+    Ridge regression on hashed SMILES character n-grams
+
+    The features are calculated once and cached next to the database as
+    "<database>.ngrams.npz" (sparse rows), dense blocks are built only for
+    the compounds being trained or predicted. The model is fitted in
+    closed form, so it has nothing random (no seed).
+    """
+    def __init__(self,db,hastenids,bits=256,ngram=3,alpha=1.0,chunk_size=100000):
+        self.bits = bits
+        self.alpha = alpha
+        self.chunk_size = chunk_size
+        self.weights = None
+        self.indptr,self.indices = self.load_features(db,hastenids,ngram)
+
+    def load_features(self,db,hastenids,ngram):
+        """
+        Load or calculate the sparse n-gram features
+
+        :param db: The filename of SQlite3 database
+        :param hastenids: hastenids in the order of the oracle scores
+        :param ngram: longest n-gram length
+        :return: indptr and indices arrays (CSR layout without values)
+        """
+        if db is None:
+            print("n-gram model needs SMILES from HASTEN database (-m)")
+            sys.exit(1)
+        cache_name = db+".ngrams.npz"
+        if os.path.exists(cache_name):
+            cache = np.load(cache_name)
+            if cache["bits"]==self.bits and cache["ngram"]==ngram and len(cache["indptr"])==len(hastenids)+1:
+                return cache["indptr"],cache["indices"]
+        print("Calculating n-gram features...")
+        conn = hasten_db.connect(db,readonly=True)
+        cur = conn.cursor().execute("SELECT data.smiles,data.hastenid FROM data INNER JOIN oracle ON oracle.hastenid=data.hastenid ORDER BY data.hastenid")
+        indptr = np.zeros(len(hastenids)+1,dtype=np.int64)
+        indices = []
+        row_count = 0
+        rows = hasten_library.fill_text(db,cur.fetchmany(self.chunk_size),1,0)
+        while len(rows)>0:
+            for row in rows:
+                smiles = row[0]
+                grams = set()
+                for n in range(1,ngram+1):
+                    for i in range(len(smiles)-n+1):
+                        grams.add(zlib.crc32(smiles[i:i+n].encode())%self.bits)
+                indices.append(np.fromiter(grams,dtype=np.uint16,count=len(grams)))
+                row_count += 1
+                indptr[row_count] = indptr[row_count-1]+len(grams)
+            rows = hasten_library.fill_text(db,cur.fetchmany(self.chunk_size),1,0)
+        indices = np.concatenate(indices) if len(indices)>0 else np.zeros(0,dtype=np.uint16)
+        try:
+            np.savez(cache_name,indptr=indptr,indices=indices,bits=self.bits,ngram=ngram)
+        except OSError:
+            print("NOTE: could not write feature cache",cache_name)
+        return indptr,indices
+
+    def dense(self,rows):
+        """
+        Build dense feature block for the given rows
+
+        :param rows: numpy array of row numbers
+        :return: float32 matrix with a bias column
+        """
+        starts = self.indptr[rows]
+        lengths = self.indptr[rows+1]-starts
+        row_of = np.repeat(np.arange(len(rows)),lengths)
+        offsets = np.arange(lengths.sum())-np.repeat(np.cumsum(lengths)-lengths,lengths)
+        columns = self.indices[np.repeat(starts,lengths)+offsets].astype(np.int64)
+        x = np.zeros((len(rows),self.bits+1),dtype=np.float32)
+        x[row_of,columns] = 1.0
+        x[:,self.bits] = 1.0
+        return x
+
+    def fit(self,rows,scores):
+        """
+        Train the model
+
+        :param rows: numpy array of row numbers of the training compounds
+        :param scores: their docking scores
+        """
+        xtx = np.zeros((self.bits+1,self.bits+1),dtype=np.float64)
+        xty = np.zeros(self.bits+1,dtype=np.float64)
+        for start in range(0,len(rows),self.chunk_size):
+            x = self.dense(rows[start:start+self.chunk_size])
+            xtx += x.T@x
+            xty += x.T@scores[start:start+self.chunk_size]
+        xtx[np.diag_indices(self.bits)] += self.alpha
+        self.weights = np.linalg.solve(xtx,xty).astype(np.float32)
+
+    def predict(self,rows):
+        """
+        Predict docking scores
+
+        :param rows: numpy array of row numbers
+        :return: numpy array of predicted scores
+        """
+        return self.dense(rows)@self.weights
+
+class NoisyOracleModel:
+    """
+    Surrogate that returns the true score plus gaussian noise, tuned so that
+    predictions correlate with the true scores with the given coefficient
+    """
+    def __init__(self,scores,seed,correlation=0.7):
+        self.scores = scores
+        self.rng = np.random.default_rng(seed)
+        self.noise = float(np.std(scores))*np.sqrt(1.0/correlation**2-1.0)
+
+    def fit(self,rows,scores):
+        pass
+
+    def predict(self,rows):
+        return self.scores[rows]+self.rng.normal(0.0,self.noise,len(rows)).astype(np.float32)
+
+def get_model(spec,db,hastenids,scores,seed):
+    """
+    Create surrogate model from command line specification
+
+    Custom models are given as "module:Class". The class is created as
+    Class(db,hastenids,scores,seed) and needs fit(rows,scores) and
+    predict(rows) methods, rows being positions in the hastenids array.
+
+    :param spec: model specification
+    :param db: The filename of SQlite3 database (or None)
+    :param hastenids: numpy array of hastenids
+    :param scores: numpy array of oracle scores
+    :param seed: random seed
+    :return: model object
+    """
+    if spec == "ngram":
+        return NgramModel(db,hastenids)
+    elif spec.startswith("noisy-oracle"):
+        if ":" in spec:
+            try:
+                correlation = float(spec.split(":")[1])
+            except ValueError:
+                print("Invalid correlation for noisy-oracle model:",spec)
+                sys.exit(1)
+            if correlation<=0.0 or correlation>1.0:
+                print("Correlation for noisy-oracle model must be in (0,1]")
+                sys.exit(1)
+            return NoisyOracleModel(scores,seed,correlation)
+        return NoisyOracleModel(scores,seed)
+    elif ":" in spec:
+        module_name,class_name = spec.split(":",1)
+        try:
+            model_class = getattr(importlib.import_module(module_name),class_name)
+        except (ImportError,AttributeError) as e:
+            print("Cannot load model",spec,":",e)
+            sys.exit(1)
+        return model_class(db,hastenids,scores,seed)
+    print("Unknown surrogate model:",spec)
+    sys.exit(1)
+
+def load_oracle(db,chunk_size=1000000):
+    """
+    Load hastenids and oracle scores from simulation database
+
+    :param db: The filename of SQlite3 database
+    :param chunk_size: number of rows fetched at a time
+    :return: numpy arrays of hastenids and scores (ordered by hastenid)
+    """
+    conn=hasten_db.connect(db,readonly=True)
+    c = conn.cursor()
+    if not hasten_db.has_table(conn,"oracle"):
+        print("No oracle table in the database, import it with hasten_import_simulation.py")
+        sys.exit(1)
+    hastenids = []
+    scores = []
+    cur = c.execute("SELECT hastenid,score FROM oracle ORDER BY hastenid")
+    rows = cur.fetchmany(chunk_size)
+    while len(rows)>0:
+        chunk = np.array(rows,dtype=np.float64)
+        hastenids.append(chunk[:,0].astype(np.int64))
+        scores.append(chunk[:,1].astype(np.float32))
+        rows = cur.fetchmany(chunk_size)
+    if len(scores)==0:
+        return np.zeros(0,dtype=np.int64),np.zeros(0,dtype=np.float32)
+    return np.concatenate(hastenids),np.concatenate(scores)
+
+def simulate(protocol,scores,model,seed):
+    """
+    Run HASTEN iterations in memory
+
+    :param protocol: Protocol dictionary
+    :param scores: numpy array of oracle scores
+    :param model: surrogate model
+    :param seed: random seed
+    :return: numpy array of docking iteration for each compound (0 = not docked)
+    """
+    rng = np.random.default_rng(seed)
+    number_of_mols = len(scores)
+    number_to_dock = int(round(protocol["dataset_size"]*number_of_mols))
+    dock_iteration = np.zeros(number_of_mols,dtype=np.int32)
+    iteration = 1
+    while iteration<=protocol["stop_criteria"]:
+        undocked = np.flatnonzero(dock_iteration==0)
+        to_dock = min(number_to_dock,len(undocked))
+        if to_dock==0:
+            break
+        if iteration==1:
+            picked = rng.choice(undocked,to_dock,replace=False)
+        else:
+            docked = np.flatnonzero(dock_iteration>0)
+            rng.shuffle(docked)
+            train_set = np.sort(docked[:int(round(protocol["dataset_split"][0]*len(docked)))])
+            model.fit(train_set,scores[train_set])
+            pred = np.empty(len(undocked),dtype=np.float32)
+            for start in range(0,len(undocked),protocol["pred_size"]):
+                pred[start:start+protocol["pred_size"]] = model.predict(undocked[start:start+protocol["pred_size"]])
+            if to_dock<len(undocked):
+                picked = undocked[np.argpartition(pred,to_dock-1)[:to_dock]]
+            else:
+                picked = undocked
+        dock_iteration[picked] = iteration
+        print("Iteration",iteration,"docked",to_dock)
+        iteration += 1
+    return dock_iteration
+
+def count_docked(scores,dock_iteration,cutoffs):
+    """
+    Count docked compounds and hits per iteration
+
+    :param scores: numpy array of oracle scores
+    :param dock_iteration: numpy array from simulate()
+    :param cutoffs: list of (threshold,cutoff,hits) from score_cutoffs()
+    :return: dictionary iteration -> [docked,hits at each cutoff...]
+    """
+    per_iteration = {}
+    for iteration in np.unique(dock_iteration[dock_iteration>0]):
+        iteration_scores = scores[dock_iteration==iteration]
+        per_iteration[int(iteration)] = [len(iteration_scores)]+[int(np.count_nonzero(iteration_scores<=cutoff[1])) for cutoff in cutoffs]
+    return per_iteration
+
+def run_fast_simulation(protocol,db,dock,model_spec,thresholds):
+    """
+    Load data, simulate and calculate the recall curve
+
+    :param protocol: Protocol dictionary
+    :param db: The filename of SQlite3 database (or None)
+    :param dock: docking data file (used if db is None)
+    :param model_spec: surrogate model specification
+    :param thresholds: list of top fractions counted as hits
+    :return: cutoffs, recall curve and number of compounds
+    """
+    if db is not None:
+        hastenids,scores = load_oracle(db)
+    else:
+        scores = np.asarray(hasten_analyze_simulation.load_reference_scores(dock))
+        hastenids = np.arange(1,len(scores)+1)
+    if len(scores)==0:
+        print("No docking scores to simulate")
+        sys.exit(1)
+    model = get_model(model_spec,db,hastenids,scores,protocol["random_seed"])
+    dock_iteration = simulate(protocol,scores,model,protocol["random_seed"])
+    cutoffs = hasten_analyze_simulation.score_cutoffs(scores,thresholds)
+    per_iteration = count_docked(scores,dock_iteration,cutoffs)
+    curve = hasten_analyze_simulation.recall_curve(per_iteration,cutoffs,len(scores))
+    return cutoffs,curve,len(scores)
+
+if __name__ == "__main__":
+    args = parse_cmd_line()
+    if (not files_exist(args)): sys.exit(1)
+    protocol = hasten.get_protocol(args.protocol,check_files=False)
+    cutoffs,curve,number_of_mols = run_fast_simulation(protocol,args.database,args.dock,args.model,args.thresholds)
+    print()
+    hasten_analyze_simulation.print_recall_table(cutoffs,curve,args.budgets,number_of_mols)
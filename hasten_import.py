@@ -36,7 +36,11 @@ import argparse
 import os
 import sys
 import csv
-import sqlite3
+
+import hasten_db
+import hasten_library
+import hasten_memory
+import hasten_status
 
 def parse_cmd_line():
     """
@@ -47,6 +51,8 @@ def parse_cmd_line():
     parser = argparse.ArgumentParser(description="Import large SMILES")
     parser.add_argument("-s","--smiles",required=True,type=str,help="SMILES input file")
     parser.add_argument("-o","--output",required=True,type=str,help="Output database filename")
+    parser.add_argument("--max-memory",required=False,type=str,help="Memory budget like 16G")
+    parser.add_argument("-l","--library",action="store_true",help="Move SMILES to the library store (<output>.lib)")
     return parser.parse_args()
 
 def files_exist(args):
@@ -67,11 +73,9 @@ def import_db(args):
 
     :param args: Parsed arguments
     """
-    conn=sqlite3.connect(args.output)
+    # tables are created by the schema migrations
+    conn=hasten_db.connect(args.output,create=True)
     c=conn.cursor()
-    c.execute("CREATE TABLE IF NOT EXISTS data (hastenid INTEGER PRIMARY KEY,smiles TEXT,smilesid TEXT,dock_score NUMERIC,dock_iteration INTEGER,pred_score NUMERIC,dataset_status INTEGER)")
-    c.execute("CREATE TABLE IF NOT EXISTS confs (hastenid INTEGER PRIMARY KEY,conf BLOB)")
-    c.execute("CREATE TABLE IF NOT EXISTS poses (hastenid INTEGER PRIMARY KEY,pose BLOB)")
 
     print("Importing data...")
     chunksize=123456
@@ -79,17 +83,26 @@ def import_db(args):
     with open(args.smiles) as smilesfile:
         for row in csv.reader(smilesfile,delimiter=" "):
             to_db.append((row[0],row[1]))
+            if len(to_db)==1000:
+                # chunk size from the size of the first rows
+                chunksize=hasten_memory.rows_for(hasten_memory.row_size(to_db),123456,what="import chunks")
             if len(to_db)>=chunksize:
                 c.executemany("INSERT INTO data(smiles,smilesid) VALUES (?,?)",to_db)
+                hasten_status.add_imported(conn,len(to_db))
                 to_db = []
         conn.commit()
     if len(to_db)>0:
         c.executemany("INSERT INTO data(smiles,smilesid) VALUES (?,?)",to_db)
+        hasten_status.add_imported(conn,len(to_db))
         conn.commit()
-    conn.close()
+    if args.library:
+        print("Moving SMILES to library...")
+        print(hasten_library.build(args.output),"compounds added to",args.output+".lib")
+    hasten_db.close()
     print("hasten_import.py done.")
     
 if __name__ == "__main__":
     args = parse_cmd_line()
     if (not files_exist(args)): sys.exit(1)
+    hasten_memory.configure(None,args.max_memory)
     import_db(args)
@@ -36,7 +36,9 @@ import argparse
 import os
 import sys
 import csv
-import sqlite3
+
+import hasten_db
+import hasten_status
 
 def parse_cmd_line():
     """
@@ -67,55 +69,69 @@ def files_exist(args):
         os.remove(args.output)
     return True
 
-def check_files(mols,docks):
-    """
-    Verify that we have docking score for each SMILES
-
-    :param mols:Dictionary of SMILES
-    :param docks:Dictionar of scores
-    :return:True if the data is OK, false otherwise
-    """
-    for molid in mols:
-        if molid not in docks:
-            return False
-    return True
-
 def import_db(args):
     """
     Process the files and import them to database
 
+    Both files are streamed in chunks. A repeated SMILES ID is imported
+    once (with its last SMILES, at the place it was first seen). The
+    docking scores are stored to "oracle" table (keyed by hastenid) so that
+    simulated docking can join them instead of reading the docking score
+    file again.
+
     :param args: Parsed arguments
     """
-    mols = {}
-    docks = {}
+    # HASTEN tables are created by the schema migrations
+    conn=hasten_db.connect(args.output,create=True)
+    c=conn.cursor()
+    c.execute("CREATE TABLE oracle (hastenid INTEGER PRIMARY KEY,score NUMERIC)")
+    c.execute("CREATE TABLE oracle_import (smilesid TEXT PRIMARY KEY,score NUMERIC)")
+    c.execute("CREATE TABLE smiles_import (smilesid TEXT PRIMARY KEY,position INTEGER,smiles TEXT)")
+
+    chunksize=123456
+    sqlstr = "INSERT INTO smiles_import(position,smiles,smilesid) VALUES (?,?,?) ON CONFLICT(smilesid) DO UPDATE SET smiles=excluded.smiles"
+    to_db = []
     with open(args.smiles) as smilesfile:
-        for row in csv.reader(smilesfile,delimiter=" "):
-            mols[row[1]] = row[0]
+        for position,row in enumerate(csv.reader(smilesfile,delimiter=" ")):
+            to_db.append((position,row[0],row[1]))
+            if len(to_db)>=chunksize:
+                c.executemany(sqlstr,to_db)
+                to_db = []
+    if len(to_db)>0:
+        c.executemany(sqlstr,to_db)
+    c.execute("INSERT INTO data(smiles,smilesid) SELECT smiles,smilesid FROM smiles_import ORDER BY position")
+    hasten_status.add_imported(conn,c.execute("SELECT COUNT(*) FROM smiles_import").fetchone()[0])
+    c.execute("DROP TABLE smiles_import")
+    to_db = []
     with open(args.dock) as dockfile:
         for row in csv.reader(dockfile,delimiter=" "):
             try:
-                docks[row[1]] = float(row[0])
-            except:
+                to_db.append((row[1],float(row[0])))
+            except (ValueError,IndexError):
                 print("Invalid numeric value in docking scores:",row)
+                hasten_db.close()
+                os.remove(args.output)
                 sys.exit(1)
-    if len(mols)!=len(docks) or not check_files(mols,docks):
+            if len(to_db)>=chunksize:
+                c.executemany("INSERT OR REPLACE INTO oracle_import(smilesid,score) VALUES (?,?)",to_db)
+                to_db = []
+    if len(to_db)>0:
+        c.executemany("INSERT OR REPLACE INTO oracle_import(smilesid,score) VALUES (?,?)",to_db)
+    conn.commit()
+
+    # verify that we have docking score for each SMILES
+    mols=c.execute("SELECT COUNT(*) FROM data").fetchone()[0]
+    docks=c.execute("SELECT COUNT(*) FROM oracle_import").fetchone()[0]
+    missing=c.execute("SELECT COUNT(*) FROM data LEFT JOIN oracle_import ON oracle_import.smilesid=data.smilesid WHERE oracle_import.smilesid IS NULL").fetchone()[0]
+    if mols!=docks or missing>0:
         print("Error: SMILES and docking scores do not match")
+        hasten_db.close()
+        os.remove(args.output)
         sys.exit(1)
-    try:
-        conn=sqlite3.connect(args.output)
-    except error in e:
-        print("Error while creating database",e)
-    finally:
-        if conn:
-            c=conn.cursor()
-            c.execute("CREATE TABLE data (hastenid INTEGER PRIMARY KEY,smiles TEXT,smilesid TEXT,dock_score NUMERIC,dock_iteration INTEGER,pred_score NUMERIC,dataset_status INTEGER)")
-            c.execute("CREATE TABLE confs (hastenid INTEGER PRIMARY KEY,conf BLOB)")
-            c.execute("CREATE TABLE poses (hastenid INTEGER PRIMARY KEY,pose BLOB)")
-            to_db = []
-            for molname in mols: to_db.append((mols[molname],molname))
-            c.executemany("INSERT INTO data(smiles,smilesid) VALUES (?,?)",to_db)
-            conn.commit()
-            conn.close()
+    c.execute("INSERT INTO oracle(hastenid,score) SELECT data.hastenid,oracle_import.score FROM data INNER JOIN oracle_import ON oracle_import.smilesid=data.smilesid")
+    c.execute("DROP TABLE oracle_import")
+    conn.commit()
+    hasten_db.close()
     
 if __name__ == "__main__":
     args = parse_cmd_line()
@@ -0,0 +1,274 @@
+# 
+# Copyright (c) 2021 Orion Corporation
+# 
+# Redistribution and use in source and binary forms, with or without 
+# modification, are permitted provided that the following conditions are met:
+# 
+# 1. Redistributions of source code must retain the above copyright notice, 
+# this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice, 
+# this list of conditions and the following disclaimer in the documentation 
+# and/or other materials provided with the distribution.
+# 3. Neither the name of the copyright holder nor the names of its contributors
+# may be used to endorse or promote products derived from this software 
+# without specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" 
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE 
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE 
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE 
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR 
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF 
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS 
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN 
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) 
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE 
+# POSSIBILITY OF SUCH DAMAGE.
+# 
+"""
+HASTEN result ingest
+
+Shared by the docking wrappers. Results are streamed in as (hastenid,
+score, iteration, pose) records and written in bounded transactions. The
+best score of each compound is kept on the fly and score, iteration and
+pose are written in the same pass.
+
+Example:
+
+    with hasten_ingest.DockIngest(db) as ingest:
+        for ...:
+            ingest.add(hastenid,score,iteration,pose)
+
+Predictions and conformers are written with write_predictions() and
+write_confs(), compounds dropped by a docking cascade stage are marked with
+write_dropped(). If the writer service (hasten_dbwriter.py) runs for the
+database, all writes go through it, otherwise they are written directly.
+"""
+import hasten_db
+import hasten_dbwriter
+import hasten_dedup
+import hasten_leaderboard
+import hasten_status
+
+# dataset_status of compounds dropped by a docking cascade stage: they are
+# not docked (their stage scores are in stage_scores table) and they are
+# not predicted or picked again
+CASCADE_DROPPED = 1
+
+def write_dock_batch(conn,batch,stage=None,leaderboard_size=None):
+    """
+    Write batch of docking results. The caller commits.
+
+    :param conn: SQLite3 connection
+    :param batch: dictionary hastenid -> (score,iteration,pose)
+    :param stage: docking cascade stage (None for the final docking)
+    :param leaderboard_size: size of dock leaderboard (None: from database)
+    :return: number of compounds whose score was written
+    """
+    c = conn.cursor()
+    if stage is not None:
+        c.executemany("INSERT INTO stage_scores(hastenid,stage,score,iteration) VALUES (?,?,?,?) ON CONFLICT(hastenid,stage) DO UPDATE SET score=excluded.score,iteration=excluded.iteration WHERE stage_scores.iteration IS NOT excluded.iteration OR stage_scores.score>excluded.score",[(hastenid,stage,score,iteration) for hastenid,(score,iteration,pose) in batch.items()])
+        return len(batch)
+    if leaderboard_size is None:
+        leaderboard_size = hasten_leaderboard.get_leaderboard_size(conn,"dock")
+        if leaderboard_size is None:
+            leaderboard_size = hasten_leaderboard.DEFAULT_SIZE
+    # compounds with identical SMILES get the same result
+    batch = hasten_dedup.fan_out_docking(conn,batch)
+    improved = []
+    for hastenid,(score,iteration,pose) in batch.items():
+        # results of earlier batches of the same iteration are only
+        # replaced by a better score
+        c.execute("UPDATE data SET dock_score = ?, dock_iteration = ? WHERE hastenid = ? AND (dock_score IS NULL OR dock_iteration IS NOT ? OR dock_score > ?)",[score,iteration,hastenid,iteration,score])
+        if c.rowcount>0:
+            improved.append((score,hastenid))
+            if pose is not None:
+                c.execute("REPLACE INTO poses(hastenid,pose) VALUES (?,?)",[hastenid,pose])
+            else:
+                c.execute("DELETE FROM poses WHERE hastenid = ?",[hastenid,])
+    hasten_leaderboard.update_leaderboard(conn,"dock",improved,leaderboard_size)
+    hasten_leaderboard.remove_from_leaderboard(conn,"pred",[hastenid for score,hastenid in improved])
+    return len(improved)
+
+def write_dropped_batch(conn,hastenids):
+    """
+    Mark compounds dropped by a docking cascade stage (with the undocked
+    compounds of their groups). The caller commits.
+
+    :param conn: SQLite3 connection
+    :param hastenids: list of hastenids
+    :return: number of compounds
+    """
+    members = hasten_dedup.undocked_members(conn,hastenids) if hasten_dedup.has_groups(conn) else {}
+    hastenids = list(hastenids)+[member for group in members.values() for member in group]
+    c = conn.cursor()
+    c.executemany("UPDATE data SET dataset_status = ?, pred_score = NULL, pred_std = NULL WHERE hastenid = ? AND dock_score IS NULL AND dataset_status IS NOT ?",[(CASCADE_DROPPED,hastenid,CASCADE_DROPPED) for hastenid in hastenids])
+    hasten_status.add_dropped(conn,c.rowcount)
+    hasten_leaderboard.remove_from_leaderboard(conn,"pred",hastenids)
+    return len(hastenids)
+
+def write_pred_batch(conn,pred_scores,leaderboard_size,update_scores=True):
+    """
+    Write predicted scores. The caller commits.
+
+    :param conn: SQLite3 connection
+    :param pred_scores: list of (score,std,hastenid) tuples
+    :param leaderboard_size: size of pred leaderboard
+    :param update_scores: write pred_score column (False with prediction store)
+    :return: number of predictions
+    """
+    if update_scores:
+        conn.executemany("UPDATE data SET pred_score = ?, pred_std = ? WHERE hastenid = ?",pred_scores)
+    hasten_status.add_predictions(conn,pred_scores)
+    hasten_leaderboard.update_leaderboard(conn,"pred",[(score,hastenid) for score,std,hastenid in pred_scores],leaderboard_size)
+    return len(pred_scores)
+
+def write_confs_batch(conn,confs):
+    """
+    Write conformers. The caller commits.
+
+    :param conn: SQLite3 connection
+    :param confs: list of (hastenid,conf) tuples
+    :return: number of conformers
+    """
+    conn.executemany("REPLACE INTO confs(hastenid,conf) VALUES (?,?)",confs)
+    return len(confs)
+
+def write_predictions(db,pred_scores,leaderboard_size,update_scores=True):
+    """
+    Write predicted scores in one transaction (through writer service if
+    it runs)
+
+    :param db: The filename of SQlite3 database
+    :param pred_scores: list of (score,std,hastenid) tuples
+    :param leaderboard_size: size of pred leaderboard
+    :param update_scores: write pred_score column (False with prediction store)
+    """
+    writer = hasten_dbwriter.connect_writer(db)
+    if writer is not None:
+        writer.request("pred",pred_scores,leaderboard_size,update_scores)
+        writer.close()
+        return
+    conn = hasten_db.connect(db)
+    hasten_db.begin_write(conn)
+    write_pred_batch(conn,pred_scores,leaderboard_size,update_scores)
+    conn.commit()
+
+def write_dropped(db,hastenids):
+    """
+    Mark compounds dropped by a docking cascade stage in one transaction
+    (through writer service if it runs)
+
+    :param db: The filename of SQlite3 database
+    :param hastenids: list of hastenids
+    """
+    writer = hasten_dbwriter.connect_writer(db)
+    if writer is not None:
+        writer.request("dropped",hastenids)
+        writer.close()
+        return
+    conn = hasten_db.connect(db)
+    hasten_db.begin_write(conn)
+    write_dropped_batch(conn,hastenids)
+    conn.commit()
+
+def write_confs(db,confs):
+    """
+    Write conformers in one transaction (through writer service if it runs)
+
+    :param db: The filename of SQlite3 database
+    :param confs: list of (hastenid,conf) tuples
+    """
+    writer = hasten_dbwriter.connect_writer(db)
+    if writer is not None:
+        writer.request("confs",confs)
+        writer.close()
+        return
+    conn = hasten_db.connect(db)
+    hasten_db.begin_write(conn)
+    write_confs_batch(conn,confs)
+    conn.commit()
+
+class DockIngest:
+    """
+    Batched writer of docking results
+    """
+    def __init__(self,db,batch_size=10000,stage=None):
+        """
+        :param db: The filename of SQlite3 database
+        :param batch_size: number of compounds written per transaction
+        :param stage: docking cascade stage (None for the final docking). The
+                      scores of the earlier stages go to stage_scores table
+                      and their poses are not stored.
+        """
+        self.writer = hasten_dbwriter.connect_writer(db)
+        self.conn = hasten_db.connect(db) if self.writer is None else None
+        self.batch_size = batch_size
+        self.stage = stage
+        self.batch = {}
+        self.written = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,exc_type,exc_value,traceback):
+        # on error the unwritten batch is dropped, the connection is shared
+        # with the caller so its transaction is not rolled back
+        if exc_type is None:
+            self.close()
+        elif self.writer is not None:
+            self.writer.close()
+
+    def add(self,hastenid,score,iteration,pose=None):
+        """
+        Add docking result. If the compound has several results (for
+        example, tautomers) only the best one is kept.
+
+        :param hastenid: hastenid of the compound
+        :param score: docking score
+        :param iteration: iteration integer (or None if not known)
+        :param pose: pose as bytes or text (or None)
+        """
+        hastenid = int(hastenid)
+        if hastenid in self.batch and self.batch[hastenid][0]<=score:
+            return
+        if isinstance(pose,str):
+            pose = bytes(pose,encoding="utf-8")
+        self.batch[hastenid] = (score,iteration,pose)
+        if len(self.batch)>=self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Write the current batch in one transaction
+        """
+        if len(self.batch)==0:
+            return
+        if self.writer is not None:
+            self.written += self.writer.request("dock",self.batch,self.stage)
+        else:
+            # a failed batch is rolled back without touching other work
+            # on the (pooled) connection
+            hasten_db.begin_write(self.conn)
+            self.conn.execute("SAVEPOINT dock_ingest")
+            try:
+                written = write_dock_batch(self.conn,self.batch,self.stage)
+            except:
+                self.conn.execute("ROLLBACK TO dock_ingest")
+                self.conn.execute("RELEASE dock_ingest")
+                raise
+            self.conn.execute("RELEASE dock_ingest")
+            self.conn.commit()
+            self.written += written
+        self.batch = {}
+
+    def close(self):
+        """
+        Write the rest
+
+        :return: number of compounds whose score was written
+        """
+        self.flush()
+        if self.writer is not None:
+            self.writer.close()
+        return self.written
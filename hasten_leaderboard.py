@@ -0,0 +1,126 @@
+# 
+# Copyright (c) 2021 Orion Corporation
+# 
+# Redistribution and use in source and binary forms, with or without 
+# modification, are permitted provided that the following conditions are met:
+# 
+# 1. Redistributions of source code must retain the above copyright notice, 
+# this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice, 
+# this list of conditions and the following disclaimer in the documentation 
+# and/or other materials provided with the distribution.
+# 3. Neither the name of the copyright holder nor the names of its contributors
+# may be used to endorse or promote products derived from this software 
+# without specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" 
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE 
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE 
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE 
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR 
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF 
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS 
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN 
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) 
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE 
+# POSSIBILITY OF SUCH DAMAGE.
+# 
+"""
+HASTEN leaderboard
+
+Keeps bounded top-N tables of the best docked ("dock") and predicted
+("pred") compounds up to date, so that the best hits can be exported
+without scanning the whole database. The tables are created by the schema
+migrations of hasten_db.py.
+"""
+
+# size used if not defined in protocol
+DEFAULT_SIZE = 100000
+def leaderboard_exists(conn):
+    """
+    Check if the database has leaderboard
+
+    :param conn: SQLite3 connection
+    :return: True if leaderboard tables exist
+    """
+    return conn.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='leaderboard'").fetchone() is not None
+
+def get_leaderboard_size(conn,kind):
+    """
+    Get the maximum size of leaderboard
+
+    :param conn: SQLite3 connection
+    :param kind: "dock" or "pred"
+    :return: size or None if the leaderboard has not been filled
+    """
+    if not leaderboard_exists(conn):
+        return None
+    row = conn.execute("SELECT size FROM leaderboard_size WHERE kind=?",[kind,]).fetchone()
+    if row is None:
+        return None
+    return row[0]
+
+def update_leaderboard(conn,kind,scores,size):
+    """
+    Add scores to leaderboard and drop those that fall out of top N. The
+    caller commits.
+
+    :param conn: SQLite3 connection
+    :param kind: "dock" or "pred"
+    :param scores: list of (score,hastenid) tuples
+    :param size: maximum number of compounds kept
+    """
+    c = conn.cursor()
+    c.execute("REPLACE INTO leaderboard_size(kind,size) VALUES (?,?)",[kind,size])
+    # skip the scores that would be dropped anyway
+    worst = c.execute("SELECT score FROM leaderboard WHERE kind=? ORDER BY score LIMIT 1 OFFSET ?",[kind,size-1]).fetchone()
+    if worst is not None:
+        scores = [score for score in scores if score[0] is not None and score[0]<worst[0]]
+    else:
+        scores = [score for score in scores if score[0] is not None]
+    if len(scores)==0:
+        return
+    c.executemany("REPLACE INTO leaderboard(kind,hastenid,score) VALUES ('"+kind+"',?,?)",[(hastenid,score) for score,hastenid in scores])
+    c.execute("DELETE FROM leaderboard WHERE kind=? AND hastenid IN (SELECT hastenid FROM leaderboard WHERE kind=? ORDER BY score LIMIT -1 OFFSET ?)",[kind,kind,size])
+
+def remove_from_leaderboard(conn,kind,hastenids):
+    """
+    Remove compounds from leaderboard (docked compounds from "pred"). The
+    caller commits.
+
+    :param conn: SQLite3 connection
+    :param kind: "dock" or "pred"
+    :param hastenids: list of hastenids
+    """
+    if not leaderboard_exists(conn):
+        return
+    conn.executemany("DELETE FROM leaderboard WHERE kind='"+kind+"' AND hastenid=?",[(hastenid,) for hastenid in hastenids])
+
+def reset_leaderboard(conn,kind):
+    """
+    Empty leaderboard (predictions of the previous iteration). The caller
+    commits.
+
+    :param conn: SQLite3 connection
+    :param kind: "dock" or "pred"
+    """
+    if leaderboard_exists(conn):
+        conn.execute("DELETE FROM leaderboard WHERE kind=?",[kind,])
+
+def rebuild_leaderboard(conn,kind,size):
+    """
+    Fill leaderboard from scratch with a full scan of the database (for
+    databases created before the leaderboard existed)
+
+    :param conn: SQLite3 connection
+    :param kind: "dock" or "pred"
+    :param size: maximum number of compounds kept
+    """
+    reset_leaderboard(conn,kind)
+    if kind=="dock":
+        sqlstr="INSERT INTO leaderboard(kind,hastenid,score) SELECT 'dock',hastenid,dock_score FROM data WHERE dock_score IS NOT NULL ORDER BY dock_score LIMIT ?"
+    else:
+        sqlstr="INSERT INTO leaderboard(kind,hastenid,score) SELECT 'pred',hastenid,pred_score FROM data WHERE dock_score IS NULL AND pred_score IS NOT NULL ORDER BY pred_score LIMIT ?"
+    conn.execute(sqlstr,[size,])
+    conn.execute("REPLACE INTO leaderboard_size(kind,size) VALUES (?,?)",[kind,size])
+    conn.commit()
@@ -0,0 +1,281 @@
+# 
+# Copyright (c) 2021 Orion Corporation
+# 
+# Redistribution and use in source and binary forms, with or without 
+# modification, are permitted provided that the following conditions are met:
+# 
+# 1. Redistributions of source code must retain the above copyright notice, 
+# this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice, 
+# this list of conditions and the following disclaimer in the documentation 
+# and/or other materials provided with the distribution.
+# 3. Neither the name of the copyright holder nor the names of its contributors
+# may be used to endorse or promote products derived from this software 
+# without specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" 
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE 
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE 
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE 
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR 
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF 
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS 
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN 
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) 
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE 
+# POSSIBILITY OF SUCH DAMAGE.
+# 
+"""
+HASTEN compound library store
+
+Optional read-only store for the SMILES and smilesids, which never change
+after the import but make up most of the data table:
+
+    python hasten_library.py -m screen.db
+
+moves the text columns of the imported compounds to "<database>.lib"
+(zlib-compressed blocks of compounds in hastenid order) and
+"<database>.lib.idx" (first and last hastenid, offset and length of each
+block), and leaves only the scores to SQLite. Run it after each import
+(or use hasten_import.py --library). The file is memory-mapped and the
+compounds are found with a binary search over the block index. The full
+passes (prediction, training and export) read the compounds in chunks in
+hastenid order, so each block is read and uncompressed once.
+"""
+import argparse
+import os
+import sys
+import mmap
+import zlib
+import array
+import bisect
+import collections
+
+import hasten_db
+
+MAGIC = b"HASTENLIB1\n"
+# first hastenid, last hastenid, offset and length of each block
+ENTRY = 4
+
+def parse_cmd_line():
+    """
+    Parse command line using ArgumentParser
+
+    :return: parsed arguments
+    """
+    parser = argparse.ArgumentParser(description="Move SMILES of HASTEN database to a library store")
+    parser.add_argument("-m","--database",required=True,type=str,help="HASTEN database")
+    parser.add_argument("-b","--block-size",required=False,type=int,default=4096,help="Compounds per compressed block (default: 4096)")
+    parser.add_argument("--vacuum",action="store_true",help="Shrink the database file afterwards (slow)")
+    return parser.parse_args()
+
+def files_exist(args):
+    """
+    Check if input files exist
+
+    :param args: parsed arguments
+    :return: True if files exist, false otherwise
+    """
+    if not os.path.exists(args.database):
+        print("HASTEN database file missing!")
+        return False
+    return True
+
+class Library:
+    """
+    Memory-mapped library of (hastenid,smiles,smilesid)
+    """
+    def __init__(self,db,cache_blocks=8):
+        """
+        :param db: The filename of SQlite3 database
+        :param cache_blocks: number of uncompressed blocks kept for lookups
+        """
+        self.path = db+".lib"
+        self.index_path = self.path+".idx"
+        self.cache_blocks = cache_blocks
+        self.cache = collections.OrderedDict()
+        self.load()
+
+    def load(self):
+        """
+        (Re)read the block index and map the library file
+        """
+        self.index = array.array("q")
+        with open(self.index_path,"rb") as index_file:
+            self.index.frombytes(index_file.read())
+        self.index_size = len(self.index)*self.index.itemsize
+        self.firsts = self.index[0::ENTRY]
+        with open(self.path,"rb") as library_file:
+            self.map = mmap.mmap(library_file.fileno(),0,access=mmap.ACCESS_READ)
+        if self.map[:len(MAGIC)]!=MAGIC:
+            print("Invalid library file:",self.path)
+            sys.exit(1)
+        self.cache.clear()
+
+    def blocks(self):
+        """
+        :return: number of blocks
+        """
+        return len(self.firsts)
+
+    def last_hastenid(self):
+        """
+        :return: the largest hastenid in the library (0 when empty)
+        """
+        return self.index[-3] if len(self.index)>0 else 0
+
+    def read_block(self,number):
+        """
+        Uncompress a block
+
+        :param number: block number
+        :return: list of (hastenid,smiles,smilesid) tuples
+        """
+        offset,length = self.index[number*ENTRY+2],self.index[number*ENTRY+3]
+        records = []
+        for line in zlib.decompress(self.map[offset:offset+length]).decode().split("\n"):
+            hastenid,smiles,smilesid = line.split("\t")
+            records.append((int(hastenid),smiles,smilesid))
+        return records
+
+    def block(self,number):
+        """
+        Uncompressed block from the cache
+
+        :param number: block number
+        :return: dictionary hastenid -> (smiles,smilesid)
+        """
+        if number in self.cache:
+            self.cache.move_to_end(number)
+        else:
+            self.cache[number] = dict((hastenid,(smiles,smilesid)) for hastenid,smiles,smilesid in self.read_block(number))
+            if len(self.cache)>self.cache_blocks:
+                self.cache.popitem(last=False)
+        return self.cache[number]
+
+    def get(self,hastenids):
+        """
+        Random access to compounds. The hastenids are looked up in order, so
+        each block is uncompressed once.
+
+        :param hastenids: list of hastenids
+        :return: dictionary hastenid -> (smiles,smilesid) of the found ones
+        """
+        text = {}
+        for hastenid in sorted(hastenids):
+            number = bisect.bisect_right(self.firsts,hastenid)-1
+            if number<0 or hastenid>self.index[number*ENTRY+1]:
+                continue
+            record = self.block(number).get(hastenid)
+            if record is not None:
+                text[hastenid] = record
+        return text
+
+_libraries = {}
+
+def open_library(db):
+    """
+    Open the library of the database (shared within the process)
+
+    :param db: The filename of SQlite3 database
+    :return: Library or None if the database has no library
+    """
+    if not os.path.exists(db+".lib.idx"):
+        # target databases share the library of the imported database
+        db = hasten_db.library_db(db)
+        if db is None or not os.path.exists(db+".lib.idx"):
+            return None
+    key = os.path.abspath(db)
+    library = _libraries.get(key)
+    if library is None:
+        library = _libraries[key] = Library(db)
+    elif os.path.getsize(library.index_path)!=library.index_size:
+        # more compounds were added
+        library.load()
+    return library
+
+def fill_text(db,rows,hastenid_column,smiles_column=None,smilesid_column=None):
+    """
+    Fill the SMILES and smilesids that were moved from the data table to
+    the library
+
+    :param db: The filename of SQlite3 database
+    :param rows: list of result rows
+    :param hastenid_column: position of hastenid in the rows
+    :param smiles_column: position of SMILES in the rows (None: not used)
+    :param smilesid_column: position of smilesid in the rows (None: not used)
+    :return: list of rows
+    """
+    columns = [column for column in [smiles_column,smilesid_column] if column is not None]
+    missing = [row[hastenid_column] for row in rows if any(row[column] is None for column in columns)]
+    if len(missing)==0:
+        return rows
+    library = open_library(db)
+    if library is None:
+        return rows
+    text = library.get(missing)
+    filled = []
+    for row in rows:
+        record = text.get(row[hastenid_column])
+        if record is not None:
+            row = list(row)
+            if smiles_column is not None: row[smiles_column] = record[0]
+            if smilesid_column is not None: row[smilesid_column] = record[1]
+            row = tuple(row)
+        filled.append(row)
+    return filled
+
+def build(db,block_size=4096):
+    """
+    Append the compounds that still have their text in the data table to
+    the library and clear the text columns. Only compounds after the last
+    one of the library are taken, so run this after each import.
+
+    :param db: The filename of SQlite3 database
+    :param block_size: compounds per compressed block
+    :return: number of compounds added
+    """
+    library_path = db+".lib"
+    index_path = library_path+".idx"
+    if not os.path.exists(index_path):
+        with open(library_path,"wb") as library_file:
+            library_file.write(MAGIC)
+        open(index_path,"wb").close()
+    library = open_library(db)
+    last = library.last_hastenid()
+    conn = hasten_db.connect(db)
+    sqlstr = "SELECT hastenid,smiles,smilesid FROM data WHERE hastenid > ? AND smiles IS NOT NULL ORDER BY hastenid LIMIT ?"
+    added = 0
+    first = last
+    with open(library_path,"ab") as library_file,open(index_path,"ab") as index_file:
+        rows = conn.execute(sqlstr,[last,block_size]).fetchall()
+        while len(rows)>0:
+            data = zlib.compress("\n".join(str(hastenid)+"\t"+smiles+"\t"+str(smilesid) for hastenid,smiles,smilesid in rows).encode())
+            index_file.write(array.array("q",[rows[0][0],rows[-1][0],library_file.tell(),len(data)]).tobytes())
+            library_file.write(data)
+            added += len(rows)
+            last = rows[-1][0]
+            if added%(block_size*100)==0:
+                print(added,"compounds written to",library_path)
+            rows = conn.execute(sqlstr,[last,block_size]).fetchall()
+        # the text is removed from the database only when the blocks are on disk
+        library_file.flush()
+        os.fsync(library_file.fileno())
+        index_file.flush()
+        os.fsync(index_file.fileno())
+    conn.execute("UPDATE data SET smiles=NULL,smilesid=NULL WHERE hastenid > ? AND hastenid <= ?",[first,last])
+    conn.commit()
+    return added
+
+if __name__ == "__main__":
+    args = parse_cmd_line()
+    if (not files_exist(args)): sys.exit(1)
+    print("Moving SMILES to library...")
+    added = build(args.database,args.block_size)
+    print(added,"compounds added to",args.database+".lib")
+    if args.vacuum:
+        print("Vacuuming database...")
+        hasten_db.close()
+        conn = hasten_db.connect(args.database)
+        conn.execute("VACUUM")
+    hasten_db.close()
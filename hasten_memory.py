@@ -0,0 +1,173 @@
+# 
+# Copyright (c) 2021 Orion Corporation
+# 
+# Redistribution and use in source and binary forms, with or without 
+# modification, are permitted provided that the following conditions are met:
+# 
+# 1. Redistributions of source code must retain the above copyright notice, 
+# this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice, 
+# this list of conditions and the following disclaimer in the documentation 
+# and/or other materials provided with the distribution.
+# 3. Neither the name of the copyright holder nor the names of its contributors
+# may be used to endorse or promote products derived from this software 
+# without specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" 
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE 
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE 
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE 
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR 
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF 
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS 
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN 
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) 
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE 
+# POSSIBILITY OF SUCH DAMAGE.
+# 
+"""
+HASTEN memory budget
+
+With "memory_budget" in the protocol (or --max-memory) the stages size
+their database fetches, writes and chunks from the measured size of the
+rows, so that HASTEN stays within the budget on shared nodes, and stop
+with a message before starting a stage that can not fit. The budget is
+passed to the plug-in scripts (and read by the import and export tools)
+as HASTEN_MEMORY_BUDGET environment variable in bytes.
+"""
+import os
+import sys
+
+# fraction of the budget one buffer (fetched rows, a chunk) may take
+SHARE = 0.25
+# below this HASTEN itself does not run
+MINIMUM = 64<<20
+UNITS = {"K":1<<10,"M":1<<20,"G":1<<30,"T":1<<40}
+
+BUDGET = None
+
+def parse_size(text):
+    """
+    Parse memory size like 512M, 16G or plain bytes
+
+    :param text: size as text
+    :return: size in bytes
+    """
+    text = str(text).strip().upper().rstrip("B")
+    try:
+        if len(text)>0 and text[-1] in UNITS:
+            return int(float(text[:-1])*UNITS[text[-1]])
+        return int(text)
+    except ValueError:
+        print("Invalid memory size:",text)
+        sys.exit(1)
+
+def format_size(size):
+    """
+    :param size: size in bytes
+    :return: human-readable size
+    """
+    for unit in ["T","G","M","K"]:
+        if size>=UNITS[unit]:
+            return str(round(size/UNITS[unit],1))+unit
+    return str(int(size))
+
+def set_budget(size):
+    """
+    Set the budget for this process and the plug-in scripts
+
+    :param size: budget in bytes (None or 0: no budget)
+    """
+    global BUDGET
+    if size is None or size==0:
+        BUDGET = None
+        return
+    if size<MINIMUM:
+        print("Memory budget",format_size(size),"is too small, at least",format_size(MINIMUM),"is needed")
+        sys.exit(1)
+    BUDGET = size
+    os.environ["HASTEN_MEMORY_BUDGET"] = str(size)
+
+def configure(protocol,max_memory=None):
+    """
+    Take the budget from command line (max_memory) or protocol and keep
+    the SQLite page cache within it
+
+    :param protocol: Protocol dictionary (None for tools without protocol)
+    :param max_memory: budget from command line as text, overrides protocol
+    """
+    if max_memory is not None:
+        set_budget(parse_size(max_memory))
+    elif protocol is not None and protocol.get("memory_budget","0")!="0":
+        set_budget(parse_size(protocol["memory_budget"]))
+    if BUDGET is None:
+        return
+    print("Memory budget:",format_size(BUDGET))
+    if protocol is not None and protocol["db_cache_size"]*1024>BUDGET*SHARE:
+        protocol["db_cache_size"] = int(BUDGET*SHARE/1024)
+        print("SQLite page cache limited to",format_size(protocol["db_cache_size"]*1024))
+
+def row_size(rows):
+    """
+    Measure the memory taken by result rows
+
+    :param rows: list of tuples
+    :return: average size of a row in bytes
+    """
+    if len(rows)==0:
+        return 0
+    return sum(sys.getsizeof(row)+sum(sys.getsizeof(item) for item in row) for row in rows)/len(rows)
+
+def rows_for(row_bytes,default,share=SHARE,minimum=1,what="rows"):
+    """
+    Number of rows that fit to a share of the budget
+
+    :param row_bytes: size of a row in bytes
+    :param default: number of rows without budget (the upper limit)
+    :param share: fraction of the budget for these rows
+    :param minimum: the smallest workable number of rows
+    :param what: description for the error message
+    :return: number of rows
+    """
+    if BUDGET is None or row_bytes<=0:
+        return default
+    rows = int(BUDGET*share/row_bytes)
+    if rows<minimum:
+        print("Memory budget",format_size(BUDGET),"is too small for",what,"(",minimum,"rows of",format_size(row_bytes),"are needed)")
+        sys.exit(1)
+    return max(1,min(default,rows))
+
+def check(needed,what,hint=None):
+    """
+    Stop if something does not fit to the budget
+
+    :param needed: bytes needed
+    :param what: description for the error message
+    :param hint: how to make it fit
+    """
+    if BUDGET is not None and needed>BUDGET*(1.0-SHARE):
+        print("Memory budget",format_size(BUDGET),"is too small for",what,"( about",format_size(needed),"is needed)")
+        if hint is not None:
+            print(hint)
+        sys.exit(1)
+
+def fetch_chunks(cursor,default,share=SHARE,what="rows",sample=100):
+    """
+    Read result set in chunks sized by the budget. The first chunk is a
+    small sample, the size of the next chunk is measured from the
+    previous one.
+
+    :param cursor: SQLite3 cursor
+    :param default: rows fetched at a time without budget
+    :param share: fraction of the budget for one chunk
+    :param what: description for the error message
+    :param sample: number of rows in the first chunk
+    :return: generator of lists of rows
+    """
+    rows = cursor.fetchmany(min(sample,default) if BUDGET is not None else default)
+    while len(rows)>0:
+        yield rows
+        rows = cursor.fetchmany(rows_for(row_size(rows[:sample]),default,share,what=what))
+
+if "HASTEN_MEMORY_BUDGET" in os.environ:
+    set_budget(parse_size(os.environ["HASTEN_MEMORY_BUDGET"]))
@@ -0,0 +1,309 @@
+# 
+# Copyright (c) 2021 Orion Corporation
+# 
+# Redistribution and use in source and binary forms, with or without 
+# modification, are permitted provided that the following conditions are met:
+# 
+# 1. Redistributions of source code must retain the above copyright notice, 
+# this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice, 
+# this list of conditions and the following disclaimer in the documentation 
+# and/or other materials provided with the distribution.
+# 3. Neither the name of the copyright holder nor the names of its contributors
+# may be used to endorse or promote products derived from this software 
+# without specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" 
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE 
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE 
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE 
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR 
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF 
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS 
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN 
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) 
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE 
+# POSSIBILITY OF SUCH DAMAGE.
+# 
+"""
+HASTEN planner
+
+Estimates the cost of a screen before running it:
+
+    python hasten_plan.py -m screen.db -p glide.protocol
+
+The protocol and the statistics of the database give the number of
+compounds docked and predicted in each iteration. The speed of HASTEN's
+own steps (picking, exporting compounds for ML, writing the docking
+results and predictions) is measured on a sample of the database, the
+writes go to a scratch database. With --run-plugins N the confgen and
+docking scripts of the protocol are run for N compounds (in a scratch
+database) to measure their speed and the size of the conformers and
+poses. The projected wall time, plugin hours and disk space of each
+iteration are printed. ML training and prediction are not measured and
+not included in the totals.
+"""
+import argparse
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+import hasten
+import hasten_acquisition
+import hasten_db
+import hasten_ingest
+import hasten_library
+import hasten_scratch
+import hasten_status
+import hasten_target
+
+def parse_cmd_line():
+    """
+    Parse command line using ArgumentParser
+
+    :return: parsed arguments
+    """
+    parser = argparse.ArgumentParser(description="Estimate the cost of HASTEN screen")
+    parser.add_argument("-m","--database",required=True,type=str,help="HASTEN database")
+    parser.add_argument("-p","--protocol",required=True,type=str,help="Screening protocol file")
+    parser.add_argument("-t","--target",required=False,type=str,help="Plan a target of the database (see hasten_target.py)")
+    parser.add_argument("-s","--sample",required=False,type=int,default=20000,help="Number of compounds in the benchmarks (default: 20000)")
+    parser.add_argument("--run-plugins",required=False,type=int,default=0,help="Run confgen and docking scripts for this many compounds to time them")
+    return parser.parse_args()
+
+def files_exist(args):
+    """
+    Check if input files exist
+
+    :param args: parsed arguments
+    :return: True if files exist, false otherwise
+    """
+    if not os.path.exists(args.database):
+        print("HASTEN database file missing!")
+        return False
+    if not os.path.exists(args.protocol):
+        print("Screening protocol file missing!")
+        return False
+    return True
+
+def timed(function,*args):
+    """
+    :param function: function to run
+    :return: (seconds,return value)
+    """
+    start = time.perf_counter()
+    result = function(*args)
+    return time.perf_counter()-start,result
+
+def scratch_database(workdir,db,conn,hastenids,with_oracle=False):
+    """
+    Create a database with copies of the compounds
+
+    :param workdir: directory for the database
+    :param db: The filename of SQlite3 database
+    :param conn: SQLite3 connection of the database
+    :param hastenids: list of hastenids to copy
+    :param with_oracle: copy also the oracle scores of simulation database
+    :return: filename of the scratch database
+    """
+    scratch = os.path.join(workdir,"scratch"+str(len(os.listdir(workdir)))+".db")
+    scratch_conn = hasten_db.connect(scratch,create=True)
+    chunk_size = 900
+    for start in range(0,len(hastenids),chunk_size):
+        chunk = hastenids[start:start+chunk_size]
+        marks = ",".join(["?"]*len(chunk))
+        rows = hasten_library.fill_text(db,conn.execute("SELECT hastenid,smiles,smilesid FROM data WHERE hastenid IN ("+marks+")",chunk).fetchall(),0,1,2)
+        scratch_conn.executemany("INSERT INTO data(hastenid,smiles,smilesid) VALUES (?,?,?)",rows)
+        if with_oracle:
+            scratch_conn.execute("CREATE TABLE IF NOT EXISTS oracle (hastenid INTEGER PRIMARY KEY,score NUMERIC)")
+            scratch_conn.executemany("INSERT INTO oracle(hastenid,score) VALUES (?,?)",conn.execute("SELECT hastenid,score FROM oracle WHERE hastenid IN ("+marks+")",chunk).fetchall())
+    hasten_status.add_imported(scratch_conn,len(hastenids))
+    scratch_conn.commit()
+    return scratch
+
+def benchmark(protocol,db,conn,workdir,sample):
+    """
+    Measure the speed of HASTEN's own steps
+
+    :param protocol: Protocol dictionary
+    :param db: The filename of SQlite3 database
+    :param conn: SQLite3 connection
+    :param workdir: directory for scratch files
+    :param sample: number of compounds
+    :return: dictionary of per-compound seconds (and bytes)
+    """
+    speed = {}
+    seconds,hastenids = timed(hasten_acquisition.pick_random,conn,protocol,sample)
+    sample = len(hastenids)
+    if sample==0:
+        print("No undocked compounds in the database")
+        sys.exit(1)
+    speed["random_pick"] = seconds/sample
+    # greedy picking and scratch training read through the table
+    last = conn.execute("SELECT MIN(hastenid) FROM data").fetchone()[0]+sample*10
+    seconds,rows = timed(lambda: conn.execute("SELECT COUNT(pred_score),COUNT(dock_score) FROM data WHERE hastenid <= ?",[last]).fetchone())
+    speed["scan"] = seconds/max(1,conn.execute("SELECT COUNT(*) FROM data WHERE hastenid <= ?",[last]).fetchone()[0])
+    # exporting compounds for ML the way run_ml_pred does
+    filename = os.path.join(workdir,"export.csv")
+    sqlstr = "SELECT smiles,hastenid FROM data WHERE hastenid > ? ORDER BY hastenid LIMIT ?"
+    seconds,rows = timed(lambda: hasten.write_for_ml(hasten_library.fill_text(db,conn.execute(sqlstr,[0,sample]).fetchall(),1,0),with_score=False,filename=filename))
+    speed["export"] = seconds/sample
+    speed["export_bytes"] = os.path.getsize(filename)/sample
+    # writes go to a scratch database
+    scratch = scratch_database(workdir,db,conn,hastenids)
+    scratch_conn = hasten_db.connect(scratch)
+    def ingest_dock():
+        hasten_ingest.write_dock_batch(scratch_conn,dict((hastenid,(-float(hastenid%1000)/100.0,1,None)) for hastenid in hastenids),leaderboard_size=protocol["leaderboard_size"])
+        scratch_conn.commit()
+    def ingest_pred():
+        hasten_ingest.write_pred_batch(scratch_conn,[(-float(hastenid%1000)/100.0,None,hastenid) for hastenid in hastenids],protocol["leaderboard_size"])
+        scratch_conn.commit()
+    speed["pred_ingest"] = timed(ingest_pred)[0]/sample
+    speed["dock_ingest"] = timed(ingest_dock)[0]/sample
+    return speed
+
+def run_plugins(protocol,db,conn,workdir,number):
+    """
+    Time the confgen and docking scripts on a few compounds
+
+    :param protocol: Protocol dictionary
+    :param db: The filename of SQlite3 database
+    :param conn: SQLite3 connection
+    :param workdir: directory for scratch files
+    :param number: number of compounds
+    :return: dictionary of per-compound seconds and bytes
+    """
+    hastenids = hasten_acquisition.pick_random(conn,protocol,number)
+    scratch = scratch_database(workdir,db,conn,hastenids,hasten_db.has_table(conn,"oracle"))
+    speed = {}
+    # one script at a time, so that the time is the script time per compound
+    serial = dict(protocol,confgen_parallel=1,docking_parallel=1)
+    print("Running confgen for",len(hastenids),"compounds...")
+    speed["confgen"] = timed(hasten.run_confgen,serial,scratch,hastenids)[0]/len(hastenids)
+    print("Running docking for",len(hastenids),"compounds...")
+    speed["docking"] = timed(hasten.run_docking,serial,scratch,hastenids,1)[0]/len(hastenids)
+    scratch_conn = hasten_db.connect(scratch)
+    speed["conf_bytes"] = scratch_conn.execute("SELECT IFNULL(AVG(LENGTH(conf)),0) FROM confs").fetchone()[0]
+    speed["pose_bytes"] = scratch_conn.execute("SELECT IFNULL(AVG(LENGTH(pose)),0) FROM poses").fetchone()[0]
+    return speed
+
+def existing_sizes(conn):
+    """
+    Sizes of the conformers and poses already in the database
+
+    :param conn: SQLite3 connection
+    :return: dictionary of average bytes per compound (missing if none)
+    """
+    sizes = {}
+    conf = conn.execute("SELECT AVG(LENGTH(conf)) FROM (SELECT conf FROM confs LIMIT 1000)").fetchone()[0]
+    if conf is not None:
+        sizes["conf_bytes"] = conf
+    pose = conn.execute("SELECT AVG(LENGTH(pose)) FROM (SELECT pose FROM poses LIMIT 1000)").fetchone()[0]
+    if pose is not None:
+        sizes["pose_bytes"] = pose
+    return sizes
+
+def format_time(seconds):
+    """
+    :param seconds: time in seconds
+    :return: human-readable time
+    """
+    if seconds>=86400:
+        return str(round(seconds/86400,1))+"d"
+    if seconds>=3600:
+        return str(round(seconds/3600,1))+"h"
+    if seconds>=60:
+        return str(round(seconds/60,1))+"min"
+    return str(round(seconds,1))+"s"
+
+def format_bytes(size):
+    """
+    :param size: size in bytes
+    :return: human-readable size
+    """
+    for unit,scale in [("T",1<<40),("G",1<<30),("M",1<<20),("K",1<<10)]:
+        if size>=scale:
+            return str(round(size/scale,1))+unit
+    return str(int(size))
+
+def plan(protocol,stats,speed,start_iteration=1):
+    """
+    Print the projected cost of each iteration. The wall time uses the
+    parallel runs of confgen and docking (confgen_parallel and
+    docking_parallel chunks) and the plugin hours are the summed run time
+    of the scripts. ML training and prediction are not included.
+
+    :param protocol: Protocol dictionary
+    :param stats: campaign statistics (see hasten_status.get_stats)
+    :param speed: measured per-compound seconds and bytes
+    :param start_iteration: first iteration to plan
+    """
+    total = stats["total"]
+    docked = stats["docked"]
+    number_to_dock = int(round(protocol["dataset_size"]*total))
+    plugins = "confgen" in speed
+    print("")
+    print("NOTE: ML training and prediction are not included in the times below")
+    print("Iteration\tdocked\tHASTEN\tconfgen\tdocking\twall time\tplugin hours\tdisk")
+    sums = [0.0,0.0,0.0]
+    for iteration in range(start_iteration,protocol["stop_criteria"]+1):
+        undocked = total-docked
+        to_dock = min(number_to_dock,undocked)
+        if iteration==1:
+            own = to_dock*speed["random_pick"]
+        else:
+            # training export and greedy pick scan the table, the
+            # undocked compounds are exported and predictions written
+            training = min(docked,protocol["train_budget"]) if protocol["train_budget"]>0 else docked
+            own = total*speed["scan"]*2+training*speed["export"]+undocked*(speed["export"]+speed["pred_ingest"])
+        own += to_dock*speed["dock_ingest"]
+        disk = to_dock*(speed.get("conf_bytes",0)+speed.get("pose_bytes",0))
+        if plugins:
+            confgen = to_dock*speed["confgen"]
+            docking = to_dock*speed["docking"]
+            # the compounds are split into this many chunks run at once
+            wall = own+confgen/max(1,min(protocol["confgen_parallel"],to_dock))+docking/max(1,min(protocol["docking_parallel"],to_dock))
+            hours = (confgen+docking)/3600
+            columns = [format_time(confgen),format_time(docking),format_time(wall),str(round(hours,1)),format_bytes(disk)]
+            sums[1] += hours
+        else:
+            wall = own
+            columns = ["-","-",format_time(wall),"-",format_bytes(disk) if disk>0 else "-"]
+        sums[0] += wall
+        sums[2] += disk
+        docked += to_dock
+        print(str(iteration)+"\t"+str(docked)+"\t"+format_time(own)+"\t"+"\t".join(columns))
+    print("")
+    print("Total wall time:",format_time(sums[0]),"(HASTEN, confgen and docking, ML training and prediction NOT included)")
+    if plugins:
+        print("Total plugin hours:",round(sums[1],1),"(run time of confgen and docking scripts, multiply by the CPUs one script uses)")
+    else:
+        print("Confgen and docking not measured, use --run-plugins 10 to time them")
+    if sums[2]>0:
+        print("Conformers and poses:",format_bytes(sums[2]))
+    print("Temporary files per prediction round: up to",format_bytes(speed["export_bytes"]*protocol["pred_size"]*protocol["ml_pred_parallel"]*2))
+
+if __name__ == "__main__":
+    args = parse_cmd_line()
+    if (not files_exist(args)): sys.exit(1)
+    if args.target is not None: args.database = hasten_target.get_target_db(args.database,args.target)
+    protocol = hasten.get_protocol(args.protocol)
+    hasten_db.configure(protocol)
+    hasten_scratch.configure(protocol)
+    conn = hasten_db.connect(args.database,readonly=True)
+    stats = hasten_status.get_stats(conn)
+    print("Compounds:",stats["total"],"docked:",stats["docked"])
+    print("Docking",int(round(protocol["dataset_size"]*stats["total"])),"compounds per iteration,",protocol["stop_criteria"],"iterations")
+    workdir = tempfile.mkdtemp(prefix="hasten_plan_",dir=hasten_scratch.DIRECTORY)
+    try:
+        print("Benchmarking with",args.sample,"compounds...")
+        speed = benchmark(protocol,args.database,conn,workdir,args.sample)
+        speed.update(existing_sizes(conn))
+        if args.run_plugins>0:
+            speed.update(run_plugins(protocol,args.database,conn,workdir,args.run_plugins))
+        plan(protocol,stats,speed)
+    finally:
+        hasten_db.close()
+        shutil.rmtree(workdir,ignore_errors=True)
@@ -0,0 +1,314 @@
+# 
+# Copyright (c) 2021 Orion Corporation
+# 
+# Redistribution and use in source and binary forms, with or without 
+# modification, are permitted provided that the following conditions are met:
+# 
+# 1. Redistributions of source code must retain the above copyright notice, 
+# this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice, 
+# this list of conditions and the following disclaimer in the documentation 
+# and/or other materials provided with the distribution.
+# 3. Neither the name of the copyright holder nor the names of its contributors
+# may be used to endorse or promote products derived from this software 
+# without specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" 
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE 
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE 
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE 
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR 
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF 
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS 
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN 
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) 
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE 
+# POSSIBILITY OF SUCH DAMAGE.
+# 
+"""
+HASTEN prediction store
+
+Optional column store for the predicted scores (pred_store=mmap in the
+protocol). The scores of each iteration are kept in a dense array indexed
+by hastenid in a memory-mapped file "<database>.preds/iter<N>.<dtype>"
+(and "iter<N>_std.<dtype>" for the ensemble spread). Writing predictions is
+a fill of the array instead of an UPDATE for every row of the data table,
+and the predictions of earlier iterations stay available. Not predicted
+compounds are NaN. Needs numpy.
+"""
+import os
+import re
+import sys
+import random
+import tempfile
+import numpy as np
+
+import hasten_acquisition
+import hasten_db
+import hasten_library
+
+DTYPES = ["float32","float16"]
+
+class PredictionStore:
+    """
+    Memory-mapped arrays of predicted scores, one per iteration
+    """
+    def __init__(self,db,dtype="float32",block_size=1<<24):
+        """
+        :param db: The filename of SQlite3 database
+        :param dtype: "float32" or "float16"
+        :param block_size: number of scores processed at a time in scans
+        """
+        if dtype not in DTYPES:
+            print("Invalid prediction store data type:",dtype)
+            sys.exit(1)
+        self.path = db+".preds"
+        self.dtype = dtype
+        self.block_size = block_size
+
+    def filename(self,iteration,std=False):
+        return os.path.join(self.path,"iter"+str(iteration)+("_std" if std else "")+"."+self.dtype)
+
+    def iterations(self):
+        """
+        :return: sorted list of iterations in the store
+        """
+        if not os.path.isdir(self.path):
+            return []
+        iterations = []
+        for filename in os.listdir(self.path):
+            m = re.match(r"^iter(\d+)\."+self.dtype+"$",filename)
+            if m:
+                iterations.append(int(m.group(1)))
+        return sorted(iterations)
+
+    def latest_iteration(self):
+        """
+        :return: the latest iteration with predictions or None
+        """
+        iterations = self.iterations()
+        return iterations[-1] if len(iterations)>0 else None
+
+    def create_array(self,filename,size):
+        """
+        Create an empty (NaN) array. The array is written to a temporary
+        file and linked to its name only if it does not exist yet, so an
+        array being filled by another writer is never replaced.
+
+        :param filename: filename of the array
+        :param size: largest hastenid of the database
+        """
+        handle,temporary = tempfile.mkstemp(dir=self.path)
+        os.close(handle)
+        try:
+            scores = np.memmap(temporary,dtype=self.dtype,mode="w+",shape=(size+1,))
+            for start in range(0,len(scores),self.block_size):
+                scores[start:start+self.block_size] = np.nan
+            scores.flush()
+            del scores
+            os.link(temporary,filename)
+        except FileExistsError:
+            pass
+        finally:
+            os.unlink(temporary)
+
+    def create_iteration(self,iteration,size):
+        """
+        Create empty (NaN) score array for an iteration. The array of the
+        ensemble spread is created when the first spreads are written.
+
+        :param iteration: iteration integer
+        :param size: largest hastenid of the database
+        """
+        if not os.path.isdir(self.path):
+            os.mkdir(self.path)
+        for std in [False,True]:
+            if os.path.exists(self.filename(iteration,std)):
+                os.unlink(self.filename(iteration,std))
+        self.create_array(self.filename(iteration),size)
+
+    def open_iteration(self,iteration,std=False,mode="r"):
+        """
+        Open score array of an iteration
+
+        :param iteration: iteration integer
+        :param std: open the ensemble spread instead of scores
+        :param mode: "r" or "r+"
+        :return: numpy memmap
+        """
+        if not os.path.exists(self.filename(iteration,std)):
+            print("No predictions for iteration",iteration,"in",self.path)
+            sys.exit(1)
+        return np.memmap(self.filename(iteration,std),dtype=self.dtype,mode=mode)
+
+    def write(self,iteration,hastenids,scores,stds=None):
+        """
+        Store predictions
+
+        :param iteration: iteration integer
+        :param hastenids: list of hastenids
+        :param scores: list of predicted scores
+        :param stds: list of ensemble spreads (or None, a list of Nones is the same)
+        """
+        hastenids = np.asarray(hastenids,dtype=np.int64)
+        order = np.argsort(hastenids)
+        array = self.open_iteration(iteration,mode="r+")
+        size = len(array)-1
+        array[hastenids[order]] = np.asarray(scores,dtype=np.float64)[order]
+        array.flush()
+        del array
+        if stds is not None and any(std is not None for std in stds):
+            self.create_array(self.filename(iteration,True),size)
+            array = self.open_iteration(iteration,std=True,mode="r+")
+            array[hastenids[order]] = np.asarray([np.nan if std is None else std for std in stds],dtype=np.float64)[order]
+            array.flush()
+            del array
+
+    def best(self,iteration,number,key=None):
+        """
+        Find hastenids with the smallest keys (predicted scores by default)
+        with one sequential pass over the store
+
+        :param iteration: iteration integer
+        :param number: number of compounds wanted
+        :param key: function(scores,stds,start) -> keys for one block
+        :return: numpy array of hastenids ordered by key
+        """
+        scores = self.open_iteration(iteration)
+        stds = self.open_iteration(iteration,std=True) if os.path.exists(self.filename(iteration,True)) else None
+        best_ids = np.zeros(0,dtype=np.int64)
+        best_keys = np.zeros(0,dtype=np.float64)
+        for start in range(0,len(scores),self.block_size):
+            block = np.asarray(scores[start:start+self.block_size],dtype=np.float64)
+            if key is not None:
+                block = key(block,None if stds is None else np.asarray(stds[start:start+self.block_size],dtype=np.float64),start)
+            valid = np.flatnonzero(~np.isnan(block))
+            ids = np.concatenate([best_ids,valid+start])
+            keys = np.concatenate([best_keys,block[valid]])
+            if len(keys)>number:
+                keep = np.argpartition(keys,number-1)[:number]
+                ids,keys = ids[keep],keys[keep]
+            best_ids,best_keys = ids,keys
+        order = np.argsort(best_keys,kind="stable")
+        return best_ids[order]
+
+    def pick(self,conn,protocol,iteration,number_to_dock):
+        """
+        Pick compounds for docking, see pick_from_store()
+        """
+        return pick_from_store(conn,protocol,self,iteration,number_to_dock)
+
+    def below(self,iteration,cutoff):
+        """
+        Find hastenids with predicted score below or at cut off, one block
+        at a time
+
+        :param iteration: iteration integer
+        :param cutoff: score cut off
+        :return: generator of (hastenids,scores) numpy arrays
+        """
+        scores = self.open_iteration(iteration)
+        for start in range(0,len(scores),self.block_size):
+            block = np.asarray(scores[start:start+self.block_size],dtype=np.float64)
+            found = np.flatnonzero(block<=cutoff)
+            if len(found)>0:
+                yield found+start,block[found]
+
+def exists(db):
+    """
+    Check if the database has a prediction store
+
+    :param db: The filename of SQlite3 database
+    :return: data type of the store or None
+    """
+    for dtype in DTYPES:
+        if PredictionStore(db,dtype).latest_iteration() is not None:
+            return dtype
+    return None
+
+def undocked(conn,hastenids,chunk_size=900):
+    """
+    Drop compounds that have been docked (or dropped by a docking cascade
+    stage) after the prediction
+
+    :param conn: SQLite3 connection
+    :param hastenids: hastenids in order
+    :param chunk_size: number of hastenids looked up at a time
+    :return: list of undocked hastenids in the same order
+    """
+    docked = set()
+    hastenids = [int(hastenid) for hastenid in hastenids]
+    for start in range(0,len(hastenids),chunk_size):
+        chunk = hastenids[start:start+chunk_size]
+        docked.update(row[0] for row in conn.execute("SELECT hastenid FROM data WHERE (dock_score IS NOT NULL OR dataset_status IS NOT NULL) AND hastenid IN ("+",".join(["?"]*len(chunk))+")",chunk))
+    return [hastenid for hastenid in hastenids if hastenid not in docked]
+
+def acquisition_key(protocol):
+    """
+    Block key function of the acquisition strategy for PredictionStore.best()
+
+    :param protocol: Protocol dictionary
+    :return: function or None for plain predicted scores
+    """
+    if protocol["acquisition"] in ["greedy","diverse"]:
+        return None
+    if protocol["acquisition"]=="ucb":
+        return lambda scores,stds,start: scores if stds is None else scores-protocol["acquisition_beta"]*np.nan_to_num(stds)
+    if protocol["acquisition"]=="thompson":
+        # random is seeded with random_seed of the protocol in run_hasten
+        rng = np.random.default_rng(random.getrandbits(64))
+        def sample(scores,stds,start):
+            if stds is None:
+                return scores
+            return scores+np.nan_to_num(np.clip(stds,0.0,None))*rng.standard_normal(len(scores))
+        return sample
+    print("Acquisition strategy",protocol["acquisition"],"is not available with pred_store=mmap")
+    sys.exit(1)
+
+def pick_from_store(conn,protocol,store,iteration,number_to_dock):
+    """
+    Pick compounds for docking from the prediction store using the
+    acquisition strategy of the protocol
+
+    :param conn: SQLite3 connection
+    :param protocol: Protocol dictionary
+    :param store: PredictionStore
+    :param iteration: iteration of the predictions
+    :param number_to_dock: number of compounds to pick
+    :return: list of hastenids
+    """
+    key = acquisition_key(protocol)
+    # diverse picking skips compounds, so take more candidates
+    wanted = number_to_dock*(4 if protocol["acquisition"]=="diverse" else 1)
+    margin = max(100,wanted//100)
+    while True:
+        candidates = store.best(iteration,wanted+margin,key)
+        picked = undocked(conn,candidates)
+        if len(picked)>=wanted or len(candidates)<wanted+margin:
+            break
+        margin *= 4
+    if protocol["acquisition"] in ["ucb","thompson"]:
+        stds = store.open_iteration(iteration,std=True) if os.path.exists(store.filename(iteration,True)) else None
+        hasten_acquisition.warn_without_std(protocol["acquisition"],[None]*len(picked) if stds is None else stds[np.asarray(picked[:number_to_dock],dtype=np.int64)].tolist())
+    if protocol["acquisition"]!="diverse":
+        return picked[:number_to_dock]
+    bucket_counts = {}
+    to_dock = []
+    skipped = []
+    chunk_size = 900
+    db = hasten_db.filename(conn)
+    for start in range(0,len(picked),chunk_size):
+        chunk = picked[start:start+chunk_size]
+        smiles = dict(hasten_library.fill_text(db,conn.execute("SELECT hastenid,smiles FROM data WHERE hastenid IN ("+",".join(["?"]*len(chunk))+")",chunk).fetchall(),0,1))
+        for hastenid in chunk:
+            bucket = hasten_acquisition.smiles_bucket(smiles[hastenid])
+            if bucket_counts.get(bucket,0)<protocol["diversity_bucket_size"]:
+                bucket_counts[bucket] = bucket_counts.get(bucket,0)+1
+                to_dock.append(hastenid)
+            else:
+                skipped.append(hastenid)
+        if len(to_dock)>=number_to_dock:
+            break
+    print(len(bucket_counts),"buckets of similar compounds picked")
+    # fill up with the best skipped ones if the candidates ran out
+    return (to_dock+skipped)[:number_to_dock]
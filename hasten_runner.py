@@ -0,0 +1,175 @@
+# 
+# Copyright (c) 2021 Orion Corporation
+# 
+# Redistribution and use in source and binary forms, with or without 
+# modification, are permitted provided that the following conditions are met:
+# 
+# 1. Redistributions of source code must retain the above copyright notice, 
+# this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice, 
+# this list of conditions and the following disclaimer in the documentation 
+# and/or other materials provided with the distribution.
+# 3. Neither the name of the copyright holder nor the names of its contributors
+# may be used to endorse or promote products derived from this software 
+# without specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" 
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE 
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE 
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE 
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR 
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF 
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS 
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN 
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) 
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE 
+# POSSIBILITY OF SUCH DAMAGE.
+# 
+"""
+HASTEN runner
+
+Starts the plug-in scripts (confgen, docking, ML training and prediction)
+as asyncio subprocesses. Each stage has its own limit of parallel runs and
+every run has optional timeout and retries. The output of the scripts is
+printed line by line with the stage name as prefix.
+
+Protocol keywords (all optional):
+
+stage_timeout    -- seconds before a script is killed (0 = no timeout)
+stage_retries    -- how many times a failed script is run again
+<stage>_parallel -- max. parallel runs of confgen, docking and ml_pred, e.g.
+                    ml_pred_parallel=4 (ml_train is one run per iteration)
+"""
+import asyncio
+import os
+import shlex
+import signal
+import sys
+
+STAGES = ["confgen","docking","ml_train","ml_pred"]
+
+class StageRunner:
+    """
+    Runs plug-in scripts with per-stage concurrency limits
+    """
+    def __init__(self,protocol):
+        """
+        :param protocol: Protocol dictionary
+        """
+        self.timeout = protocol.get("stage_timeout",0)
+        self.retries = protocol.get("stage_retries",0)
+        self.limits = {}
+        for stage in STAGES:
+            self.limits[stage] = protocol.get(stage+"_parallel",1)
+        self.semaphores = {}
+
+    def semaphore(self,stage):
+        """
+        Semaphore of a stage (created inside the running event loop)
+
+        :param stage: stage name
+        :return: asyncio.Semaphore
+        """
+        if stage not in self.semaphores:
+            self.semaphores[stage] = asyncio.Semaphore(self.limits.get(stage,1))
+        return self.semaphores[stage]
+
+    async def stream_output(self,stage,stream):
+        """
+        Print output of a script line by line
+
+        :param stage: stage name
+        :param stream: asyncio StreamReader
+        """
+        while True:
+            line = await stream.readline()
+            if len(line)==0:
+                break
+            print("["+stage+"]",line.decode(errors="replace").rstrip("\n"),flush=True)
+
+    async def run_once(self,stage,command):
+        """
+        Run script once
+
+        :param stage: stage name
+        :param command: command line (string)
+        :return: exit code, None if the script timed out
+        """
+        # own session so that the whole process group can be killed
+        process = await asyncio.create_subprocess_shell(command,stdout=asyncio.subprocess.PIPE,stderr=asyncio.subprocess.STDOUT,start_new_session=True)
+        reader = asyncio.ensure_future(self.stream_output(stage,process.stdout))
+        try:
+            await asyncio.wait_for(process.wait(),self.timeout if self.timeout>0 else None)
+        except (asyncio.TimeoutError,asyncio.CancelledError) as e:
+            try:
+                os.killpg(process.pid,signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+            await process.wait()
+            await reader
+            if isinstance(e,asyncio.CancelledError):
+                raise
+            print("["+stage+"] timed out after",self.timeout,"seconds",flush=True)
+            return None
+        await reader
+        return process.returncode
+
+    async def run(self,stage,script,args):
+        """
+        Run script within the limits of its stage, retrying on failure.
+        Exits HASTEN if the script keeps failing.
+
+        :param stage: stage name
+        :param script: script from the protocol (run through shell)
+        :param args: list of parameters
+        """
+        command = script+" "+" ".join([shlex.quote(str(arg)) for arg in args])
+        async with self.semaphore(stage):
+            for attempt in range(self.retries+1):
+                if attempt>0:
+                    print("["+stage+"] retrying (",attempt,"/",self.retries,")",flush=True)
+                returncode = await self.run_once(stage,command)
+                if returncode==0:
+                    return
+                if returncode is not None:
+                    print("["+stage+"] failed with exit code",returncode,flush=True)
+        print("Error: stage",stage,"failed:",command)
+        sys.exit(1)
+
+    async def run_bounded(self,coroutines,limit):
+        """
+        Run coroutines with at most limit of them in flight. The coroutines
+        are created lazily from the iterable, so their inputs are not
+        prepared before there is room for them.
+
+        :param coroutines: iterable of coroutines
+        :param limit: max. number of coroutines running at the same time
+        """
+        pending = set()
+        for coroutine in coroutines:
+            if len(pending)>=max(1,limit):
+                done,pending = await asyncio.wait(pending,return_when=asyncio.FIRST_COMPLETED)
+                for task in done: task.result()
+            pending.add(asyncio.ensure_future(coroutine))
+        for task in asyncio.as_completed(pending):
+            await task
+
+    def execute(self,coroutine):
+        """
+        Run coroutine in a new event loop and wait for it
+
+        :param coroutine: coroutine to run
+        :return: result of the coroutine
+        """
+        self.semaphores = {}
+        return asyncio.run(coroutine)
+
+    def run_sync(self,stage,script,args):
+        """
+        Run one script and wait for it (for the blocking parts of HASTEN)
+
+        :param stage: stage name
+        :param script: script from the protocol
+        :param args: list of parameters
+        """
+        self.execute(self.run(stage,script,args))
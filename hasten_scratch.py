@@ -0,0 +1,171 @@
+# 
+# Copyright (c) 2021 Orion Corporation
+# 
+# Redistribution and use in source and binary forms, with or without 
+# modification, are permitted provided that the following conditions are met:
+# 
+# 1. Redistributions of source code must retain the above copyright notice, 
+# this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice, 
+# this list of conditions and the following disclaimer in the documentation 
+# and/or other materials provided with the distribution.
+# 3. Neither the name of the copyright holder nor the names of its contributors
+# may be used to endorse or promote products derived from this software 
+# without specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" 
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE 
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE 
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE 
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR 
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF 
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS 
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN 
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) 
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE 
+# POSSIBILITY OF SUCH DAMAGE.
+# 
+"""
+HASTEN scratch files
+
+The input files of the plug-in scripts (SMILES for confgen, conformers
+for docking, CSV files for ML) and the prediction outputs are written to
+a scratch directory, by default /tmp. On nodes where /tmp is a small
+RAM disk, give another directory with scratch_dir in the protocol, with
+hasten.py --scratch-dir or with HASTEN_SCRATCH_DIR environment variable
+(which is passed on to the plug-in scripts).
+
+With plugin_io=pipes the inputs are named pipes instead of files: a
+thread writes the compounds from the database to the pipe while the
+script reads it, so the input is never stored as a whole. The script
+must read each input once from the beginning to the end (Glide, for
+example, needs real files). Outputs are always files, they are small.
+
+Scratch files are removed when the step is done, also when it fails.
+"""
+import os
+import sys
+import tempfile
+import threading
+
+DIRECTORY = os.environ.get("HASTEN_SCRATCH_DIR","/tmp")
+PIPES = False
+
+def configure(protocol,scratch_dir=None):
+    """
+    Take the scratch directory from command line or protocol and pass it
+    to the plug-in scripts through environment
+
+    :param protocol: Protocol dictionary
+    :param scratch_dir: directory from command line, overrides protocol
+    """
+    global DIRECTORY,PIPES
+    if scratch_dir is None and protocol.get("scratch_dir","")!="":
+        scratch_dir = protocol["scratch_dir"]
+    if scratch_dir is not None:
+        if not os.path.isdir(scratch_dir) or not os.access(scratch_dir,os.W_OK):
+            print("Scratch directory",scratch_dir,"does not exist or is not writable")
+            sys.exit(1)
+        DIRECTORY = os.path.abspath(scratch_dir)
+        os.environ["HASTEN_SCRATCH_DIR"] = DIRECTORY
+    PIPES = protocol.get("plugin_io","files")=="pipes"
+
+def mkstemp(suffix,prefix="hasten"):
+    """
+    Create an empty scratch file
+
+    :param suffix: filename suffix
+    :param prefix: filename prefix
+    :return: filename
+    """
+    handle,name = tempfile.mkstemp(suffix,prefix,DIRECTORY)
+    os.close(handle)
+    return name
+
+def remove(*names):
+    """
+    Remove scratch files, the ones already removed (by the plug-in script)
+    are skipped
+
+    :param names: filenames
+    """
+    for name in names:
+        try:
+            os.unlink(name)
+        except FileNotFoundError:
+            pass
+
+class Input:
+    """
+    Input of a plug-in script, written by a function to a scratch file or
+    (plugin_io=pipes) streamed through a named pipe. Use as a context
+    manager around the run of the script:
+
+        with hasten_scratch.Input(".smi","hasten_confgen_",write) as smi:
+            runner.run_sync("confgen",script,[smi.name,db])
+
+    The write function gets the open file and must not use a database
+    connection of the caller (it runs in its own thread with pipes).
+    """
+    def __init__(self,suffix,prefix,write,binary=False,pipe=None):
+        """
+        :param suffix: filename suffix
+        :param prefix: filename prefix
+        :param write: function writing the input to an open file
+        :param binary: open the file in binary mode
+        :param pipe: stream through a named pipe (default: plugin_io)
+        """
+        self.write = write
+        self.mode = "wb" if binary else "wt"
+        self.pipe = PIPES if pipe is None else pipe
+        self.name = mkstemp(suffix,prefix)
+        self.thread = None
+        self.error = None
+        if self.pipe:
+            os.unlink(self.name)
+            os.mkfifo(self.name)
+            self.thread = threading.Thread(target=self.feed,daemon=True)
+            self.thread.start()
+        else:
+            try:
+                with open(self.name,self.mode) as w:
+                    write(w)
+            except:
+                remove(self.name)
+                raise
+
+    def feed(self):
+        """
+        Write the input to the named pipe (opening it waits for the reader)
+        """
+        try:
+            with open(self.name,self.mode) as w:
+                self.write(w)
+        except BrokenPipeError:
+            pass
+        except BaseException as e:
+            self.error = e
+
+    def close(self):
+        """
+        Stop the writer if the script did not read the whole input and
+        remove the file
+        """
+        if self.thread is not None and self.thread.is_alive():
+            # a reader lets the writer out of open(), closing it ends the writes
+            try:
+                os.close(os.open(self.name,os.O_RDONLY|os.O_NONBLOCK))
+            except OSError:
+                pass
+            self.thread.join(5)
+        remove(self.name)
+        if self.error is not None:
+            print("Error writing input",self.name,":",self.error)
+            sys.exit(1)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*exc):
+        self.close()
+        return False
@@ -0,0 +1,170 @@
+# 
+# Copyright (c) 2021 Orion Corporation
+# 
+# Redistribution and use in source and binary forms, with or without 
+# modification, are permitted provided that the following conditions are met:
+# 
+# 1. Redistributions of source code must retain the above copyright notice, 
+# this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice, 
+# this list of conditions and the following disclaimer in the documentation 
+# and/or other materials provided with the distribution.
+# 3. Neither the name of the copyright holder nor the names of its contributors
+# may be used to endorse or promote products derived from this software 
+# without specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" 
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE 
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE 
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE 
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR 
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF 
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS 
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN 
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) 
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE 
+# POSSIBILITY OF SUCH DAMAGE.
+# 
+"""
+HASTEN status
+
+Print progress of a HASTEN campaign without scanning the database. The
+numbers come from the stats tables that are kept up to date while
+compounds are imported, docked and predicted.
+"""
+import argparse
+import os
+import sys
+
+import hasten_db
+import hasten_leaderboard
+
+def parse_cmd_line():
+    """
+    Parse command line using ArgumentParser
+
+    :return: parsed arguments
+    """
+    parser = argparse.ArgumentParser(description="Show status of HASTEN database")
+    parser.add_argument("-m","--database",required=True,type=str,help="HASTEN database")
+    parser.add_argument("-t","--target",required=False,type=str,help="Status of a target of the database (see hasten_target.py)")
+    parser.add_argument("--recount",required=False,action="store_true",help="Recalculate the statistics with a full scan of the database")
+    return parser.parse_args()
+
+def files_exist(args):
+    """
+    Check if input files exist
+
+    :param args: parsed arguments
+    :return: True if files exist, false otherwise
+    """
+    if not os.path.exists(args.database):
+        print("HASTEN database file missing!")
+        return False
+    return True
+
+def get_stats(conn):
+    """
+    Get the campaign statistics
+
+    :param conn: SQLite3 connection
+    :return: dictionary with total, docked, dropped, undocked, predicted, best_dock, best_pred and pred_iteration
+    """
+    stats = dict(conn.execute("SELECT key,value FROM stats").fetchall())
+    # compounds dropped by the docking cascade are not docked again
+    stats["undocked"] = stats["total"]-stats["docked"]-stats["dropped"]
+    return stats
+
+def get_iteration_stats(conn):
+    """
+    Get number of docked compounds and the best score per iteration
+
+    :param conn: SQLite3 connection
+    :return: list of (iteration,docked,best score) tuples, iteration -1 is unknown
+    """
+    return conn.execute("SELECT iteration,docked,best_score FROM iteration_stats ORDER BY iteration").fetchall()
+
+def add_imported(conn,count):
+    """
+    Count imported compounds. The caller commits.
+
+    :param conn: SQLite3 connection
+    :param count: number of compounds inserted to data table
+    """
+    conn.execute("UPDATE stats SET value=value+? WHERE key='total'",[count,])
+
+def add_dropped(conn,count):
+    """
+    Count compounds dropped by a docking cascade stage. The caller commits.
+
+    :param conn: SQLite3 connection
+    :param count: number of compounds marked dropped
+    """
+    conn.execute("UPDATE stats SET value=value+? WHERE key='dropped'",[count,])
+
+def reset_predictions(conn,iteration):
+    """
+    Start counting predictions of a new iteration. The caller commits.
+
+    :param conn: SQLite3 connection
+    :param iteration: iteration integer
+    """
+    conn.execute("UPDATE stats SET value=0 WHERE key='predicted'")
+    conn.execute("UPDATE stats SET value=NULL WHERE key='best_pred'")
+    conn.execute("UPDATE stats SET value=? WHERE key='pred_iteration'",[iteration,])
+
+def add_predictions(conn,pred_scores):
+    """
+    Count written predictions. The caller commits.
+
+    :param conn: SQLite3 connection
+    :param pred_scores: list of (score,std,hastenid) tuples
+    """
+    if len(pred_scores)==0:
+        return
+    best = min(score for score,std,hastenid in pred_scores)
+    conn.execute("UPDATE stats SET value=value+? WHERE key='predicted'",[len(pred_scores),])
+    conn.execute("UPDATE stats SET value=? WHERE key='best_pred' AND (value IS NULL OR value>?)",[best,best])
+
+def print_status(conn,db):
+    """
+    Print the campaign status
+
+    :param conn: SQLite3 connection
+    :param db: The filename of SQlite3 database
+    """
+    stats = get_stats(conn)
+    percent = lambda count: str(round(100.0*count/stats["total"],3))+"%" if stats["total"]>0 else "-"
+    print("HASTEN database",db)
+    print("Compounds:",stats["total"])
+    print("Docked:",stats["docked"],"("+percent(stats["docked"])+")")
+    if stats["dropped"]>0:
+        print("Dropped by docking cascade:",stats["dropped"])
+    print("Not docked:",stats["undocked"])
+    if stats["pred_iteration"] is not None:
+        print("Predicted in iteration",str(stats["pred_iteration"])+":",stats["predicted"])
+    print("Best docking score:",stats["best_dock"])
+    print("Best predicted score:",stats["best_pred"])
+    for kind in ["dock","pred"]:
+        size = hasten_leaderboard.get_leaderboard_size(conn,kind)
+        if size is not None:
+            print("Leaderboard",kind+":",conn.execute("SELECT COUNT(*) FROM leaderboard WHERE kind=?",[kind,]).fetchone()[0],"of",size)
+    print()
+    print("Iter\t Docked\t Docked%\t Best")
+    print("-------------------------------------")
+    for iteration,docked,best in get_iteration_stats(conn):
+        print(("NA" if iteration<0 else str(iteration))+"\t "+str(docked)+"\t "+percent(docked)+"\t "+str(best))
+
+if __name__ == "__main__":
+    args = parse_cmd_line()
+    if (not files_exist(args)): sys.exit(1)
+    if args.target is not None:
+        # imported here, hasten_target imports this module
+        import hasten_target
+        args.database = hasten_target.get_target_db(args.database,args.target)
+    conn = hasten_db.connect(args.database)
+    if args.recount:
+        print("Counting statistics from the database...")
+        hasten_db.recount_stats(conn)
+        conn.commit()
+    print_status(conn,args.database)
@@ -0,0 +1,261 @@
+# 
+# Copyright (c) 2021 Orion Corporation
+# 
+# Redistribution and use in source and binary forms, with or without 
+# modification, are permitted provided that the following conditions are met:
+# 
+# 1. Redistributions of source code must retain the above copyright notice, 
+# this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice, 
+# this list of conditions and the following disclaimer in the documentation 
+# and/or other materials provided with the distribution.
+# 3. Neither the name of the copyright holder nor the names of its contributors
+# may be used to endorse or promote products derived from this software 
+# without specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" 
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE 
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE 
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE 
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR 
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF 
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS 
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN 
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) 
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE 
+# POSSIBILITY OF SUCH DAMAGE.
+# 
+"""
+HASTEN parameter sweep
+
+Expands a protocol template over parameter grids and runs the simulations
+in parallel. Recalls of all runs are collected into one table.
+"""
+import argparse
+import os
+import sys
+import itertools
+import shutil
+import subprocess
+import contextlib
+import concurrent.futures
+
+import hasten
+import hasten_analyze_simulation
+import hasten_db
+import hasten_fast_simulation
+
+def parse_cmd_line():
+    """
+    Parse command line using ArgumentParser
+
+    :return: parsed arguments
+    """
+    parser = argparse.ArgumentParser(description="Run HASTEN simulations over parameter grids")
+    parser.add_argument("-m","--database",required=True,type=str,help="HASTEN simulation database (with oracle table)")
+    parser.add_argument("-p","--protocol",required=True,type=str,help="Protocol template")
+    parser.add_argument("-g","--grid",required=True,type=str,action="append",help="Parameter values as KEY=V1,V2,... Protocol keywords replace the value of the keyword line, other keys (like STEPSIZE) are replaced as text. Can be given several times")
+    parser.add_argument("-e","--engine",required=False,type=str,choices=["fast","full"],default="fast",help="fast: in-memory simulation (default), full: hasten.py on a copy of the database")
+    parser.add_argument("-M","--model",required=False,type=str,default="ngram",help="Surrogate model for the fast engine (see hasten_fast_simulation.py)")
+    parser.add_argument("-j","--jobs",required=False,type=int,default=os.cpu_count(),help="Number of simulations run in parallel")
+    parser.add_argument("-w","--workdir",required=False,type=str,default="sweep",help="Directory for the run protocols, logs and database copies")
+    parser.add_argument("-o","--output",required=True,type=str,help="Output table (tab separated)")
+    parser.add_argument("-t","--thresholds",required=False,type=float,nargs="+",default=[0.001,0.01,0.05],help="Fractions of the best reference scores counted as hits (default: 0.001 0.01 0.05)")
+    parser.add_argument("--keep",required=False,action="store_true",help="Keep the database copies of the full engine")
+    return parser.parse_args()
+
+def files_exist(args):
+    """
+    Check if input files exist
+
+    :param args: parsed arguments
+    :return: True if files exist, false otherwise
+    """
+    if not os.path.exists(args.database):
+        print("HASTEN database file missing!")
+        return False
+    if not os.path.exists(args.protocol):
+        print("Protocol template missing!")
+        return False
+    return True
+
+def parse_grid(grid_args):
+    """
+    Parse grid definitions
+
+    :param grid_args: list of KEY=V1,V2,... strings
+    :return: list of (key,[values]) tuples
+    """
+    grid = []
+    for grid_arg in grid_args:
+        l = grid_arg.split("=",1)
+        if len(l)!=2 or len(l[0])==0 or len(l[1])==0:
+            print("Invalid grid definition:",grid_arg)
+            sys.exit(1)
+        grid.append((l[0],l[1].split(",")))
+    return grid
+
+def expand_template(template,settings):
+    """
+    Write values of one grid point into protocol template
+
+    :param template: protocol template as text
+    :param settings: list of (key,value) tuples
+    :return: protocol as text
+    """
+    keywords = dict(settings)
+    replaced = set()
+    lines = []
+    for line in template.split("\n"):
+        l = line.split("=",1)
+        if not line.startswith("#") and len(l)==2 and l[0] in keywords:
+            line = l[0]+"="+keywords[l[0]]
+            replaced.add(l[0])
+        lines.append(line)
+    protocol = "\n".join(lines)
+    for key,value in settings:
+        if key not in replaced:
+            protocol = protocol.replace(key,value)
+    return protocol
+
+def absolute_paths(protocol):
+    """
+    Make the script paths of a protocol absolute: the runs of the full
+    engine are started in their own directories
+
+    :param protocol: protocol as text
+    :return: protocol as text
+    """
+    lines = []
+    for line in protocol.split("\n"):
+        l = line.split("=",1)
+        if not line.startswith("#") and len(l)==2 and len(l[1].strip())>0:
+            if l[0] in ["confgen","docking","ml_train","ml_pred","scratch_dir"]:
+                line = l[0]+"="+os.path.abspath(l[1].strip())
+            elif l[0]=="docking_cascade":
+                stages = [stage.rsplit(":",1) for stage in l[1].split()]
+                line = l[0]+"="+" ".join([os.path.abspath(stage[0])+":"+stage[1] if len(stage)==2 else ":".join(stage) for stage in stages])
+        lines.append(line)
+    return "\n".join(lines)
+
+def clone_database(db,target):
+    """
+    Copy database cheaply: reflink (copy-on-write) where the file system
+    supports it, normal copy otherwise
+
+    :param db: The filename of SQlite3 database
+    :param target: filename of the copy
+    """
+    if sys.platform.startswith("linux"):
+        if subprocess.call(["cp","--reflink=always",db,target],stderr=subprocess.DEVNULL)==0:
+            return
+    shutil.copyfile(db,target)
+
+def run_one(run_name,protocol_name,args,cutoffs,database_size):
+    """
+    Run one simulation (in worker process)
+
+    :param run_name: name of the run
+    :param protocol_name: expanded protocol file
+    :param args: parsed arguments
+    :param cutoffs: list of (threshold,cutoff,hits) from score_cutoffs()
+    :param database_size: number of compounds in the database
+    :return: recall curve, None if the run failed (see its run.log)
+    """
+    run_dir = os.path.dirname(protocol_name)
+    with open(os.path.join(run_dir,"run.log"),"wt") as log:
+        if args.engine=="fast":
+            with contextlib.redirect_stdout(log):
+                try:
+                    protocol = hasten.get_protocol(protocol_name,check_files=False)
+                    cutoffs,curve,database_size = hasten_fast_simulation.run_fast_simulation(protocol,args.database,None,args.model,args.thresholds)
+                except SystemExit:
+                    return None
+        else:
+            clone = os.path.join(run_dir,"run.db")
+            clone_database(args.database,clone)
+            returncode = subprocess.call([sys.executable,os.path.join(os.path.dirname(os.path.abspath(__file__)),"hasten.py"),"-m",os.path.abspath(clone),"-p",os.path.abspath(protocol_name)],stdout=log,stderr=subprocess.STDOUT,cwd=run_dir)
+            if returncode!=0:
+                if not args.keep:
+                    os.unlink(clone)
+                return None
+            per_iteration = hasten_analyze_simulation.scan_docked(clone,cutoffs)
+            curve = hasten_analyze_simulation.recall_curve(per_iteration,cutoffs,database_size)
+            if not args.keep:
+                os.unlink(clone)
+    return curve
+
+def run_sweep(args):
+    """
+    Expand the template and run all simulations
+
+    :param args: Parsed arguments
+    """
+    grid = parse_grid(args.grid)
+    template = open(args.protocol,"rt").read()
+    scores = hasten_analyze_simulation.load_oracle_scores(args.database)
+    cutoffs = hasten_analyze_simulation.score_cutoffs(scores,args.thresholds)
+    database_size = len(scores)
+    del scores
+
+    if not os.path.exists(args.workdir):
+        os.mkdir(args.workdir)
+    runs = []
+    for run_number,values in enumerate(itertools.product(*[values for key,values in grid])):
+        settings = list(zip([key for key,values in grid],values))
+        run_name = "run"+str(run_number+1)
+        run_dir = os.path.join(args.workdir,run_name)
+        if not os.path.exists(run_dir):
+            os.mkdir(run_dir)
+        protocol_name = os.path.join(run_dir,"run.protocol")
+        with open(protocol_name,"wt") as w:
+            w.write(absolute_paths(expand_template(template,settings)))
+        # check protocols before starting anything
+        hasten.get_protocol(protocol_name,check_files=args.engine=="full")
+        runs.append((run_name,settings,protocol_name))
+    print(len(runs),"runs,",args.jobs,"in parallel")
+
+    # build the feature cache once instead of in every worker
+    if args.engine=="fast" and args.model=="ngram":
+        hastenids,scores = hasten_fast_simulation.load_oracle(args.database)
+        hasten_fast_simulation.NgramModel(args.database,hastenids)
+        del hastenids,scores
+
+    # workers copy the database and open their own connections
+    hasten_db.checkpoint(args.database)
+    hasten_db.close()
+
+    results = {}
+    with concurrent.futures.ProcessPoolExecutor(max_workers=args.jobs) as executor:
+        futures = {}
+        for run_name,settings,protocol_name in runs:
+            futures[executor.submit(run_one,run_name,protocol_name,args,cutoffs,database_size)] = run_name
+        for future in concurrent.futures.as_completed(futures):
+            log = os.path.join(args.workdir,futures[future],"run.log")
+            try:
+                curve = future.result()
+            except Exception as e:
+                print("Failed",futures[future],":",e)
+                continue
+            if curve is None:
+                print("Failed",futures[future]+", see",log)
+                continue
+            results[futures[future]] = curve
+            print("Finished",futures[future])
+
+    with open(args.output,"wt") as w:
+        header = ["run"]+[key for key,values in grid]+["iteration","mols","docked"]+["top"+str(threshold) for threshold,cutoff,hits in cutoffs]
+        w.write("\t".join(header)+"\n")
+        for run_name,settings,protocol_name in runs:
+            if run_name not in results:
+                continue
+            for iteration,mols,fraction,recalls in results[run_name]:
+                w.write("\t".join([run_name]+[value for key,value in settings]+[str(iteration),str(mols),str(round(fraction,6))]+[str(round(recall,4)) for recall in recalls])+"\n")
+    print("Wrote",args.output)
+    if len(results)<len(runs):
+        print(len(runs)-len(results),"runs failed and are not in the results")
+
+if __name__ == "__main__":
+    args = parse_cmd_line()
+    if (not files_exist(args)): sys.exit(1)
+    run_sweep(args)
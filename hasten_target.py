@@ -0,0 +1,158 @@
+# 
+# Copyright (c) 2021 Orion Corporation
+# 
+# Redistribution and use in source and binary forms, with or without 
+# modification, are permitted provided that the following conditions are met:
+# 
+# 1. Redistributions of source code must retain the above copyright notice, 
+# this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice, 
+# this list of conditions and the following disclaimer in the documentation 
+# and/or other materials provided with the distribution.
+# 3. Neither the name of the copyright holder nor the names of its contributors
+# may be used to endorse or promote products derived from this software 
+# without specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" 
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE 
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE 
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE 
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR 
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF 
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS 
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN 
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) 
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE 
+# POSSIBILITY OF SUCH DAMAGE.
+# 
+"""
+HASTEN targets
+
+Screen one imported library against several targets without importing it
+again:
+
+    python hasten_target.py -m screen.db -t kinase
+    python hasten.py -m screen.db -t kinase -p kinase.protocol
+
+Each target is a database "<database>.targets/<target>.db" with its own
+docking scores, predictions, poses, leaderboards and statistics keyed by
+the hastenids of the imported database. The SMILES come from the library
+store of the imported database (created here if needed, see
+hasten_library.py) and the conformers are shared: the target has no
+confs table, the confs table of the imported database is used instead.
+Run it again after importing more compounds to add them to the target.
+"""
+import argparse
+import os
+import re
+import sys
+import glob
+
+import hasten_db
+import hasten_library
+import hasten_status
+
+def parse_cmd_line():
+    """
+    Parse command line using ArgumentParser
+
+    :return: parsed arguments
+    """
+    parser = argparse.ArgumentParser(description="Create or update targets of HASTEN database")
+    parser.add_argument("-m","--database",required=True,type=str,help="HASTEN database (the imported library)")
+    parser.add_argument("-t","--target",required=False,type=str,help="Target name, list the targets if not given")
+    return parser.parse_args()
+
+def files_exist(args):
+    """
+    Check if input files exist
+
+    :param args: parsed arguments
+    :return: True if files exist, false otherwise
+    """
+    if not os.path.exists(args.database):
+        print("HASTEN database file missing!")
+        return False
+    return True
+
+def target_db(db,target):
+    """
+    :param db: The filename of SQlite3 database (the imported library)
+    :param target: target name
+    :return: the filename of the target database
+    """
+    if re.fullmatch("[A-Za-z0-9_.-]+",target) is None:
+        print("Invalid target name:",target)
+        sys.exit(1)
+    return os.path.join(db+".targets",target+".db")
+
+def get_target_db(db,target):
+    """
+    Get the database of an existing target
+
+    :param db: The filename of SQlite3 database (the imported library)
+    :param target: target name
+    :return: the filename of the target database
+    """
+    filename = target_db(db,target)
+    if not os.path.exists(filename):
+        print("Target",target,"does not exist, create it with: python hasten_target.py -m",db,"-t",target)
+        sys.exit(1)
+    return filename
+
+def create_target(db,target):
+    """
+    Create target database or add the newly imported compounds to it
+
+    :param db: The filename of SQlite3 database (the imported library)
+    :param target: target name
+    :return: number of compounds added to the target
+    """
+    if hasten_db.library_db(db) is not None:
+        print(db,"is a target database, give the imported database")
+        sys.exit(1)
+    # targets have only the hastenids, the SMILES come from the library store
+    added = hasten_library.build(db)
+    if added>0:
+        print(added,"compounds moved to library",db+".lib")
+    filename = target_db(db,target)
+    if not os.path.exists(filename):
+        os.makedirs(os.path.dirname(filename),exist_ok=True)
+        conn = hasten_db.connect(filename,create=True)
+        conn.execute("CREATE TABLE target (name TEXT,library TEXT)")
+        conn.execute("INSERT INTO target(name,library) VALUES (?,?)",[target,os.path.relpath(os.path.abspath(db),os.path.dirname(os.path.abspath(filename)))])
+        # conformers are used from the library database
+        conn.execute("DROP TABLE confs")
+        conn.commit()
+        # reopen with the library attached
+        hasten_db.close(filename)
+    conn = hasten_db.connect(filename)
+    last = conn.execute("SELECT MAX(hastenid) FROM main.data").fetchone()[0]
+    cur = conn.execute("INSERT INTO main.data(hastenid) SELECT hastenid FROM library.data WHERE hastenid > ? ORDER BY hastenid",[0 if last is None else last])
+    added = cur.rowcount
+    hasten_status.add_imported(conn,added)
+    conn.commit()
+    return added
+
+def print_targets(db):
+    """
+    Print the targets of database
+
+    :param db: The filename of SQlite3 database (the imported library)
+    """
+    filenames = sorted(glob.glob(os.path.join(db+".targets","*.db")))
+    if len(filenames)==0:
+        print("No targets for",db)
+    for filename in filenames:
+        stats = hasten_status.get_stats(hasten_db.connect(filename,readonly=True))
+        print(os.path.basename(filename)[:-3],"-- compounds:",stats["total"],"docked:",stats["docked"],"best docking score:",stats["best_dock"])
+
+if __name__ == "__main__":
+    args = parse_cmd_line()
+    if (not files_exist(args)): sys.exit(1)
+    if args.target is None:
+        print_targets(args.database)
+    else:
+        added = create_target(args.database,args.target)
+        print(added,"compounds added to target",args.target,"(",target_db(args.database,args.target),")")
+    hasten_db.close()
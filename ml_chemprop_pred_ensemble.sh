@@ -0,0 +1,8 @@
+# prediction with the spread of the ensemble (ml_chemprop_train_ensemble.sh) as
+# fourth column, needed by acquisition=ucb|thompson. chemprop writes the
+# variance of the ensemble (chemprop 1.5 or later), HASTEN takes the standard
+# deviation.
+PREDS=$(mktemp ${HASTEN_SCRATCH_DIR:-/tmp}/hasten_pred_XXXXXX.csv)
+chemprop_predict --test_path $1 --checkpoint_dir $2 --preds_path $PREDS --uncertainty_method ensemble
+awk -F, 'NR==1 {print $1","$2","$3",docking_score_std"; next} {print $1","$2","$3","($4>0 ? sqrt($4) : 0)}' $PREDS > $3
+rm -f $PREDS
@@ -0,0 +1,2 @@
+# ensemble of models for acquisition=ucb|thompson (use with ml_chemprop_pred_ensemble.sh)
+chemprop_train --target_columns docking_score --data_path $1 --separate_val_path $2 --separate_test_path $3 --dataset_type regression --ensemble_size 5 --save_dir $4
@@ -0,0 +1,9 @@
+# train_mode=shards: $1 is the manifest of the training data shards, chemprop
+# needs one file per set, so the shards are concatenated (header only once)
+# in scratch_dir of the protocol (HASTEN_SCRATCH_DIR)
+DATA=$(mktemp -d ${HASTEN_SCRATCH_DIR:-/tmp}/hasten_train_XXXXXX)
+for SET in train valid test; do
+    python -c "import json,sys; print(chr(10).join(json.load(open(sys.argv[1]))[sys.argv[2]]))" $1 $SET | xargs awk 'FNR>1 || NR==1' > $DATA/$SET.csv
+done
+chemprop_train --target_columns docking_score --data_path $DATA/train.csv --separate_val_path $DATA/valid.csv --separate_test_path $DATA/test.csv --dataset_type regression --save_dir $2
+rm -rf $DATA
@@ -35,7 +35,8 @@
 #
 import sys
 import csv
-import sqlite3
+import hasten_db
+import hasten_ingest
 
 mols = []
 confs = []
@@ -44,19 +45,10 @@ with open(sys.argv[1]) as smilesfile:
         mols.append(row[1].split("|")[1])
         conf=bytes(row[1].split("|")[0]+"\n",encoding="utf-8")
         confs.append(conf)
-try:
-    conn=sqlite3.connect(sys.argv[2])
-except:
-    print("Error while accessing database")
-    sys.exit(1)
-finally:
-    if conn:
-        c=conn.cursor()
-        # insert empty mols for these
-        to_db = []
-        for counter in range(len(mols)): 
-            to_db.append((mols[counter],confs[counter]))
-        c.executemany("REPLACE INTO confs(hastenid,conf) VALUES (?,?)",to_db)
-        conn.commit()
-        conn.close()
-        print("simulate_confgen.py done.")
+# insert empty mols for these
+to_db = []
+for counter in range(len(mols)): 
+    to_db.append((mols[counter],confs[counter]))
+hasten_ingest.write_confs(sys.argv[2],to_db)
+hasten_db.close()
+print("simulate_confgen.py done.")
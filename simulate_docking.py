@@ -26,7 +26,8 @@
 # POSSIBILITY OF SUCH DAMAGE.
 # 
 # 
-# Simulate docking i.e. read score from a textfile and insert empty pose to
+# Simulate docking i.e. read score from the oracle table (or a textfile with
+# databases imported before the oracle table existed) and store it to
 # database
 #
 # param 1 "confs". here just compound IDs
@@ -34,17 +35,16 @@
 # param 3 dock.txt (the complete docking results)
 # param 4 hasten<->smilesid mapping
 # param 5 iteration 
+# param 6 docking cascade stage (optional)
 #
 import sys
 import csv
-import sqlite3
+
+import hasten_db
+import hasten_ingest
 
 iteration = int(sys.argv[5])
-alldocks = {}
-# read in docking scores from text file
-with open(sys.argv[3]) as dockfile:
-    for row in csv.reader(dockfile,delimiter=" "):
-        alldocks[row[1]] = float(row[0])
+stage = int(sys.argv[6]) if len(sys.argv)>6 else None
 
 # read in codes and hasten ids
 smilesids_to_hastenids = {}
@@ -52,25 +52,26 @@ with open(sys.argv[4]) as hastenfile:
     for row in csv.reader(hastenfile,delimiter=" "):
         r = row[0].split("|")
         if r[0] not in smilesids_to_hastenids:
-            smilesids_to_hastenids[r[0]] = r[1]
-try:
-    conn=sqlite3.connect(sys.argv[2])
-except:
-    print("Error while accessing database!")
-    sys.exit(1)
-finally:
-    if conn:
-        c=conn.cursor()
-        to_db = []
-        for smilesid in smilesids_to_hastenids: 
-            to_db.append((alldocks[smilesid],smilesids_to_hastenids[smilesid]))
-        c.executemany("UPDATE data SET dock_score = ? WHERE hastenid = ?",to_db)
-        conn.commit()
-        to_db = []
-        for smilesid in smilesids_to_hastenids: 
-            to_db.append((iteration,smilesids_to_hastenids[smilesid]))
-        c.executemany("UPDATE data SET dock_iteration = ? WHERE hastenid = ?",to_db)
-        conn.commit()
-        conn.close()
+            smilesids_to_hastenids[r[0]] = int(r[1])
+conn=hasten_db.connect(sys.argv[2])
+c=conn.cursor()
+scores = []
+if hasten_db.has_table(conn,"oracle"):
+    hastenids = list(smilesids_to_hastenids.values())
+    chunk_size = 900
+    for start in range(0,len(hastenids),chunk_size):
+        chunk = hastenids[start:start+chunk_size]
+        scores.extend(c.execute("SELECT hastenid,score FROM oracle WHERE hastenid IN ("+",".join(["?"]*len(chunk))+")",chunk).fetchall())
+else:
+    # old simulation database: pick only the scores of this batch from the file
+    with open(sys.argv[3]) as dockfile:
+        for row in csv.reader(dockfile,delimiter=" "):
+            if row[1] in smilesids_to_hastenids:
+                scores.append((smilesids_to_hastenids[row[1]],float(row[0])))
+
+with hasten_ingest.DockIngest(sys.argv[2],stage=stage) as ingest:
+    for hastenid,score in scores:
+        ingest.add(hastenid,score,iteration)
 
-        print("simulate_docking.py OK")
+hasten_db.close()
+print("simulate_docking.py OK")
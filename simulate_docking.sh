@@ -25,4 +25,4 @@
 # ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE 
 # POSSIBILITY OF SUCH DAMAGE.
 # 
-python /data/tuomo/PROJECTS/HASTEN/simulate_docking.py $1 $2 dock.txt $3 $4
+python /data/tuomo/PROJECTS/HASTEN/simulate_docking.py $1 $2 dock.txt $3 $4 $5
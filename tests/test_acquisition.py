@@ -0,0 +1,72 @@
+# 
+# Copyright (c) 2021 Orion Corporation
+# 
+# Redistribution and use in source and binary forms, with or without 
+# modification, are permitted provided that the following conditions are met:
+# 
+# 1. Redistributions of source code must retain the above copyright notice, 
+# this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice, 
+# this list of conditions and the following disclaimer in the documentation 
+# and/or other materials provided with the distribution.
+# 3. Neither the name of the copyright holder nor the names of its contributors
+# may be used to endorse or promote products derived from this software 
+# without specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" 
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE 
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE 
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE 
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR 
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF 
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS 
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN 
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) 
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE 
+# POSSIBILITY OF SUCH DAMAGE.
+# 
+"""
+Tests of the random pick of the first iteration
+"""
+import random
+
+import hasten_acquisition
+import hasten_db
+
+PROTOCOL = {"random_seed":1909}
+
+def fill(db,size=2000,docked=0):
+    conn = hasten_db.connect(db)
+    conn.executemany("INSERT INTO data(hastenid,smiles,smilesid,dock_score,dock_iteration) VALUES (?,?,?,?,?)",[(number,"C"*(1+number%20),"MOL"+str(number),-1.0 if number<=docked else None,1 if number<=docked else None) for number in range(1,size+1)])
+    conn.commit()
+    return conn
+
+def pick(conn,seed,number):
+    # run_hasten seeds random with random_seed of the protocol
+    random.seed(seed)
+    return hasten_acquisition.pick_random(conn,PROTOCOL,number)
+
+def test_pick_random_reproducible(database):
+    conn = fill(database)
+    picked = pick(conn,1909,100)
+    assert len(picked)==100
+    assert len(set(picked))==100
+    assert pick(conn,1909,100)==picked
+    assert pick(conn,1910,100)!=picked
+
+def test_pick_random_undocked(database):
+    conn = fill(database,docked=1000)
+    picked = pick(conn,1909,200)
+    assert len(set(picked))==200
+    assert min(picked)>1000
+
+def test_pick_random_fallback(database):
+    # nearly everything is docked: the positions of the undocked compounds
+    # are drawn instead, also with the seeded random
+    conn = fill(database,docked=1990)
+    picked = pick(conn,1909,5)
+    assert len(set(picked))==5
+    assert min(picked)>1990
+    assert pick(conn,1909,5)==picked
+    # asking more than there are gives all of them
+    assert sorted(pick(conn,1909,50))==list(range(1991,2001))
@@ -0,0 +1,69 @@
+# 
+# Copyright (c) 2021 Orion Corporation
+# 
+# Redistribution and use in source and binary forms, with or without 
+# modification, are permitted provided that the following conditions are met:
+# 
+# 1. Redistributions of source code must retain the above copyright notice, 
+# this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice, 
+# this list of conditions and the following disclaimer in the documentation 
+# and/or other materials provided with the distribution.
+# 3. Neither the name of the copyright holder nor the names of its contributors
+# may be used to endorse or promote products derived from this software 
+# without specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" 
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE 
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE 
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE 
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR 
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF 
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS 
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN 
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) 
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE 
+# POSSIBILITY OF SUCH DAMAGE.
+# 
+"""
+Tests of grouping identical SMILES and picking one compound per group
+"""
+import hasten_db
+import hasten_dedup
+
+SMILES = ["CCN","CCO","CCO","CCN","c1ccccc1"]
+
+def fill(db):
+    conn = hasten_db.connect(db)
+    conn.executemany("INSERT INTO data(hastenid,smiles,smilesid) VALUES (?,?,?)",[(number,smiles,"MOL"+str(number)) for number,smiles in enumerate(SMILES,start=1)])
+    conn.commit()
+    return conn
+
+def groups(conn):
+    return dict(conn.execute("SELECT hastenid,rep FROM dup_groups").fetchall())
+
+def test_build_groups(database):
+    conn = fill(database)
+    assert hasten_dedup.build_groups(conn)==2
+    assert groups(conn)=={3:2,4:1}
+
+def test_build_groups_hash_collision(database,monkeypatch):
+    # every SMILES gets the same hash: the different SMILES must not be
+    # grouped and the identical ones behind the collision still are
+    monkeypatch.setattr(hasten_dedup,"smiles_hash",lambda smiles: 42)
+    conn = fill(database)
+    assert hasten_dedup.build_groups(conn)==2
+    assert groups(conn)=={3:2,4:1}
+
+def test_one_per_group(database):
+    conn = fill(database)
+    hasten_dedup.build_groups(conn)
+    assert hasten_dedup.one_per_group(conn,[4,1,2,3,5])==[4,2,5]
+
+def test_pick_representatives_keeps_earlier_picks(database):
+    conn = fill(database)
+    hasten_dedup.build_groups(conn)
+    # a strategy that picks different compounds on each call (like random)
+    calls = iter([[1,4,3],[5,2,3,1,4]])
+    picked = hasten_dedup.pick_representatives(conn,lambda number: next(calls)[:number],3)
+    assert picked==[1,3,5]
@@ -0,0 +1,76 @@
+# 
+# Copyright (c) 2021 Orion Corporation
+# 
+# Redistribution and use in source and binary forms, with or without 
+# modification, are permitted provided that the following conditions are met:
+# 
+# 1. Redistributions of source code must retain the above copyright notice, 
+# this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice, 
+# this list of conditions and the following disclaimer in the documentation 
+# and/or other materials provided with the distribution.
+# 3. Neither the name of the copyright holder nor the names of its contributors
+# may be used to endorse or promote products derived from this software 
+# without specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" 
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE 
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE 
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE 
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR 
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF 
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS 
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN 
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) 
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE 
+# POSSIBILITY OF SUCH DAMAGE.
+# 
+"""
+Tests of the docking cost estimate and the chunk balancing
+"""
+import hasten_dockcost
+
+def test_heavy_atoms():
+    assert hasten_dockcost.parse("CCCCCC")[0]==6
+    assert hasten_dockcost.parse("c1ccccc1")[0]==6
+    assert hasten_dockcost.parse("CC(C)Cc1ccc(cc1)C(C)C(=O)O")[0]==15
+    # two-letter halogens and bracket atoms are one atom each
+    assert hasten_dockcost.parse("ClCBr")[0]==3
+    assert hasten_dockcost.parse("[NH4+].[Cl-]")[0]==2
+    # explicit hydrogens are not heavy atoms
+    assert hasten_dockcost.parse("[H][H]")[0]==0
+    assert hasten_dockcost.parse("[2H]C")[0]==1
+
+def test_rotors():
+    # hexane: three rotatable bonds (the terminal bonds do not count)
+    assert hasten_dockcost.estimate("CCCCCC")==6+3*hasten_dockcost.ROTOR_WEIGHT
+    # ring bonds and the bonds of ethane are not rotatable
+    assert hasten_dockcost.estimate("c1ccccc1")==6
+    assert hasten_dockcost.estimate("CC")==2
+    # paracetamol: C-N and N-c, the amide C=O and the phenol O are terminal
+    assert hasten_dockcost.estimate("CC(=O)Nc1ccc(O)cc1")==11+2*hasten_dockcost.ROTOR_WEIGHT
+    # ibuprofen: four rotatable bonds
+    assert hasten_dockcost.estimate("CC(C)Cc1ccc(cc1)C(C)C(=O)O")==15+4*hasten_dockcost.ROTOR_WEIGHT
+    # a double bond is not rotatable
+    assert hasten_dockcost.estimate("CC=CC")==4
+    # bonds of a fused ring system
+    assert hasten_dockcost.estimate("c1ccc2ccccc2c1")==10
+
+def test_balance():
+    rows = [(smiles,number) for number,smiles in enumerate(["CCCCCC","c1ccccc1","CC","CCCC","CCCCCCCC","C"])]
+    chunks = hasten_dockcost.balance(rows,2)
+    # the same number of chunks as with chunks of two compounds
+    assert len(chunks)==3
+    # every compound is in exactly one chunk
+    assert sorted(row for cost,members in chunks for row in members)==sorted(rows)
+    for cost,members in chunks:
+        assert cost==sum(hasten_dockcost.estimate(row[0]) for row in members)
+    # the most expensive compound (octane) is alone
+    costs = [cost for cost,members in chunks]
+    assert max(costs)-min(costs)<=hasten_dockcost.estimate("CCCCCCCC")
+
+def test_balance_smiles_column():
+    rows = [(1,"CCCCCC"),(2,"CC")]
+    chunks = hasten_dockcost.balance(rows,1,smiles_column=1)
+    assert [members for cost,members in chunks]==[[(1,"CCCCCC")],[(2,"CC")]]
+    assert hasten_dockcost.balance([],10)==[]
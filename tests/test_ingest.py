@@ -0,0 +1,99 @@
+# 
+# Copyright (c) 2021 Orion Corporation
+# 
+# Redistribution and use in source and binary forms, with or without 
+# modification, are permitted provided that the following conditions are met:
+# 
+# 1. Redistributions of source code must retain the above copyright notice, 
+# this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice, 
+# this list of conditions and the following disclaimer in the documentation 
+# and/or other materials provided with the distribution.
+# 3. Neither the name of the copyright holder nor the names of its contributors
+# may be used to endorse or promote products derived from this software 
+# without specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" 
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE 
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE 
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE 
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR 
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF 
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS 
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN 
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) 
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE 
+# POSSIBILITY OF SUCH DAMAGE.
+# 
+"""
+Tests of writing docking results
+"""
+import hasten_db
+import hasten_dedup
+import hasten_ingest
+import hasten_status
+
+SMILES = ["CCN","CCO","CCO","CCN","c1ccccc1"]
+
+def fill(db,grouped=True):
+    conn = hasten_db.connect(db)
+    conn.executemany("INSERT INTO data(hastenid,smiles,smilesid) VALUES (?,?,?)",[(number,smiles,"MOL"+str(number)) for number,smiles in enumerate(SMILES,start=1)])
+    hasten_status.add_imported(conn,len(SMILES))
+    conn.commit()
+    if grouped:
+        hasten_dedup.build_groups(conn)
+    return conn
+
+def scores(conn):
+    return dict((hastenid,(score,iteration)) for hastenid,score,iteration in conn.execute("SELECT hastenid,dock_score,dock_iteration FROM data WHERE dock_score IS NOT NULL"))
+
+def test_fan_out(database):
+    conn = fill(database)
+    # compound 4 has the same SMILES as 1, compound 3 as 2
+    assert hasten_ingest.write_dock_batch(conn,{1:(-5.0,1,b"pose1"),3:(-7.0,1,None)})==4
+    conn.commit()
+    assert scores(conn)=={1:(-5.0,1),4:(-5.0,1),2:(-7.0,1),3:(-7.0,1)}
+    assert dict(conn.execute("SELECT hastenid,pose FROM poses").fetchall())=={1:b"pose1",4:b"pose1"}
+    assert hasten_status.get_stats(conn)["docked"]==4
+    assert hasten_status.get_stats(conn)["undocked"]==1
+
+def test_better_score_only(database):
+    conn = fill(database,grouped=False)
+    hasten_ingest.write_dock_batch(conn,{1:(-5.0,1,b"first")})
+    # a worse result of the same iteration (another batch) is not written
+    assert hasten_ingest.write_dock_batch(conn,{1:(-4.0,1,b"worse")})==0
+    assert scores(conn)[1]==(-5.0,1)
+    assert conn.execute("SELECT pose FROM poses WHERE hastenid=1").fetchone()[0]==b"first"
+    # a better one is
+    assert hasten_ingest.write_dock_batch(conn,{1:(-6.0,1,b"better")})==1
+    assert scores(conn)[1]==(-6.0,1)
+    assert conn.execute("SELECT pose FROM poses WHERE hastenid=1").fetchone()[0]==b"better"
+    # the result of a new docking iteration replaces the old one
+    assert hasten_ingest.write_dock_batch(conn,{1:(-3.0,2,None)})==1
+    assert scores(conn)[1]==(-3.0,2)
+    assert conn.execute("SELECT pose FROM poses WHERE hastenid=1").fetchone() is None
+    conn.commit()
+    assert hasten_status.get_stats(conn)["docked"]==1
+
+def test_cascade_stage(database):
+    conn = fill(database,grouped=False)
+    hasten_ingest.write_dock_batch(conn,{2:(-5.0,1,b"pose")},stage=1)
+    hasten_ingest.write_dock_batch(conn,{2:(-4.0,1,None)},stage=1)
+    conn.commit()
+    # stage scores do not count as docked
+    assert scores(conn)=={}
+    assert conn.execute("SELECT hastenid,stage,score,iteration FROM stage_scores").fetchall()==[(2,1,-5.0,1)]
+    hasten_ingest.write_dropped_batch(conn,[2])
+    conn.commit()
+    stats = hasten_status.get_stats(conn)
+    assert (stats["docked"],stats["dropped"],stats["undocked"])==(0,1,4)
+
+def test_dock_ingest(database):
+    conn = fill(database)
+    with hasten_ingest.DockIngest(database,batch_size=2) as ingest:
+        # only the best result of a compound (e.g. tautomers) is kept
+        ingest.add(5,-8.0,1)
+        ingest.add(5,-9.0,1,"pose")
+        ingest.add(2,-1.0,1)
+    assert ingest.written==3
+    assert scores(conn)=={5:(-9.0,1),2:(-1.0,1),3:(-1.0,1)}
@@ -0,0 +1,104 @@
+# 
+# Copyright (c) 2021 Orion Corporation
+# 
+# Redistribution and use in source and binary forms, with or without 
+# modification, are permitted provided that the following conditions are met:
+# 
+# 1. Redistributions of source code must retain the above copyright notice, 
+# this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice, 
+# this list of conditions and the following disclaimer in the documentation 
+# and/or other materials provided with the distribution.
+# 3. Neither the name of the copyright holder nor the names of its contributors
+# may be used to endorse or promote products derived from this software 
+# without specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" 
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE 
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE 
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE 
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR 
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF 
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS 
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN 
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) 
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE 
+# POSSIBILITY OF SUCH DAMAGE.
+# 
+"""
+Tests of the schema migrations on a database of the original HASTEN
+"""
+import sqlite3
+import pytest
+
+import hasten_db
+import hasten_status
+
+def baseline_database(db):
+    """
+    Database as created by the original hasten_import.py (user_version 0)
+    """
+    conn = sqlite3.connect(db)
+    conn.execute("CREATE TABLE data (hastenid INTEGER PRIMARY KEY,smiles TEXT,smilesid TEXT,dock_score NUMERIC,dock_iteration INTEGER,pred_score NUMERIC,dataset_status INTEGER)")
+    conn.execute("CREATE TABLE confs (hastenid INTEGER PRIMARY KEY,conf BLOB)")
+    conn.execute("CREATE TABLE poses (hastenid INTEGER PRIMARY KEY,pose BLOB)")
+    rows = [(1,"CCO","A",-7.0,1,None),(2,"CCN","B",-9.5,2,None),(3,"CCC","C",None,None,-6.0),(4,"CCO","D",None,None,-8.0),(5,"c1ccccc1","E",-3.0,None,None)]
+    conn.executemany("INSERT INTO data(hastenid,smiles,smilesid,dock_score,dock_iteration,pred_score) VALUES (?,?,?,?,?,?)",rows)
+    conn.commit()
+    conn.close()
+
+def tables(conn):
+    return set(row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type IN ('table','index','trigger')"))
+
+def test_migrate_baseline(tmp_path):
+    db = str(tmp_path/"old.db")
+    baseline_database(db)
+    conn = hasten_db.connect(db)
+    try:
+        assert conn.execute("PRAGMA user_version").fetchone()[0]==hasten_db.SCHEMA_VERSION
+        assert "pred_std" in [row[1] for row in conn.execute("PRAGMA table_info(data)")]
+        assert {"leaderboard","leaderboard_size","stage_scores","stats","iteration_stats","stats_dock","data_docked","dup_groups","data_dock_iteration"}<=tables(conn)
+        # the data is kept and the statistics are counted from it
+        assert conn.execute("SELECT COUNT(*) FROM data").fetchone()[0]==5
+        stats = hasten_status.get_stats(conn)
+        assert (stats["total"],stats["docked"],stats["dropped"],stats["undocked"],stats["best_dock"])==(5,3,0,2,-9.5)
+        assert hasten_status.get_iteration_stats(conn)==[(-1,1,-3.0),(1,1,-7.0),(2,1,-9.5)]
+        # the trigger keeps counting the docked compounds
+        conn.execute("UPDATE data SET dock_score=-10.0,dock_iteration=3 WHERE hastenid=3")
+        conn.commit()
+        stats = hasten_status.get_stats(conn)
+        assert (stats["docked"],stats["best_dock"])==(4,-10.0)
+    finally:
+        hasten_db.close(db)
+    # a migrated database is not migrated again
+    conn = hasten_db.connect(db)
+    try:
+        assert hasten_status.get_stats(conn)["docked"]==4
+    finally:
+        hasten_db.close(db)
+
+def test_migrate_partial(tmp_path):
+    db = str(tmp_path/"partial.db")
+    baseline_database(db)
+    conn = sqlite3.connect(db)
+    for migration in hasten_db.MIGRATIONS[:4]:
+        migration(conn)
+    conn.execute("PRAGMA user_version=4")
+    conn.commit()
+    conn.close()
+    conn = hasten_db.connect(db)
+    try:
+        assert conn.execute("PRAGMA user_version").fetchone()[0]==hasten_db.SCHEMA_VERSION
+        assert hasten_status.get_stats(conn)["docked"]==3
+    finally:
+        hasten_db.close(db)
+
+def test_newer_schema(tmp_path):
+    db = str(tmp_path/"new.db")
+    baseline_database(db)
+    conn = sqlite3.connect(db)
+    conn.execute("PRAGMA user_version="+str(hasten_db.SCHEMA_VERSION+1))
+    conn.close()
+    with pytest.raises(SystemExit):
+        hasten_db.connect(db)
+    hasten_db.close(db)